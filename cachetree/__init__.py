@@ -10,10 +10,18 @@ from django.db.models.fields.related import (
     ForeignRelatedObjectsDescriptor, ManyRelatedObjectsDescriptor, 
     ReverseManyRelatedObjectsDescriptor)
 from django.conf import settings as django_settings
+from django.db.backends import BaseDatabaseWrapper
 import settings as cachetree_settings
 from manager import CacheManagerMixin
 from utils import get_cached_models
-from invalidation import Invalidator, invalidate, no_invalidation
+from plans import compile_plans, PLANS
+from cache import tree_cache, key_generations, IdentityMap
+from stats import get_stats, reset_stats
+from refresh import refresher
+from invalidation import (Invalidator, invalidate, invalidate_model, no_invalidation,
+                          batch_invalidation, connect_negative_entry_signals,
+                          deferred_invalidation, async_invalidation)
+from bulk import BulkInvalidationManagerMixin, bulk_update, bulk_delete, bulk_create
 from exceptions import ImproperlyConfigured
 from auth import CachedModelBackend
 from shortcuts import get_cached_object_or_404
@@ -39,6 +47,9 @@ class _Installer(object):
                                  ForeignRelatedObjectsDescriptor,
                                  ReverseManyRelatedObjectsDescriptor):
             self.method_cache[descriptor_class] = {"__get__": descriptor_class.__get__}
+        self.method_cache[BaseDatabaseWrapper] = dict(
+            (name, BaseDatabaseWrapper.__dict__[name]) 
+            for name in ("commit", "rollback", "leave_transaction_management"))
     
     ####################################################################
     
@@ -70,9 +81,20 @@ class _Installer(object):
             self.wrap_many_related_descriptor(descriptor_cls)
             
         self._install_auth_dependencies()
+        self.wrap_transaction_methods()
+        
+        compile_plans()
+        tree_cache.configure(cachetree_settings.LOCAL_CACHE, cachetree_settings.NEGATIVE_FILTER)
+        key_generations.check_interval = cachetree_settings.GENERATION_CHECK_INTERVAL
+        key_generations.clear()
+        refresher.configure(**(cachetree_settings.STALE_REFRESH or {}))
+        async_invalidation.configure(cachetree_settings.ASYNC_INVALIDATION)
         
         if cachetree_settings.INVALIDATE and not cachetree_settings.DISABLE:
             Invalidator.install()
+        elif not cachetree_settings.DISABLE:
+            # Misses are still cleared when their instances are created.
+            connect_negative_entry_signals()
             
         self.installed = True
        
@@ -120,14 +142,60 @@ class _Installer(object):
                                ManyRelatedObjectsDescriptor, 
                                ReverseManyRelatedObjectsDescriptor):
             descriptor_cls.__get__ = self.method_cache.get(descriptor_cls).get("__get__")
+        for name, method in self.method_cache[BaseDatabaseWrapper].iteritems():
+            setattr(BaseDatabaseWrapper, name, method)
             
         if cachetree_settings.INVALIDATE and not cachetree_settings.DISABLE:
             Invalidator.uninstall()
+        connect_negative_entry_signals(action="disconnect")
             
+        PLANS.clear()
+        tree_cache.configure(None)
+        refresher.stop()
+        async_invalidation.configure(None)
+        
         self.installed = False
     
     ####################################################################
     
+    def wrap_transaction_methods(self):
+        """Wraps the database connections' commit and rollback methods to
+        invalidate or drop the invalidations deferred until the end of the
+        transaction (see CACHETREE_DEFER_INVALIDATION), and queue or drop
+        those held for asynchronous invalidation (see
+        CACHETREE_ASYNC_INVALIDATION), and leave_transaction_management to
+        invalidate or queue any that are left once the connection is no
+        longer managed.
+        """
+        original_methods = self.method_cache[BaseDatabaseWrapper]
+        
+        original_commit = original_methods["commit"]
+        def commit(self):
+            original_commit(self)
+            deferred_invalidation.flush(self.alias)
+            async_invalidation.flush(self.alias)
+        BaseDatabaseWrapper.commit = wraps(original_commit)(commit)
+        
+        original_rollback = original_methods["rollback"]
+        def rollback(self):
+            original_rollback(self)
+            deferred_invalidation.discard(self.alias)
+            async_invalidation.discard(self.alias)
+        BaseDatabaseWrapper.rollback = wraps(original_rollback)(rollback)
+        
+        original_leave_transaction_management = original_methods["leave_transaction_management"]
+        def leave_transaction_management(self):
+            try:
+                original_leave_transaction_management(self)
+            finally:
+                if not self.is_managed():
+                    deferred_invalidation.flush(self.alias)
+                    async_invalidation.flush(self.alias)
+        BaseDatabaseWrapper.leave_transaction_management = wraps(
+            original_leave_transaction_management)(leave_transaction_management)
+        
+    ####################################################################
+    
     @staticmethod
     def wrap_many_related_descriptor(descriptor_cls):
         """Wraps the ``descriptor_cls``'s __get__ method to return a modified
@@ -161,9 +229,18 @@ class _Installer(object):
             original_all = manager.__class__.all
             def all_(*args, **kwargs):
                 try:
-                    return getattr(instance, cached_attr_name)
+                    cached = getattr(instance, cached_attr_name)
                 except AttributeError:
                     return original_all(*args, **kwargs)
+                if isinstance(cached, list):
+                    # Trees read by the row serializer store the related
+                    # objects as a list; turn it into the queryset that
+                    # all() would have returned.
+                    queryset = original_all(*args, **kwargs)
+                    queryset._result_cache = cached
+                    setattr(instance, cached_attr_name, queryset)
+                    return queryset
+                return cached
             manager.__class__.all = wraps(original_all)(all_)
             
             def uncache(*args, **kwargs):
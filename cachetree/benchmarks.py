@@ -0,0 +1,294 @@
+"""
+Cachetree Benchmarks
+"""
+
+########################################################################
+
+import sys
+import time
+from copy import copy
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from cache import cache
+from invalidation import Invalidator
+from plans import get_cache_plan
+from utils import generate_base_key, get_cache_settings, md5, WHITESPACE
+import serializers
+
+########################################################################
+
+def time_per_call(function, iterations):
+    """Returns the average number of seconds taken by one call to
+    ``function``.
+    """
+    start = time.time()
+    for i in xrange(iterations):
+        function()
+    return (time.time() - start) / iterations
+
+########################################################################
+
+def get_sample_kwargs(model):
+    """Returns get_cached kwargs for the first instance of ``model``, using
+    the model's first lookup, or None if there are no instances.
+    """
+    sample = get_sample_kwargs_list(model, 1)
+    if not sample:
+        return None
+    return sample[0]
+
+def get_sample_kwargs_list(model, count):
+    """Returns a list of get_cached kwargs for the first ``count`` instances
+    of ``model``, using the model's first lookup.
+    """
+    lookup = get_cache_plan(model).lookups[0]
+    sample = list()
+    for instance in model._default_manager.all()[:count]:
+        kwargs = dict()
+        for name in lookup:
+            if name == "pk":
+                kwargs[name] = instance.pk
+            else:
+                kwargs[name] = getattr(instance, model._meta.get_field(name).attname)
+        sample.append(kwargs)
+    return sample
+
+########################################################################
+
+def _uncompiled_get_cached_hit(manager, **kwargs):
+    """The get_cached hit path as it was before cache plans: reads the
+    settings, computes select_related and builds the base queryset, and
+    checks the kwargs against every lookup on each call.
+    """
+    cache_settings = get_cache_settings(manager.model)
+    lookups = cache_settings.get("lookups")
+    prefetch = cache_settings.get("prefetch")
+
+    related = manager._get_select_related_from_attrs(manager.model, prefetch)
+    if related:
+        base_qs = manager.all().select_related(*related)
+    else:
+        base_qs = manager.all()
+
+    keys = kwargs.keys()
+    single_kwarg_match = len(keys) == 1 and keys[0] in lookups
+    multi_kwarg_match = len(keys) != 1 and any(
+        sorted(keys) == sorted(lookup) for lookup in lookups if isinstance(lookup, (list, tuple)))
+    if not single_kwarg_match and not multi_kwarg_match:
+        raise ValueError("Caching not allowed with kwargs %s" % ", ".join(keys))
+
+    obj = cache.get(generate_base_key(manager.model, **kwargs))
+    if isinstance(obj, (ObjectDoesNotExist, MultipleObjectsReturned)):
+        raise ValueError("%r is not a cached tree" % obj)
+    return obj
+
+def benchmark_hit_path(model, kwargs=None, iterations=10000):
+    """Times get_cached for an instance of ``model`` that is already in the
+    cache. Returns a list of (name, seconds per call) tuples, comparing the
+    compiled hit path with the uncompiled one and with a bare cache.get.
+    """
+    manager = model._default_manager
+    if kwargs is None:
+        kwargs = get_sample_kwargs(model)
+        if kwargs is None:
+            return []
+
+    # Make sure the instance is in the cache.
+    manager.get_cached(**kwargs)
+    key = get_cache_plan(model).make_key(kwargs)
+
+    return [
+        ("cache.get", time_per_call(lambda: cache.get(key), iterations)),
+        ("get_cached (uncompiled)", time_per_call(
+            lambda: _uncompiled_get_cached_hit(manager, **kwargs), iterations)),
+        ("get_cached", time_per_call(lambda: manager.get_cached(**kwargs), iterations)),
+    ]
+
+########################################################################
+
+def build_tree(root, nodes):
+    """Returns a copy of the ``root`` instance with a list of ``nodes`` - 1
+    copies of it attached, for a tree of ``nodes`` instances.
+    """
+    def copy_instance(instance):
+        instance_copy = copy(instance)
+        instance_copy.__dict__ = dict(instance.__dict__)
+        instance_copy._state = copy(instance._state)
+        return instance_copy
+    tree = copy_instance(root)
+    tree._cachetree_benchmark_nodes = [copy_instance(root) for i in xrange(nodes - 1)]
+    return tree
+
+def benchmark_serialization(model, kwargs=None, iterations=100, sizes=(10, 100, 1000)):
+    """Times each built-in serializer's dumps and loads for the cached tree
+    of an instance of ``model``, and for trees of each of the
+    ``sizes``, in nodes, built from that instance. Returns a list of (name,
+    seconds per call) tuples; the names include the serialized sizes.
+    """
+    manager = model._default_manager
+    if kwargs is None:
+        kwargs = get_sample_kwargs(model)
+        if kwargs is None:
+            return []
+    
+    trees = [("cached tree", manager.get_cached(**kwargs))]
+    root = manager.get(**kwargs)
+    for nodes in sizes:
+        trees.append(("%s nodes" % nodes, build_tree(root, nodes)))
+    
+    results = list()
+    for tree_name, tree in trees:
+        for serializer in _get_builtin_serializers():
+            serializer_name = serializer.__class__.__name__
+            data = serializer.dumps(tree)
+            results.append(("%s dumps, %s (%s bytes)" % (serializer_name, tree_name, len(data)), 
+                            time_per_call(lambda: serializer.dumps(tree), iterations)))
+            results.append(("%s loads, %s" % (serializer_name, tree_name), 
+                            time_per_call(lambda: serializer.loads(data), iterations)))
+    return results
+
+def _get_builtin_serializers():
+    return sorted(serializers.BUILTIN_SERIALIZERS.values(), key=lambda serializer: serializer.id)
+
+def benchmark_serializers(model, iterations=100, sample_size=20):
+    """Compares the built-in serializers, and the ``model``'s own serializer,
+    on the cached trees of a sample of ``sample_size`` instances of
+    ``model``, as they are stored in the cache (with fallbacks, but without
+    compression). Returns a list of (name, seconds per tree) tuples; the
+    names include the average serialized size.
+    """
+    manager = model._default_manager
+    trees = [manager.get_cached(**kwargs) 
+             for kwargs in get_sample_kwargs_list(model, sample_size)]
+    if not trees:
+        return []
+    
+    model_serializers = _get_builtin_serializers()
+    plan = get_cache_plan(model)
+    if plan.serializer not in model_serializers:
+        model_serializers.append(plan.serializer)
+    
+    results = list()
+    iterations = max(1, iterations / len(trees))
+    for serializer in model_serializers:
+        serializer_name = serializer.__class__.__name__
+        if serializer is plan.serializer:
+            serializer_name += " (%s.%s)" % (model._meta.app_label, model.__name__)
+        data = [serializers.dumps(tree, serializer) for tree in trees]
+        average_size = sum(len(tree_data) for tree_data in data) / len(data)
+        results.append(("%s dumps (%s bytes per tree)" % (serializer_name, average_size), 
+                        time_per_call(lambda: [serializers.dumps(tree, serializer) for tree in trees], 
+                                      iterations) / len(trees)))
+        results.append(("%s loads" % serializer_name, 
+                        time_per_call(lambda: [serializers.loads(tree_data) for tree_data in data], 
+                                      iterations) / len(trees)))
+    return results
+
+########################################################################
+
+def _legacy_make_key(key_prefix, kwargs):
+    """make_key as it was before unhashed keys: always hashed, and always
+    sorting the kwargs and stripping whitespace.
+    """
+    key_parts = []
+    for name, value in sorted(kwargs.iteritems()):
+        key_parts.append("%s:%s" % (name, value))
+    raw_key = (key_prefix + ";".join(key_parts)).encode('utf-8')
+    return "cachetree.%s_%s" % (WHITESPACE.sub("", raw_key)[:125], md5(raw_key).hexdigest())
+
+def _legacy_instance_keys(plan, instances):
+    """The invalidation keys of the ``instances``, generated as they were
+    before lookup templates: building kwargs for each lookup of each
+    instance.
+    """
+    model = plan.model
+    keys = list()
+    for instance in instances:
+        for lookup in plan.lookups:
+            kwargs = {}
+            for fieldname in lookup:
+                if fieldname == "pk":
+                    field = model._meta.pk
+                else:
+                    field = model._meta.get_field(fieldname)
+                kwargs[fieldname] = getattr(instance, field.get_attname())
+            keys.append(_legacy_make_key(plan.key_prefix, kwargs))
+    return keys
+
+def benchmark_keys(model, kwargs=None, iterations=100, fan_out=1000):
+    """Times generating the key of one lookup, and the invalidation keys of
+    ``fan_out`` instances of ``model`` (copies of one instance), comparing
+    each with the way it was done before unhashed keys and lookup
+    templates. Returns a list of (name, seconds per call) tuples.
+    """
+    if kwargs is None:
+        kwargs = get_sample_kwargs(model)
+        if kwargs is None:
+            return []
+    plan = get_cache_plan(model)
+    instance = model._default_manager.get(**kwargs)
+    instances = [copy(instance) for i in xrange(fan_out)]
+    
+    return [
+        ("make_key (legacy)", time_per_call(
+            lambda: _legacy_make_key(plan.key_prefix, kwargs), iterations * 100)),
+        ("make_key", time_per_call(lambda: plan.make_key(kwargs), iterations * 100)),
+        ("invalidation keys, %s instances (legacy)" % fan_out, time_per_call(
+            lambda: _legacy_instance_keys(plan, instances), iterations)),
+        ("invalidation keys, %s instances" % fan_out, time_per_call(
+            lambda: plan.make_instance_keys(instances), iterations)),
+    ]
+
+########################################################################
+
+def benchmark_snapshots(model, kwargs=None, iterations=100000):
+    """Times loading ``iterations`` rows of ``model``, which can be any model
+    invalidation follows (instances built from the values of one row, as a
+    queryset builds them, with the installed post_init handlers), and
+    compares the snapshot of the original field values taken for each row,
+    a tuple, with the copy of each row's __dict__ taken before snapshots.
+    Returns a list of (name, seconds per call) tuples; the names include
+    the memory each snapshot takes per row and for all the rows.
+    """
+    if model not in Invalidator.INVALIDATION_PATHS:
+        return []
+    if kwargs is None:
+        # The model may only be cached in other models' trees, so it may
+        # have no lookups.
+        instances = list(model._default_manager.all()[:1])
+        if not instances:
+            return []
+        instance = instances[0]
+    else:
+        instance = model._default_manager.get(**kwargs)
+    values = [getattr(instance, field.attname) for field in model._meta.fields]
+    
+    def get_memory(bytes_per_row):
+        return "%s bytes per row, %.1f MB per %s rows" % (
+            bytes_per_row, bytes_per_row * iterations / 1048576.0, iterations)
+    state = instance.__dict__.copy()
+    state.pop("_orig_state", None)
+    legacy_size = sys.getsizeof(state)
+    Invalidator.copy_instance(model, instance)
+    orig_state = instance._orig_state
+    snapshot_size = sys.getsizeof(orig_state) + sys.getsizeof(orig_state.values)
+    
+    return [
+        ("load %s rows" % iterations, time_per_call(
+            lambda: [model(*values) for i in xrange(iterations)], 1)),
+        ("__dict__ copy (%s)" % get_memory(legacy_size), time_per_call(
+            lambda: state.copy(), iterations)),
+        ("snapshot (%s)" % get_memory(snapshot_size), time_per_call(
+            lambda: Invalidator.copy_instance(model, instance), iterations)),
+    ]
+
+########################################################################
+
+BENCHMARKS = {
+    "hitpath": benchmark_hit_path,
+    "serialization": benchmark_serialization,
+    "serializers": benchmark_serializers,
+    "keys": benchmark_keys,
+    "snapshots": benchmark_snapshots,
+}
+
+########################################################################
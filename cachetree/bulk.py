@@ -0,0 +1,205 @@
+"""
+Cachetree Bulk Operations
+"""
+
+########################################################################
+
+from __future__ import with_statement
+from django.db.models.deletion import Collector
+from invalidation import Invalidator, InvalidationBatch, NoInvalidation, deferred_invalidation
+from utils import get_cache_settings
+import settings as cachetree_settings
+
+########################################################################
+
+class BulkInvalidationQuerySetMixin(object):
+    """Makes a queryset's update(), delete() and bulk_create() invalidate the
+    trees of the affected instances, which QuerySet.update() and
+    bulk_create() don't send signals for, and which QuerySet.delete()
+    invalidates one instance at a time.
+
+    The root instances are found with set-based queries along the
+    invalidation paths (one query per step of each path), from the
+    affected instances before and after the write (for update(), only the
+    values of their tracked fields), and all of their keys are invalidated
+    with a single delete_many.
+    """
+
+    def update(self, **kwargs):
+        model = self.model
+        if not _invalidates(model):
+            return super(BulkInvalidationQuerySetMixin, self).update(**kwargs)
+
+        assert self.query.can_filter(), \
+                "Cannot update a query once a slice has been taken."
+
+        # Only the tracked fields are needed to follow the invalidation
+        # paths and generate the root instances' keys.
+        fields = [field for field in model._meta.fields
+                  if field.attname in Invalidator.get_tracked_attnames(model)]
+        attnames = [field.attname for field in fields]
+        names = [field.name for field in fields]
+        pk_index = attnames.index(model._meta.pk.attname)
+        rows = _values_in_pk_chunks(self._clone(), names, pk_index)
+        batch = InvalidationBatch()
+        batch.add_changed_rows(model, attnames, rows, self.db)
+        count = super(BulkInvalidationQuerySetMixin, self).update(**kwargs)
+
+        # Follow the paths again from the updated rows, which may now have
+        # other keys, or be related to other root instances.
+        pks = [row[pk_index] for row in rows]
+        updated_rows = list()
+        chunk_size = Invalidator.BULK_CHUNK_SIZE
+        for start in xrange(0, len(pks), chunk_size):
+            updated_rows.extend(model._base_manager.using(self.db).filter(
+                pk__in=pks[start:start + chunk_size]).values_list(*names))
+        batch.add_changed_rows(model, attnames, updated_rows, self.db)
+        deferred_invalidation.invalidate(batch, self.db)
+        return count
+    update.alters_data = True
+
+    def delete(self):
+        if not _invalidates(self.model):
+            return super(BulkInvalidationQuerySetMixin, self).delete()
+        assert self.query.can_filter(), \
+                "Cannot use 'limit' or 'offset' with delete."
+
+        # Collect the instances to be deleted or updated, including the
+        # cascades, as QuerySet.delete does.
+        del_query = self._clone()
+        del_query._for_write = True
+        del_query.query.select_related = False
+        del_query.query.clear_ordering()
+        collector = Collector(using=del_query.db)
+        collector.collect(del_query)
+
+        batch = InvalidationBatch()
+        for model, instances in collector.data.iteritems():
+            batch.add_changed_instances(model, list(instances), self.db)
+        updated_instances = dict()
+        for model, instances_for_fieldvalues in collector.field_updates.iteritems():
+            instances = updated_instances[model] = set()
+            for field_instances in instances_for_fieldvalues.itervalues():
+                instances.update(field_instances)
+            batch.add_changed_instances(model, list(instances), self.db)
+
+        with NoInvalidation():
+            collector.delete()
+
+        # Instances whose foreign keys were set to null may now have other
+        # keys.
+        for model, instances in updated_instances.iteritems():
+            batch.add_changed_instances(model, list(instances), self.db)
+        deferred_invalidation.invalidate(batch, self.db)
+        self._result_cache = None
+    delete.alters_data = True
+
+    def bulk_create(self, objs):
+        """Inserts the ``objs``, with QuerySet.bulk_create if this version of
+        Django has it, or else one save() at a time, but with one
+        invalidation for all of them.
+        """
+        model = self.model
+        invalidates = _invalidates(model)
+        queryset = super(BulkInvalidationQuerySetMixin, self)
+        if hasattr(queryset, "bulk_create"):
+            objs = queryset.bulk_create(objs)
+        else:
+            with NoInvalidation():
+                for obj in objs:
+                    obj.save(force_insert=True, using=self.db)
+
+        batch = InvalidationBatch()
+        if invalidates:
+            batch.add_changed_instances(model, objs, self.db)
+        elif _clears_negative_entries() and _is_cached(model):
+            # Clear the cached misses at the new instances' keys.
+            batch.add_root_instances(objs)
+        deferred_invalidation.invalidate(batch, self.db)
+        return objs
+    bulk_create.alters_data = True
+
+########################################################################
+
+class BulkInvalidationManagerMixin(object):
+    """Add to a cached model's manager classes, like CacheManagerMixin, to
+    make the querysets it returns invalidate the trees of the instances
+    changed by update(), delete() and bulk_create(). See
+    BulkInvalidationQuerySetMixin.
+    """
+
+    def get_query_set(self):
+        return get_bulk_queryset(super(BulkInvalidationManagerMixin, self).get_query_set())
+
+    def bulk_create(self, objs):
+        return self.get_query_set().bulk_create(objs)
+
+########################################################################
+
+# Maps each queryset class to its subclass with BulkInvalidationQuerySetMixin.
+BULK_QUERYSET_CLASSES = {}
+
+def get_bulk_queryset(queryset):
+    """Returns a copy of the ``queryset`` whose update(), delete() and
+    bulk_create() invalidate the affected trees in bulk.
+    """
+    queryset_class = queryset.__class__
+    if issubclass(queryset_class, BulkInvalidationQuerySetMixin):
+        return queryset
+    bulk_class = BULK_QUERYSET_CLASSES.get(queryset_class)
+    if bulk_class is None:
+        bulk_class = BULK_QUERYSET_CLASSES[queryset_class] = type(
+            "Bulk%s" % queryset_class.__name__, (BulkInvalidationQuerySetMixin, queryset_class), {})
+    return queryset._clone(klass=bulk_class)
+
+def bulk_update(queryset, **kwargs):
+    """Updates the instances in the ``queryset`` with the ``kwargs``, as
+    QuerySet.update does, and invalidates their trees in bulk. Returns the
+    number of rows updated.
+    """
+    return get_bulk_queryset(queryset).update(**kwargs)
+
+def bulk_delete(queryset):
+    """Deletes the instances in the ``queryset``, as QuerySet.delete does, and
+    invalidates their trees in bulk.
+    """
+    get_bulk_queryset(queryset).delete()
+
+def bulk_create(model, objs):
+    """Inserts the ``objs``, new instances of ``model``, and invalidates the
+    trees they are part of in bulk. Returns the ``objs``.
+    """
+    return get_bulk_queryset(model._default_manager.all()).bulk_create(objs)
+
+########################################################################
+
+def _values_in_pk_chunks(queryset, names, pk_index):
+    """Returns a list of the values of the fields ``names`` of the instances
+    in the unsliced ``queryset``, whose pks are at ``pk_index``, with one
+    values_list query per chunk of ``BULK_CHUNK_SIZE`` instances, in pk
+    order.
+    """
+    queryset = queryset.order_by("pk").values_list(*names)
+    chunk_size = Invalidator.BULK_CHUNK_SIZE
+    chunk = list(queryset[:chunk_size])
+    rows = list(chunk)
+    while len(chunk) == chunk_size:
+        chunk = list(queryset.filter(pk__gt=chunk[-1][pk_index])[:chunk_size])
+        rows.extend(chunk)
+    return rows
+
+def _invalidates(model):
+    return (cachetree_settings.INVALIDATE and not cachetree_settings.DISABLE
+            and model in Invalidator.INVALIDATION_PATHS)
+
+def _clears_negative_entries():
+    return not cachetree_settings.INVALIDATE and not cachetree_settings.DISABLE
+
+def _is_cached(model):
+    try:
+        get_cache_settings(model)
+    except ValueError:
+        return False
+    return True
+
+########################################################################
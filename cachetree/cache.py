@@ -2,11 +2,630 @@
 Cachetree Cache Wrapper
 """
 
+import sys
+import threading
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
 from django.core.cache import get_cache, DEFAULT_CACHE_ALIAS
-from django.utils.functional import SimpleLazyObject
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.utils.functional import SimpleLazyObject, wraps
+import serializers
 
 # Wrap django.core.cache.get_cache in SimpleLazyObject. The purpose of this is
 # to allow the cachetree test suite to switch to the locmem backend when
 # running tests and not interfere with the real cache. See
 # https://code.djangoproject.com/ticket/16006
-cache = SimpleLazyObject(lambda: get_cache(DEFAULT_CACHE_ALIAS))
\ No newline at end of file
+cache = SimpleLazyObject(lambda: get_cache(DEFAULT_CACHE_ALIAS))
+
+########################################################################
+
+def get_generation_key(key_prefix, model):
+    return "%s%s.%s" % (key_prefix, model._meta.app_label, model.__name__)
+
+def get_side_key(key, name):
+    """Returns the key of the ``name`` entry (a lock, marker or counter) kept
+    next to the tree at ``key``. Side keys start with "cachetree-", which no
+    tree key does (see utils.make_key_from_raw), so a lookup value can't
+    make a tree key equal to another tree's side key.
+    """
+    return "cachetree-%s:%s" % (name, key)
+
+def incr_counter(key, timeout, delta=1):
+    """Increments the counter in the shared cache at ``key`` by ``delta``, or
+    sets it to ``delta`` with the ``timeout`` if it doesn't exist. Returns
+    its new value.
+    """
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, timeout):
+            return delta
+        return cache.incr(key, delta)
+
+class Generations(object):
+    """Per-model generation counters, kept in the shared cache under
+    ``key_prefix`` followed by the model's label, and read by each process at
+    most once every ``check_interval`` seconds.
+    """
+
+    # Generations are kept for as long as the cache allows.
+    TIMEOUT = 365 * 24 * 60 * 60
+
+    def __init__(self, key_prefix, check_interval=1):
+        self.key_prefix = key_prefix
+        self.check_interval = check_interval
+        self.clear()
+
+    def clear(self):
+        # Maps each model to a (generation, checked) tuple.
+        self._generations = {}
+
+    def get(self, model):
+        """Returns the ``model``'s generation, seeding it if it is missing
+        (see _seed).
+        """
+        now = time.time()
+        generation, checked = self._generations.get(model, (None, 0))
+        if generation is None or now - checked >= self.check_interval:
+            key = get_generation_key(self.key_prefix, model)
+            generation = cache.get(key)
+            if generation is None:
+                generation = self._seed(model, key)
+            self._generations[model] = (generation, now)
+        return generation
+
+    def bump(self, models):
+        """Increments the generation of each of the ``models``, in every
+        process.
+        """
+        now = time.time()
+        for model in models:
+            key = get_generation_key(self.key_prefix, model)
+            try:
+                generation = cache.incr(key)
+            except ValueError:
+                self._seed(model, key)
+                generation = cache.incr(key)
+            self._generations[model] = (generation, now)
+
+    def _seed(self, model, key):
+        """Sets the ``model``'s missing generation at ``key``, which may have
+        been evicted, to a value higher than any it had before: the current
+        time in milliseconds, or the generation after the last one this
+        process saw, if that is higher. Seeding it with 0 would make the
+        trees of every earlier generation reachable again. Returns the
+        generation, which another process may have seeded first.
+        """
+        generation = int(time.time() * 1000)
+        last_generation = self._generations.get(model, (None, 0))[0]
+        if last_generation is not None:
+            generation = max(generation, last_generation + 1)
+        if cache.add(key, generation, self.TIMEOUT):
+            return generation
+        return cache.get(key) or generation
+
+key_generations = Generations("cachetree.gen.")
+
+########################################################################
+
+class LocalCache(object):
+    """A per-process cache of serialized trees, bounded by number of entries
+    and by total bytes, with least-recently-used eviction and a short
+    timeout.
+
+    Every entry records its model's generation, a counter kept in the shared
+    cache that is incremented whenever any process invalidates a tree of
+    that model. Hits on entries from an older generation are treated as
+    misses, so invalidations in other processes are seen within
+    ``generation_check_interval`` seconds.
+
+    Entries are stored serialized and deserialized by the caller on every
+    hit, so callers never share (or mutate) the cached copy.
+    """
+
+    GENERATION_KEY_PREFIX = "cachetree.l1gen."
+
+    def __init__(self, max_entries=1000, max_bytes=10 * 1024 * 1024, timeout=5,
+                 generation_check_interval=1):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.generations = Generations(self.GENERATION_KEY_PREFIX, generation_check_interval)
+        self._lock = threading.Lock()
+        self.clear()
+
+    ####################################################################
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            # Each entry is a (data, model, generation, expires) tuple.
+            self._entries = OrderedDict()
+            self._bytes = 0
+            self.generations.clear()
+        finally:
+            self._lock.release()
+
+    ####################################################################
+
+    @classmethod
+    def get_generation_key(cls, model):
+        return get_generation_key(cls.GENERATION_KEY_PREFIX, model)
+
+    def get_generation(self, model):
+        """Returns the ``model``'s generation, reading it from the shared cache
+        at most once every ``generation_check_interval`` seconds.
+        """
+        return self.generations.get(model)
+
+    def bump_generations(self, models):
+        """Increments the generation of each of the ``models``, making their
+        entries stale in every process.
+        """
+        self.generations.bump(models)
+
+    ####################################################################
+
+    def get(self, key, model):
+        """Returns the serialized tree stored at ``key``, or None.
+        """
+        generation = self.get_generation(model)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] != generation or entry[3] <= time.time():
+                self._delete(key)
+                return None
+            # Move the entry to the end, as the most recently used.
+            del self._entries[key]
+            self._entries[key] = entry
+        finally:
+            self._lock.release()
+        return entry[0]
+
+    def set(self, key, data, model):
+        if len(data) > self.max_bytes:
+            return
+        entry = (data, model, self.get_generation(model), time.time() + self.timeout)
+        self._lock.acquire()
+        try:
+            self._delete(key)
+            self._entries[key] = entry
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._delete(iter(self._entries).next())
+        finally:
+            self._lock.release()
+
+    def delete_many(self, keys):
+        self._lock.acquire()
+        try:
+            for key in keys:
+                self._delete(key)
+        finally:
+            self._lock.release()
+
+    def _delete(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            del self._entries[key]
+            self._bytes -= len(entry[0])
+
+    def __len__(self):
+        return len(self._entries)
+
+########################################################################
+
+class NegativeFilter(LocalCache):
+    """A per-process cache of recent misses (cached DoesNotExist and
+    MultipleObjectsReturned errors), bounded by number of entries, so that
+    repeated lookups of instances that don't exist don't go to the shared
+    cache. Misses are kept out of the LocalCache, where they would evict
+    trees.
+
+    Like the LocalCache, entries are made stale by invalidations in any
+    process, through a generation of their own.
+    """
+
+    GENERATION_KEY_PREFIX = "cachetree.negen."
+
+    def __init__(self, max_entries=10000, timeout=60, generation_check_interval=1):
+        # Entries are a couple of bytes each, so only their number is bounded.
+        super(NegativeFilter, self).__init__(
+            max_entries=max_entries, max_bytes=sys.maxint, timeout=timeout,
+            generation_check_interval=generation_check_interval)
+
+########################################################################
+
+class StaleEntry(object):
+    """Wraps a serialized tree of a model with a ``stale_ttl`` in the shared
+    cache. The tree is fresh until the ``fresh_until`` timestamp, and can be served
+    stale, while it is refreshed, until the cache entry expires.
+    """
+
+    __slots__ = ("obj", "fresh_until")
+
+    def __init__(self, obj, fresh_until):
+        self.obj = obj
+        self.fresh_until = fresh_until
+
+    def __reduce__(self):
+        return (self.__class__, (self.obj, self.fresh_until))
+
+    def is_stale(self):
+        return self.fresh_until <= time.time()
+
+########################################################################
+
+class Pointer(object):
+    """Stored in the shared cache under a lookup key of a model with
+    ``pointers`` enabled, in place of a tree, to point to the tree stored
+    under the instance's pk key.
+    """
+
+    __slots__ = ("pk",)
+
+    def __init__(self, pk):
+        self.pk = pk
+
+    def __reduce__(self):
+        return (self.__class__, (self.pk,))
+
+########################################################################
+
+class TreeCache(object):
+    """The layer that get_cached, get_many_cached and invalidation go through
+    to read, write, and delete cached trees. Serializes trees, and adds the
+    optional LocalCache tier (and NegativeFilter, for misses) in front of the
+    shared cache, and the identity map of the current thread's IdentityMap
+    scope, if any, in front of both.
+    """
+
+    def __init__(self):
+        self.local = None
+        self.negative = None
+        self._identity = threading.local()
+
+    def configure(self, local_cache_settings=None, negative_filter_settings=None):
+        """Enables the local tier with the ``local_cache_settings`` (a
+        dictionary of LocalCache arguments), or disables it if they are None,
+        and likewise the negative filter with the ``negative_filter_settings``.
+        """
+        if local_cache_settings is None:
+            self.local = None
+        else:
+            self.local = LocalCache(**local_cache_settings)
+        if negative_filter_settings is None:
+            self.negative = None
+        else:
+            self.negative = NegativeFilter(**negative_filter_settings)
+
+    ####################################################################
+
+    def begin_identity_map(self):
+        """Starts memoizing the trees read or written by the current thread.
+        Nested scopes share the outermost scope's identity map.
+        """
+        depth = getattr(self._identity, "depth", 0)
+        if not depth:
+            self._identity.objects = {}
+        self._identity.depth = depth + 1
+
+    def reset_identity_map(self):
+        """Starts a new outermost scope with an empty identity map, dropping
+        any scope the current thread didn't end.
+        """
+        self._identity.objects = {}
+        self._identity.depth = 1
+
+    def end_identity_map(self):
+        depth = self._identity.depth - 1
+        if not depth:
+            self._identity.objects = None
+        self._identity.depth = depth
+
+    def get_identity_map(self):
+        """Returns the current thread's identity map, or None.
+        """
+        return getattr(self._identity, "objects", None)
+
+    def evict_key_prefixes(self, key_prefixes):
+        """Removes the keys that start with any of the ``key_prefixes`` from
+        the current thread's identity map.
+        """
+        identity_map = self.get_identity_map()
+        if identity_map:
+            key_prefixes = tuple(key_prefixes)
+            for key in [key for key in identity_map if key.startswith(key_prefixes)]:
+                del identity_map[key]
+
+    ####################################################################
+
+    @staticmethod
+    def _wrap(obj, data, plan):
+        """Returns the value to put in the shared cache for the tree ``obj``,
+        serialized as ``data``, and its timeout.
+        """
+        if isinstance(obj, (ObjectDoesNotExist, MultipleObjectsReturned)):
+            return data, plan.negative_timeout
+        if plan.stale_ttl is None:
+            return data, plan.timeout
+        timeout = plan.timeout
+        if timeout is None:
+            timeout = cache.default_timeout
+        return StaleEntry(data, time.time() + timeout), timeout + plan.stale_ttl
+
+    @staticmethod
+    def _unwrap(key, value, on_stale):
+        """Returns the serialized tree in the shared cache ``value``, calling
+        ``on_stale(key)`` if it is stale.
+        """
+        if isinstance(value, StaleEntry):
+            if on_stale is not None and value.is_stale():
+                on_stale(key)
+            return value.obj
+        return value
+
+    def _get_local(self, key, model):
+        """Returns the serialized tree at ``key`` in the negative filter or
+        the local tier, or None.
+        """
+        data = None
+        if self.negative is not None:
+            data = self.negative.get(key, model)
+        if data is None and self.local is not None:
+            data = self.local.get(key, model)
+        return data
+
+    def _set_local(self, key, data, model):
+        """Puts the serialized tree ``data`` in the negative filter, if it is
+        a miss and the filter is enabled, or else in the local tier. Values
+        that aren't strings, such as the trees pickled as they are by
+        earlier versions, are only kept in the shared cache.
+        """
+        if not isinstance(data, str):
+            return
+        if self.negative is not None and serializers.is_negative(data):
+            self.negative.set(key, data, model)
+        elif self.local is not None:
+            self.local.set(key, data, model)
+
+    ####################################################################
+
+    def get(self, key, plan, on_stale=None):
+        """Returns the tree (or Pointer) stored at ``key``, or None. If the
+        tree is stale, calls ``on_stale(key)`` before returning it.
+        """
+        identity_map = self.get_identity_map()
+        if identity_map is not None and key in identity_map:
+            return identity_map[key]
+        data = self._get_local(key, plan.model)
+        if data is None:
+            data = self._unwrap(key, cache.get(key), on_stale)
+            if data is None or isinstance(data, Pointer):
+                return data
+            self._set_local(key, data, plan.model)
+        obj = serializers.loads(data)
+        if identity_map is not None:
+            identity_map[key] = obj
+        return obj
+
+    def get_many(self, keys, plan, on_stale=None):
+        objects = dict()
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            for key in keys:
+                if key in identity_map:
+                    objects[key] = identity_map[key]
+            keys = [key for key in keys if key not in objects]
+        serialized = dict()
+        if self.local is not None or self.negative is not None:
+            for key in keys:
+                data = self._get_local(key, plan.model)
+                if data is not None:
+                    serialized[key] = data
+            keys = [key for key in keys if key not in serialized]
+        if keys:
+            for key, value in cache.get_many(keys).iteritems():
+                data = self._unwrap(key, value, on_stale)
+                if isinstance(data, Pointer):
+                    objects[key] = data
+                elif data is not None:
+                    serialized[key] = data
+                    self._set_local(key, data, plan.model)
+        for key, data in serialized.iteritems():
+            obj = objects[key] = serializers.loads(data)
+            if identity_map is not None:
+                identity_map[key] = obj
+        return objects
+
+    def set(self, key, obj, plan):
+        data = serializers.dumps(obj, plan.serializer, plan.compression)
+        value, timeout = self._wrap(obj, data, plan)
+        cache.set(key, value, timeout)
+        self._set_local(key, data, plan.model)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map[key] = obj
+
+    def set_many(self, objects, plan):
+        # Trees, cached errors, and trees that can be served stale may each
+        # have their own timeout, so they are set separately.
+        values_by_timeout = dict()
+        for key, obj in objects.iteritems():
+            data = serializers.dumps(obj, plan.serializer, plan.compression)
+            value, timeout = self._wrap(obj, data, plan)
+            values_by_timeout.setdefault(timeout, {})[key] = value
+            self._set_local(key, data, plan.model)
+        for timeout, values in values_by_timeout.iteritems():
+            cache.set_many(values, timeout)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map.update(objects)
+
+    def set_pointers(self, pointers, plan):
+        """Points each key in the ``pointers`` dictionary to the pk key of the
+        instance whose pk it maps to.
+        """
+        cache.set_many(dict((key, Pointer(pk)) for key, pk in pointers.iteritems()), plan.timeout)
+
+    @staticmethod
+    def get_version_key(key):
+        return get_side_key(key, "version")
+
+    def get_versioned(self, keys, plan):
+        """Returns a dictionary mapping each of the ``keys`` that holds a fresh
+        tree in the shared cache to a (tree, version) tuple, read with one
+        get_many. Trees are read from the shared cache, not the local tier,
+        and keys that hold Pointers or stale trees are left out.
+        """
+        version_keys = [self.get_version_key(key) for key in keys]
+        values = cache.get_many(list(keys) + version_keys)
+        trees = dict()
+        for key, version_key in zip(keys, version_keys):
+            value = values.get(key)
+            if value is None or isinstance(value, Pointer):
+                continue
+            if isinstance(value, StaleEntry):
+                if value.is_stale():
+                    continue
+                value = value.obj
+            trees[key] = (serializers.loads(value), values.get(version_key, 0))
+        return trees
+
+    def set_versioned(self, trees, plan):
+        """Puts each tree in the ``trees`` dictionary, which maps keys to the
+        (tree, version) tuples read by get_versioned, back at its key.
+        Trees whose version was changed by another writer since they were
+        read are deleted instead. Returns the keys of the deleted trees.
+        
+        A version is even while no tree is being written at its key. Each
+        write claims the next, odd, version before the tree is set, so a
+        tree is only written if its version hasn't changed since it was
+        read, and releases it with the next even version afterwards, which
+        fails if another writer or an invalidation (see bump_versions)
+        changed it meanwhile. Every change to a version other than a
+        claim is by an even amount, so that writers reading an odd version
+        know that another write is in progress.
+        """
+        conflicts = list()
+        for key, (obj, version) in trees.iteritems():
+            version_key = self.get_version_key(key)
+            if version % 2:
+                # Make the write in progress fail too.
+                incr_counter(version_key, plan.timeout, 2)
+                conflicts.append(key)
+                continue
+            if incr_counter(version_key, plan.timeout) != version + 1:
+                # Undo the claim's change to the parity, which makes the
+                # other writer's claim or release fail too.
+                incr_counter(version_key, plan.timeout)
+                conflicts.append(key)
+                continue
+            data = serializers.dumps(obj, plan.serializer, plan.compression)
+            value, timeout = self._wrap(obj, data, plan)
+            cache.set(key, value, timeout)
+            if incr_counter(version_key, plan.timeout) != version + 2:
+                conflicts.append(key)
+        if conflicts:
+            cache.delete_many(conflicts)
+        self._evict(trees.keys(), [plan.model])
+        return conflicts
+
+    def bump_versions(self, keys, plan):
+        """Changes the versions of the ``keys``, so that trees read from them
+        by get_versioned before they were deleted aren't written back.
+        """
+        for key in keys:
+            incr_counter(self.get_version_key(key), plan.timeout, 2)
+
+    def delete_many(self, keys, models=()):
+        """Deletes the ``keys``, which belong to trees of the ``models``, from
+        every tier.
+        """
+        cache.delete_many(keys)
+        self._evict(keys, models)
+        
+    def mark_stale(self, keys, plan):
+        """Marks the trees at the ``keys``, which belong to the ``plan``'s
+        model, as stale, so that they are served until they are refreshed
+        or their ``stale_ttl`` runs out. Cached DoesNotExist and
+        MultipleObjectsReturned errors are deleted instead, so that they are
+        never served stale.
+        """
+        values = dict()
+        for key, value in cache.get_many(keys).iteritems():
+            if isinstance(value, StaleEntry):
+                values[key] = StaleEntry(value.obj, 0)
+        if values:
+            cache.set_many(values, plan.stale_ttl)
+        cache.delete_many([key for key in keys if key not in values])
+        self._evict(keys, [plan.model])
+        
+    def invalidate_models(self, models):
+        """Makes every tree of the ``models`` unreachable, by incrementing
+        the generation in their keys.
+        """
+        key_generations.bump(models)
+        self._evict((), models)
+        
+    def _evict(self, keys, models):
+        """Removes the ``keys``, which belong to trees of the ``models``, from
+        the local tier, the negative filter, and the identity map.
+        """
+        for tier in (self.local, self.negative):
+            if tier is not None:
+                tier.delete_many(keys)
+                tier.bump_generations(models)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            for key in keys:
+                identity_map.pop(key, None)
+
+########################################################################
+
+tree_cache = TreeCache()
+
+########################################################################
+
+class IdentityMap(object):
+    """Memoizes the results of get_cached and get_many_cached by cache key
+    for a unit of work, so that repeated lookups return the same instance
+    without going to the cache. Invalidations within the unit of work remove
+    the affected entries.
+
+    Use it as a context manager::
+
+        with IdentityMap():
+            ...
+
+    or as a decorator::
+
+        @IdentityMap()
+        def view(request):
+            ...
+
+    Because the same instance is returned for every lookup, changes made to
+    it are visible to later lookups in the same unit of work.
+    """
+
+    def __enter__(self):
+        tree_cache.begin_identity_map()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        tree_cache.end_identity_map()
+
+    def __call__(self, function):
+        def wrapper(*args, **kwargs):
+            tree_cache.begin_identity_map()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tree_cache.end_identity_map()
+        return wraps(function)(wrapper)
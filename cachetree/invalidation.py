@@ -4,19 +4,32 @@ Cachetree Invalidation
 
 ########################################################################
 
+import logging
+import threading
+import time
+from collections import deque
 from copy import copy
+from itertools import izip
+from operator import itemgetter
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.db import connections, close_connection, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_init, pre_save, post_save, post_delete, m2m_changed
+from django.db.models.base import ModelBase
 from django.db.models.manager import Manager
 from django.db.models.fields.related import (
     SingleRelatedObjectDescriptor, ReverseSingleRelatedObjectDescriptor, 
     ForeignRelatedObjectsDescriptor, ManyRelatedObjectsDescriptor,
     ReverseManyRelatedObjectsDescriptor, ForeignKey)
 from django.utils.functional import wraps
-from cache import cache
-from utils import generate_base_key, get_cached_models, get_cache_settings
+from cache import tree_cache
+from utils import get_cached_models, get_cache_settings, get_model_key_prefixes
+from plans import get_cache_plan
 from exceptions import ImproperlyConfigured
+from writethrough import TreePatch, can_patch, get_ordering_attnames, REPLACE, INSERT, REMOVE
 import settings as cachetree_settings
+import stats
+
+logger = logging.getLogger("cachetree")
     
 ########################################################################
 
@@ -35,94 +48,72 @@ class Invalidator(object):
     # -However, an invalidation path that is an empty list means that the model instance 
     #  itself is to be invalidated.
     INVALIDATION_PATHS = {}
+    
+    # Maps each model in INVALIDATION_PATHS to the PathNode at the base of the
+    # trie of its invalidation paths, in which paths that start with the same
+    # steps share their nodes.
+    INVALIDATION_TRIES = {}
+    
+    # Maps each (model, invalidation path as a tuple) pair to a tuple of the
+    # prefetched attribute names leading from the root model to the model,
+    # and the model's own prefetch settings below them.
+    TREE_PATHS = {}
 
     ####################################################################
     
+    ERROR_MSG_UNCACHED_MODEL = ("Cannot invalidate %(model)s instance because the %(model)s "
+                                "model was not found in the CACHETREE setting.")
+    
     @classmethod
     def invalidate_instance(cls, sender, instance, **kwargs):
-        cls()._invalidate_instance(instance)
+        if kwargs.get("signal") is post_save:
+            changed_attnames = cls.get_changed_attnames(instance)
+            if changed_attnames is not None:
+                if not changed_attnames:
+                    # The save didn't change any field, so no cached tree changed.
+                    stats.incr(sender, "invalidations_skipped")
+                    return
+                if cls.get_snapshot_fields(sender)[3].issuperset(changed_attnames):
+                    # The save only changed fields whose changes are ignored.
+                    stats.incr(sender, "invalidations_ignored")
+                    return
+        if NoInvalidation.skip(instance):
+            return
+        changed_instances = BatchInvalidation.get_changed_instances()
+        if changed_instances is not None:
+            changed_instances.add(instance)
+        elif not async_invalidation.add(instance):
+            patch_action = None
+            if kwargs.get("signal") is post_save:
+                patch_action = kwargs.get("created") and INSERT or REPLACE
+            elif kwargs.get("signal") is post_delete:
+                patch_action = REMOVE
+            cls()._invalidate_instance(instance, patch_action)
         
     ####################################################################
     
-    def _invalidate_instance(self, instance):
+    def _invalidate_instance(self, instance, patch_action=None):
         """Uses the ``instance``'s ``model`` to look up its invalidation paths and
-        find all the root instances that need to be invalidated.
+        invalidate all the root instances whose trees include it. If the
+        ``patch_action`` made to the instance is given, it is patched into
+        the trees of root models with ``write_through`` instead, where
+        possible.
         """
         
         model = instance.__class__
         
         invalidation_paths = self.INVALIDATION_PATHS.get(model, None)
         
-        self.seen_instances = set()
-        
         if not invalidation_paths:
-            raise ImproperlyConfigured(
-                "Cannot invalidate %(model)s instance because the %(model)s model was not found in the CACHETREE setting." % dict(
-                model=model.__name__))
-        
-        root_instances = set()
-        for invalidation_path in invalidation_paths:
-            path = copy(invalidation_path)
-            root_instances.update(self._get_root_instances(path, instance))
-                
-        self.invalidate_root_instances(*root_instances)
+            raise ImproperlyConfigured(self.ERROR_MSG_UNCACHED_MODEL % dict(model=model.__name__))
         
-        for seen_instance in self.seen_instances:
-            # The current state becomes the orig state for any future invalidations.
-            delattr(seen_instance, "_orig_state")
-            seen_instance._orig_state = seen_instance.__dict__.copy()
-    
-    ####################################################################
-    
-    def _get_root_instances(self, invalidation_path, *instances):
-        """Recursively traverses the ``invalidation_path`` on each of the
-        ``instances`` in order to get the root instances.
-        """
-        self.seen_instances.update(instances)
-         
-        # An empty invalidation path means we've reached the root instances.
-        if not invalidation_path:
-            return instances
-        attr_name = invalidation_path.pop(0)[0]        
-        related_instances = set()
+        using = instance._state.db or DEFAULT_DB_ALIAS
+        batch = InvalidationBatch()
+        batch.add_changed_instances(model, [instance], using, patch_action)
+        deferred_invalidation.invalidate(batch, using)
         
-        for instance in instances:
-            instance_variants = [instance]
-            if hasattr(instance, "_orig_state"):
-                orig_state = instance.__dict__.pop("_orig_state")
-                # If the instance __dict__ has changed, invalidate the
-                # original as well.
-                if orig_state != instance.__dict__:
-                    orig = instance.__class__()
-                    orig.__dict__ = orig_state
-                    # If the instance was newly created (no orig.pk), its original
-                    # state doesn't need to be invalidated.
-                    if orig.pk:
-                        instance_variants.append(orig)
-                instance.__dict__["_orig_state"] = orig_state
-                
-            for instance in instance_variants:
-            
-                try:
-                    attr = getattr(instance, attr_name)
-                except ObjectDoesNotExist:
-                    continue
-                else:
-                    if attr is None:
-                        continue
-                
-                if isinstance(attr, Manager):
-                    for related_instance in attr.all():
-                        related_instances.add(related_instance)
-                else:
-                    related_instances.add(attr)
-               
-        if related_instances:
-            return self._get_root_instances(invalidation_path, *related_instances)
-        else:
-            # If we couldn't find any related instances, then we can't get to
-            # any root instances along the invalidation path.
-            return []
+        # The current state becomes the orig state for any future invalidations.
+        self.copy_instance(model, instance)
         
     ####################################################################
     
@@ -133,40 +124,184 @@ class Invalidator(object):
         that is, an instance of one of the top-level models stored in the
         cache, not a related model instance.
         """
-        self.seen_instances.update(instances)
+        # Instances of different databases may be in different transactions.
+        instances_by_db = dict()
+        for instance in instances:
+            instances_by_db.setdefault(instance._state.db or DEFAULT_DB_ALIAS, []).append(instance)
+        for using, db_instances in instances_by_db.iteritems():
+            batch = InvalidationBatch()
+            batch.add_root_instances(db_instances)
+            deferred_invalidation.invalidate(batch, using)
         
-        keys = set()
+    ####################################################################
+    
+    BULK_CHUNK_SIZE = 500
+    
+    @classmethod
+    def follow_path(cls, model, instances, invalidation_path, using=DEFAULT_DB_ALIAS):
+        """Follows the non-empty ``invalidation_path`` from the ``instances`` of
+        ``model``, as follow_trie does. Returns the root model at the end of
+        the path, and a set of the pks of its instances reached.
+        """
+        trie = PathNode(model)
+        trie.add_path(invalidation_path)
+        for node, pks in cls.follow_trie(trie, instances, using):
+            return node.model, pks
+        return invalidation_path[-1][1], set()
+    
+    @classmethod
+    def follow_trie(cls, trie, instances, using=DEFAULT_DB_ALIAS, values=None):
+        """Follows the invalidation paths in the ``trie`` (see PathNode) from the
+        ``instances`` of its model, or, if ``instances`` is None, from the
+        ``values``, a dictionary mapping the attnames of its tracked fields
+        to sets of their values, one level at a time, on the values of
+        the fields each step joins on, rather than on instances. Returns a
+        list of (node, pks) tuples of the nodes reached at the ends of the
+        non-empty paths, with a set of the pks of their root model's
+        instances reached.
         
-        for instance in instances:
-            model = instance.__class__
-            instance_variants = [instance]
-            if hasattr(instance, "_orig_state"):
-                orig = model()
-                orig.__dict__ = instance._orig_state
-                instance_variants.append(orig)
-                
-            for instance in instance_variants:
-                
-                cache_settings = get_cache_settings(instance.__class__)
-                lookups = cache_settings.get("lookups")
-                
-                for lookup in lookups:
-                    if not isinstance(lookup, (list, tuple)):
-                        lookup = [lookup]
-                        
-                    kwargs = {}
-                    for fieldname in lookup:
-                        if fieldname == "pk":
-                            field = model._meta.pk
-                        else:
-                            field = model._meta.get_field(fieldname)
-                        attname = field.get_attname()
-                        kwargs[fieldname] = getattr(instance, attname)
+        Each node takes at most one values_list query (per chunk of
+        ``BULK_CHUNK_SIZE`` values), which selects the fields all of its
+        children join on (and its pk, if a path ends at it), however many
+        paths share it, and none if it only needs the pks that a forward
+        ForeignKey to it already holds, so the number of queries depends on
+        the number of nodes in the trie, not on the number of instances or
+        paths.
+        """
+        reached = list()
+        level = [(trie, instances, values)]
+        while level:
+            next_level = list()
+            for node, node_instances, values in level:
+                pk_attname = node.model._meta.pk.attname
+                if node_instances is not None:
+                    values = dict((attname, set([getattr(instance, attname) 
+                                                 for instance in node_instances]))
+                                  for name, attname in node.fields)
+                if node.is_root and node is not trie:
+                    pks = values[pk_attname]
+                    pks.discard(None)
+                    if pks:
+                        reached.append((node, pks))
                         
-                    key = generate_base_key(instance.__class__, **kwargs)
-                    keys.add(key)
+                for child in node.children:
+                    if child.step is None:
+                        # Not a related model descriptor, so follow it on each instance.
+                        if node_instances is None:
+                            node_instances = _filter_in_chunks(
+                                node.model, "pk__in", values[pk_attname], using)
+                        related_instances = list()
+                        for instance in node_instances:
+                            try:
+                                attr = getattr(instance, child.attr_name)
+                            except ObjectDoesNotExist:
+                                continue
+                            if isinstance(attr, Manager):
+                                related_instances.extend(attr.all())
+                            elif attr is not None:
+                                related_instances.append(attr)
+                        if related_instances:
+                            next_level.append((child, related_instances, None))
+                        continue
+                    
+                    name, attname, lookup = child.step
+                    join_values = set(values[attname])
+                    join_values.discard(None)
+                    if not join_values:
+                        continue
+                    related_pk_attname = child.model._meta.pk.attname
+                    if lookup is None and child.fields == (("pk", related_pk_attname),):
+                        # A ForeignKey to the related model's pk already
+                        # holds the only values it needs.
+                        child_values = {related_pk_attname: join_values}
+                    else:
+                        child_values = _values_in_chunks(child.model, child.fields, lookup or "pk__in",
+                                                         join_values, using)
+                    next_level.append((child, None, child_values))
+            level = next_level
+        return reached
+    
+    ####################################################################
+    
+    PATH_STEPS = {}
+    
+    @classmethod
+    def _get_path_step(cls, model, attr_name):
+        """Returns a tuple of the name and attname of the ``model``'s field that
+        the ``attr_name`` relation joins on, and the lookup that filters the
+        related model by its values (None if they are the related model's
+        pks), or None if ``attr_name`` isn't a related model descriptor.
+        """
+        try:
+            return cls.PATH_STEPS[(model, attr_name)]
+        except KeyError:
+            pass
+        descriptor = getattr(model, attr_name, None)
+        pk = model._meta.pk
+        if isinstance(descriptor, ReverseSingleRelatedObjectDescriptor):
+            field = descriptor.field
+            related_field = field.rel.get_related_field()
+            if related_field.primary_key:
+                lookup = None
+            else:
+                lookup = "%s__in" % related_field.name
+            step = (field.name, field.attname, lookup)
+        elif isinstance(descriptor, (SingleRelatedObjectDescriptor, 
+                                     ForeignRelatedObjectsDescriptor)):
+            field = descriptor.related.field
+            related_field = field.rel.get_related_field()
+            step = (related_field.name, related_field.attname, "%s__in" % field.name)
+        elif isinstance(descriptor, ManyRelatedObjectsDescriptor):
+            step = ("pk", pk.attname, "%s__in" % descriptor.related.field.name)
+        elif isinstance(descriptor, ReverseManyRelatedObjectsDescriptor):
+            step = ("pk", pk.attname, "%s__in" % descriptor.field.related_query_name())
+        else:
+            step = None
+        cls.PATH_STEPS[(model, attr_name)] = step
+        return step
         
-        cache.delete_many(keys)
+    ####################################################################
+    
+    @classmethod
+    def get_tree_patch(cls, model, instance, invalidation_path, patch_action):
+        """Returns a TreePatch that makes the ``patch_action`` to the
+        ``instance`` of ``model`` in the cached trees of the root model at
+        the end of the non-empty ``invalidation_path``, or None if the root
+        model doesn't use ``write_through`` or the change can't be patched
+        in place: the path isn't made of related model descriptors, the
+        instance has deferred fields, or it was saved with changes to the
+        fields it is joined to its parent or its prefetched children on, or
+        ordered by in its list, which move it or its children in the tree.
+        """
+        root_model = invalidation_path[-1][1]
+        if not get_cache_plan(root_model).write_through:
+            return None
+        attr_names, child_attrs = cls.TREE_PATHS[(model, tuple(invalidation_path))]
+        if not can_patch(root_model, attr_names, patch_action):
+            return None
+        attnames, get_values = cls.get_snapshot_fields(model)[:2]
+        try:
+            values = get_values(instance.__dict__)
+        except KeyError:
+            return None
+        if patch_action == REPLACE:
+            orig_state = get_orig_state(instance)
+            if orig_state is None:
+                return None
+            # Changes to the fields the instance's list is ordered by move it.
+            join_attnames = get_ordering_attnames(root_model, attr_names)
+            if join_attnames is None:
+                return None
+            join_attnames.update(cls.get_tracked_attnames(model))
+            for attr_name in child_attrs or ():
+                step = cls._get_path_step(model, attr_name)
+                if step is None:
+                    return None
+                join_attnames.add(step[1])
+            if orig_state.get_changed_attnames(instance, join_attnames):
+                return None
+        return TreePatch(patch_action, model, attnames, values, 
+                         instance._state.db or DEFAULT_DB_ALIAS, attr_names, child_attrs)
         
     ####################################################################
 
@@ -304,12 +439,17 @@ class Invalidator(object):
         and registers signal handlers for each of them.
         """
         cls.INVALIDATION_PATHS = {}
+        cls.INVALIDATION_TRIES = {}
+        cls.TREE_PATHS = {}
         for app_label, model in get_cached_models():
             cls.validate_lookups(model)
             cache_settings = get_cache_settings(model)
             attrs = cache_settings.get("prefetch")
             cls._add_invalidation_path(model, [], attrs)
             
+        cls.SNAPSHOT_FIELDS = {}
+        for model in cls.INVALIDATION_PATHS:
+            cls.get_snapshot_fields(model)
         cls.connect_signals()
             
     #################################################################### 
@@ -322,13 +462,109 @@ class Invalidator(object):
             
     #################################################################### 
 
+    @classmethod
+    def copy_instance(cls, sender, instance, **kwargs):
+        """Stores a snapshot of the starting values of the instance's fields on
+        the instance, so the Invalidator can tell whether a save changed it,
+        and invalidate based on the original state (as well as the ending
+        state).
+        """
+        attnames, get_values = (cls.SNAPSHOT_FIELDS.get(sender) 
+                                or cls.get_snapshot_fields(sender))[:2]
+        state = instance.__dict__
+        try:
+            values = get_values(state)
+        except KeyError:
+            # Deferred fields aren't in the __dict__.
+            values = tuple([state.get(attname) for attname in attnames])
+        instance._orig_state = OriginalState(attnames, values)
+        
+    @staticmethod
+    def discard_unsaved_state(sender, instance, **kwargs):
+        """Drops the snapshot of an instance that is being saved, but wasn't
+        loaded from the database or saved before, such as an instance built
+        to overwrite a row, as its starting values may not be the row's.
+        """
+        if instance._state.adding:
+            instance.__dict__.pop("_orig_state", None)
+            
     @staticmethod
-    def copy_instance(sender, instance, **kwargs):
-        """Copies the starting state of the instance and stores it on the
-        instance, so the Invalidator can invalidate based on the original
-        state (as well as the ending state).
+    def get_changed_attnames(instance):
+        """Returns a list of the attnames of the fields of the saved
+        ``instance`` that have changed since their values were snapshotted,
+        or None if there is no snapshot.
+        """
+        orig_state = get_orig_state(instance)
+        if orig_state is None:
+            return None
+        return orig_state.get_changed_attnames(instance)
+        
+    ####################################################################
+    
+    # Maps each model in INVALIDATION_PATHS to the attnames of its concrete
+    # fields, whose original values are snapshotted, a function that gets
+    # their values from an instance's __dict__ as a tuple, the set of
+    # attnames that invalidation follows or generates keys from, and the
+    # set of attnames whose changes are ignored.
+    SNAPSHOT_FIELDS = {}
+    
+    @classmethod
+    def get_snapshot_fields(cls, model):
+        """Returns a tuple of the attnames of the concrete fields of ``model``,
+        a function that gets their values from an instance's __dict__, a
+        frozenset of the tracked attnames, those whose changes require the
+        original version of an instance to be invalidated as well (its pk,
+        the fields its keys are generated from if it is a root model, and
+        the fields its invalidation paths start from), and a frozenset of
+        the attnames in the model's ``ignore_fields`` setting, if it is a
+        root model, that aren't tracked.
+        """
+        try:
+            return cls.SNAPSHOT_FIELDS[model]
+        except KeyError:
+            pass
+        attnames = tuple([field.attname for field in model._meta.fields])
+        tracked_attnames = set([model._meta.pk.attname])
+        ignored_attnames = frozenset()
+        for invalidation_path in cls.INVALIDATION_PATHS.get(model, ()):
+            if not invalidation_path:
+                plan = get_cache_plan(model)
+                tracked_attnames.update([field.attname for field in plan.key_fields])
+                ignored_attnames = plan.ignore_fields
+                continue
+            step = cls._get_path_step(model, invalidation_path[0][0])
+            if step is None:
+                # Followed on the instances themselves, which may use any field.
+                tracked_attnames.update(attnames)
+            else:
+                tracked_attnames.add(step[1])
+        if len(attnames) == 1:
+            get_value = itemgetter(attnames[0])
+            get_values = lambda state: (get_value(state),)
+        else:
+            get_values = itemgetter(*attnames)
+        snapshot_fields = cls.SNAPSHOT_FIELDS[model] = (
+            attnames, get_values, frozenset(tracked_attnames),
+            ignored_attnames.difference(tracked_attnames))
+        return snapshot_fields
+    
+    @classmethod
+    def get_tracked_attnames(cls, model):
+        return cls.get_snapshot_fields(model)[2]
+    
+    @classmethod
+    def get_root_models(cls, model):
+        """Returns a set of the root models whose trees may hold instances of
+        ``model``, which is invalidated.
         """
-        instance._orig_state = instance.__dict__.copy()
+        root_models = set()
+        for path in cls.INVALIDATION_PATHS.get(model, ()):
+            # The last step of each path is the root model.
+            if path:
+                root_models.add(path[-1][1])
+            else:
+                root_models.add(model)
+        return root_models
     
     ####################################################################
     
@@ -355,6 +591,7 @@ class Invalidator(object):
                 # handlers are later reconnected, post_init will need to have
                 # been called.
                 getattr(post_init, action)(cls.copy_instance, sender=model, dispatch_uid=dispatch_uid)
+            getattr(pre_save, action)(cls.discard_unsaved_state, sender=model, dispatch_uid=dispatch_uid)
             getattr(post_save, action)(cls.invalidate_instance, sender=model, dispatch_uid=dispatch_uid)
             getattr(post_delete, action)(cls.invalidate_instance, sender=model, dispatch_uid=dispatch_uid)
             
@@ -367,17 +604,22 @@ class Invalidator(object):
                                       "cache %(model)s.%(through_attr)s.")
     
     @classmethod
-    def _add_invalidation_path(cls, model, path, attrs):
+    def _add_invalidation_path(cls, model, path, attrs, attr_names=()):
         """Adds the invalidation ``path`` to INVALIDATION_PATHS for the specified
         ``model``, then recursively follows the ``attrs``, if any, on the
         ``model`` in order to add the invalidation paths for the ``model``'s
-        related models.
+        related models. The ``attr_names`` are the prefetched attribute
+        names leading to the ``model`` from the root model.
         """
         
         if model not in cls.INVALIDATION_PATHS:
             cls.INVALIDATION_PATHS[model] = []
             
         cls.INVALIDATION_PATHS[model].append(path)
+        if model not in cls.INVALIDATION_TRIES:
+            cls.INVALIDATION_TRIES[model] = PathNode(model)
+        cls.INVALIDATION_TRIES[model].add_path(path)
+        cls.TREE_PATHS[(model, tuple(path))] = (attr_names, attrs)
         
         if not attrs:
             return 
@@ -433,10 +675,897 @@ class Invalidator(object):
                 validate_m2m_paths()
             
             attr_path.insert(0, (related_name, model))
-            cls._add_invalidation_path(related_model, attr_path, child_attrs)
+            cls._add_invalidation_path(related_model, attr_path, child_attrs, 
+                                       attr_names + (attr_name,))
                     
 ########################################################################
 
+class PathNode(object):
+    """A node of the trie of a model's invalidation paths, compiled by
+    Invalidator._add_invalidation_path and kept in INVALIDATION_TRIES. The
+    node at the base of the trie stands for the changed model, and each
+    other node for the related model reached by one more step from its
+    parent, so that paths starting with the same steps share their nodes
+    and are followed together (see Invalidator.follow_trie):
+    
+    ``model``
+        The model the node stands for.
+    ``attr_name``
+        The attribute name followed from the parent node's model, or None
+        at the base.
+    ``step``
+        The parent's join on ``attr_name`` (see Invalidator._get_path_step),
+        or None if it isn't a related model descriptor.
+    ``path``
+        The invalidation path from the base to the node, as a tuple.
+    ``is_root``
+        True if a path ends at the node, so that its model is a root model
+        whose instances reached are invalidated.
+    ``children``
+        The nodes one step further, in the order their paths were added.
+    ``fields``
+        A tuple of the (name, attname) pairs of the fields to load for the
+        node's instances: those the children join on, and the pk if a path
+        ends at the node or a child isn't a related model descriptor.
+    """
+    
+    __slots__ = ("model", "attr_name", "step", "path", "is_root", "children", "fields")
+    
+    def __init__(self, model, attr_name=None, step=None, path=()):
+        self.model = model
+        self.attr_name = attr_name
+        self.step = step
+        self.path = path
+        self.is_root = False
+        self.children = []
+        self.fields = ()
+        
+    def __repr__(self):
+        return "<PathNode %s%s%s: %s>" % (
+            self.model.__name__, 
+            self.attr_name and " via %s" % self.attr_name or "",
+            self.is_root and " (root)" or "", 
+            self.children)
+        
+    ####################################################################
+    
+    def add_path(self, path):
+        """Adds the nodes of the invalidation ``path``, starting from this
+        node's model, that aren't in the trie yet.
+        """
+        node = self
+        for index, (attr_name, related_model) in enumerate(path):
+            for child in node.children:
+                if child.attr_name == attr_name:
+                    break
+            else:
+                child = PathNode(related_model, attr_name, 
+                                 Invalidator._get_path_step(node.model, attr_name), 
+                                 tuple(path[:index + 1]))
+                node.children.append(child)
+                node._add_field(child.step and child.step[:2])
+            node = child
+        node.is_root = True
+        node._add_field(None)
+        
+    def _add_field(self, field):
+        """Adds the (name, attname) pair ``field``, or the pk if it is None, to
+        the fields to load.
+        """
+        pk_attname = self.model._meta.pk.attname
+        if field is None or field[1] == pk_attname:
+            field = ("pk", pk_attname)
+        if field not in self.fields:
+            self.fields += (field,)
+            
+    def get_paths(self):
+        """Returns a list of the invalidation paths in the trie below this
+        node, that end at a node with ``is_root``.
+        """
+        paths = list()
+        if self.is_root:
+            paths.append([])
+        for child in self.children:
+            for path in child.get_paths():
+                paths.append([(child.attr_name, child.model)] + path)
+        return paths
+        
+########################################################################
+
+class InvalidationBatch(object):
+    """Collects the keys of root instances to be invalidated, generated from
+    the instances' field values at the time they are added, so that they
+    can all be invalidated at once, with one delete_many.
+    """
+    
+    def __init__(self):
+        self.keys = set()
+        self.models = set()
+        # Maps each model with a stale_ttl to its plan and stale keys.
+        self.stale_keys = dict()
+        # Maps each model with write_through to its plan and a dictionary of
+        # the TreePatches to make to the trees at each of its keys.
+        self.patches = dict()
+        # Maps each model with write_through to its plan and the keys whose
+        # versions are incremented when they are invalidated.
+        self.versioned_keys = dict()
+        
+    ####################################################################
+    
+    def add_root_instances(self, instances):
+        """Adds the keys of all possible versions of the root ``instances``:
+        their current state and, for instances whose lookup values have
+        changed, the keys of the changed lookups in their original state.
+        """
+        # Group the instances by model, so that each model's keys are
+        # generated in one batch.
+        instances_by_model = dict()
+        originals_by_model = dict()
+        for instance in instances:
+            model = instance.__class__
+            instances_by_model.setdefault(model, []).append(instance)
+            orig_state = get_orig_state(instance)
+            if orig_state is not None:
+                changed_attnames = orig_state.get_changed_attnames(
+                    instance, Invalidator.get_tracked_attnames(model))
+                if changed_attnames:
+                    originals_by_model.setdefault(model, []).append(
+                        (orig_state.make_original(instance), changed_attnames))
+        
+        for model, model_instances in instances_by_model.iteritems():
+            plan = get_cache_plan(model)
+            keys = plan.make_instance_keys(model_instances)
+            for orig, changed_attnames in originals_by_model.get(model, ()):
+                keys.extend(plan.make_instance_keys([orig], changed_attnames))
+            self._add_keys(plan, keys)
+            
+    def add_root_pks(self, model, pks, using=DEFAULT_DB_ALIAS):
+        """Adds the keys of the root instances of ``model`` with the ``pks``.
+        """
+        plan = get_cache_plan(model)
+        self._add_keys(plan, self.get_root_keys(plan, pks, using))
+        
+    def add_root_patch(self, model, pks, patch, using=DEFAULT_DB_ALIAS):
+        """Adds the TreePatch ``patch``, to be made to the trees of the root
+        instances of ``model`` with the ``pks``.
+        """
+        plan = get_cache_plan(model)
+        patches = self.patches.setdefault(model, (plan, dict()))[1]
+        for key in self.get_root_keys(plan, pks, using):
+            patches.setdefault(key, []).append(patch)
+        
+    @staticmethod
+    def get_root_keys(plan, pks, using=DEFAULT_DB_ALIAS):
+        """Returns the keys of the root instances of the ``plan``'s model with
+        the ``pks``, loading only the fields their keys are generated from,
+        if any but the pk.
+        """
+        model = plan.model
+        fields = plan.key_fields
+        if fields == (model._meta.pk,):
+            rows = [KeyValues({fields[0].attname: pk}) for pk in pks]
+        else:
+            attnames = [field.attname for field in fields]
+            rows = list()
+            pks = list(pks)
+            chunk_size = Invalidator.BULK_CHUNK_SIZE
+            for start in xrange(0, len(pks), chunk_size):
+                for values in model._base_manager.using(using).filter(
+                        pk__in=pks[start:start + chunk_size]).values_list(
+                        *[field.name for field in fields]):
+                    rows.append(KeyValues(dict(zip(attnames, values))))
+        return plan.make_instance_keys(rows)
+        
+    def add_changed_instances(self, model, instances, using=DEFAULT_DB_ALIAS, patch_action=None):
+        """Adds the keys of the root instances whose trees include any of the
+        changed ``instances`` of ``model``, found by following each of the
+        model's invalidation paths on primary keys. The original versions of
+        instances whose tracked fields (see
+        Invalidator.get_snapshot_fields) have changed are followed as well,
+        but not of instances whose other fields have changed, which are
+        counted as pruned. Changed root instances are added as they are,
+        with their original state.
+        
+        If the ``patch_action`` made to a single changed instance is given,
+        it is added as a TreePatch of the trees of root models with
+        ``write_through``, where possible (see Invalidator.get_tree_patch),
+        instead of their keys.
+        """
+        tracked_attnames = Invalidator.get_tracked_attnames(model)
+        instance_variants = list(instances)
+        pruned = 0
+        for instance in instances:
+            orig_state = get_orig_state(instance)
+            if orig_state is None:
+                continue
+            if orig_state.get_changed_attnames(instance, tracked_attnames):
+                orig = orig_state.make_original(instance)
+                # If the instance was newly created (no orig.pk), its
+                # original state doesn't need to be invalidated.
+                if orig.pk:
+                    instance_variants.append(orig)
+            elif orig_state.has_changed(instance):
+                pruned += 1
+        if pruned:
+            stats.incr(model, "invalidations_pruned", pruned)
+            
+        trie = Invalidator.INVALIDATION_TRIES.get(model)
+        if trie is None:
+            return
+        if trie.is_root:
+            self.add_root_instances(instances)
+        pks_by_model = dict()
+        for node, pks in Invalidator.follow_trie(trie, instance_variants, using):
+            if patch_action is not None:
+                patch = Invalidator.get_tree_patch(model, instances[0], node.path, patch_action)
+                if patch is not None:
+                    self.add_root_patch(node.model, pks, patch, using)
+                    continue
+            pks_by_model.setdefault(node.model, set()).update(pks)
+        for root_model, pks in pks_by_model.iteritems():
+            if pks:
+                self.add_root_pks(root_model, pks, using)
+                
+    def add_changed_rows(self, model, attnames, rows, using=DEFAULT_DB_ALIAS):
+        """Adds the keys of the root instances whose trees include any of the
+        changed instances of ``model`` whose values of the ``attnames``,
+        which must include its tracked attnames (see
+        Invalidator.get_snapshot_fields), are the ``rows``, as
+        add_changed_instances does, without loading the instances.
+        """
+        trie = Invalidator.INVALIDATION_TRIES.get(model)
+        if trie is None or not rows:
+            return
+        if trie.is_root:
+            plan = get_cache_plan(model)
+            self._add_keys(plan, plan.make_instance_keys(
+                [KeyValues(dict(izip(attnames, row))) for row in rows]))
+        values = dict((attname, set(column)) for attname, column in izip(attnames, izip(*rows)))
+        pks_by_model = dict()
+        for node, pks in Invalidator.follow_trie(trie, None, using, values):
+            pks_by_model.setdefault(node.model, set()).update(pks)
+        for root_model, pks in pks_by_model.iteritems():
+            self.add_root_pks(root_model, pks, using)
+                
+    def _add_keys(self, plan, keys):
+        if plan.stale_ttl is None:
+            self.keys.update(keys)
+            self.models.add(plan.model)
+        else:
+            self.stale_keys.setdefault(plan.model, (plan, set()))[1].update(keys)
+        if plan.write_through:
+            self.versioned_keys.setdefault(plan.model, (plan, set()))[1].update(keys)
+                
+    ####################################################################
+    
+    def update(self, batch):
+        """Adds the keys and patches of the other ``batch``.
+        """
+        self.keys.update(batch.keys)
+        self.models.update(batch.models)
+        for model, (plan, stale_keys) in batch.stale_keys.iteritems():
+            self.stale_keys.setdefault(model, (plan, set()))[1].update(stale_keys)
+        for model, (plan, versioned_keys) in batch.versioned_keys.iteritems():
+            self.versioned_keys.setdefault(model, (plan, set()))[1].update(versioned_keys)
+        for model, (plan, patches) in batch.patches.iteritems():
+            model_patches = self.patches.setdefault(model, (plan, dict()))[1]
+            for key, key_patches in patches.iteritems():
+                model_patches.setdefault(key, []).extend(key_patches)
+            
+    def __nonzero__(self):
+        return bool(self.keys or self.stale_keys or self.patches)
+        
+    ####################################################################
+    
+    def invalidate(self):
+        """Makes the patches, then invalidates the keys added so far, and
+        those of the trees that couldn't be patched. The patches are only
+        made once: if the batch is invalidated again, the patched keys are
+        invalidated instead.
+        """
+        for plan, keys in self.versioned_keys.itervalues():
+            # Trees being patched concurrently are deleted, not written back.
+            tree_cache.bump_versions(keys, plan)
+        patched_keys = ()
+        if self.patches:
+            patched_keys = self._make_patches()
+        if self.keys:
+            tree_cache.delete_many(list(self.keys), self.models)
+        for plan, stale_keys in self.stale_keys.itervalues():
+            tree_cache.mark_stale(list(stale_keys), plan)
+        for plan, keys in patched_keys:
+            self._add_keys(plan, keys)
+            
+    def _make_patches(self):
+        """Reads the trees at the patched keys with one get_many per model,
+        makes their patches, and writes them back, unless their versions
+        changed since they were read. The keys of the trees that couldn't
+        be patched are added to the keys to invalidate. Returns a list of
+        (plan, keys) tuples of the patched keys.
+        """
+        patches, self.patches = self.patches, dict()
+        stale_keys = set()
+        for plan, stale_model_keys in self.stale_keys.itervalues():
+            stale_keys.update(stale_model_keys)
+        patched_keys = list()
+        for model, (plan, model_patches) in patches.iteritems():
+            # Keys that are invalidated anyway aren't patched.
+            keys = [key for key in model_patches 
+                    if key not in self.keys and key not in stale_keys]
+            trees = tree_cache.get_versioned(keys, plan)
+            failed_keys = list()
+            for key, (tree, version) in trees.items():
+                if not isinstance(tree, model):
+                    # Cached DoesNotExist and MultipleObjectsReturned errors.
+                    del trees[key]
+                    continue
+                for patch in model_patches[key]:
+                    if not patch.apply(tree):
+                        failed_keys.append(key)
+                        del trees[key]
+                        break
+            if failed_keys:
+                stats.incr(model, "patch_failures", len(failed_keys))
+                tree_cache.bump_versions(failed_keys, plan)
+                self._add_keys(plan, failed_keys)
+            if trees:
+                conflicts = tree_cache.set_versioned(trees, plan)
+                stats.incr(model, "patches", len(trees) - len(conflicts))
+                if conflicts:
+                    stats.incr(model, "patch_conflicts", len(conflicts))
+            patched_keys.append((plan, keys))
+        return patched_keys
+        
+########################################################################
+
+class DeferredInvalidation(object):
+    """Defers invalidations made within a transaction until it is
+    committed, if CACHETREE_DEFER_INVALIDATION is set, so that each
+    transaction invalidates its keys once, and never before its changes can
+    be read. Holds an InvalidationBatch per database for the current
+    thread's transactions, which is invalidated when the database's
+    connection commits, and dropped when it rolls back.
+    """
+    
+    def __init__(self):
+        self._local = threading.local()
+        
+    def _get_batches(self):
+        batches = getattr(self._local, "batches", None)
+        if batches is None:
+            batches = self._local.batches = dict()
+        return batches
+    
+    ####################################################################
+    
+    def invalidate(self, batch, using=DEFAULT_DB_ALIAS):
+        """Invalidates the ``batch`` of keys, or, if invalidation is deferred
+        and the ``using`` database is in a managed transaction, adds it to
+        the transaction's batch.
+        """
+        if cachetree_settings.DEFER_INVALIDATION is None or not connections[using].is_managed():
+            batch.invalidate()
+        else:
+            self._get_batches().setdefault(using, InvalidationBatch()).update(batch)
+    
+    def flush(self, using=DEFAULT_DB_ALIAS):
+        """Invalidates the batch of the transaction on the ``using`` database,
+        which has been committed. If the "repeat_after" setting is a number
+        of seconds, the batch is invalidated again after that long, in case
+        another process filled the cache with data read before the commit.
+        """
+        batch = self._get_batches().pop(using, None)
+        if not batch:
+            return
+        batch.invalidate()
+        repeat_after = (cachetree_settings.DEFER_INVALIDATION or {}).get("repeat_after")
+        if repeat_after is not None:
+            timer = threading.Timer(repeat_after, batch.invalidate)
+            timer.setDaemon(True)
+            timer.start()
+    
+    def discard(self, using=DEFAULT_DB_ALIAS):
+        """Drops the batch of the transaction on the ``using`` database, which
+        has been rolled back.
+        """
+        self._get_batches().pop(using, None)
+    
+deferred_invalidation = DeferredInvalidation()
+        
+########################################################################
+
+class ChangedInstances(object):
+    """Collects the instances changed within a batch_invalidation, at most
+    once per model and pk, so that their trees can be invalidated together.
+    """
+    
+    def __init__(self):
+        # Maps each (model, pk) to a snapshot of the instance as it was last
+        # changed, with its original state from before its first change.
+        self.instances = dict()
+        # The changed instances themselves, by id, whose original state is
+        # reset once they have been invalidated.
+        self.changed = dict()
+        
+    ####################################################################
+    
+    def add(self, instance):
+        """Adds a snapshot of the ``instance``, which has been saved or deleted.
+        """
+        self.add_snapshot(self.snapshot(instance))
+        self.changed[id(instance)] = instance
+        
+    @staticmethod
+    def snapshot(instance):
+        """Returns a copy of the saved or deleted ``instance``, with its
+        original state, as its fields may change before it is invalidated
+        (the pk of a deleted instance is set to None, for example).
+        """
+        model = instance.__class__
+        if model not in Invalidator.INVALIDATION_PATHS:
+            raise ImproperlyConfigured(
+                Invalidator.ERROR_MSG_UNCACHED_MODEL % dict(model=model.__name__))
+        snapshot = copy(instance)
+        snapshot.__dict__ = instance.__dict__.copy()
+        return snapshot
+        
+    def add_snapshot(self, snapshot):
+        """Adds the ``snapshot`` of a changed instance returned by snapshot().
+        """
+        key = (snapshot.__class__, snapshot.pk)
+        previous = self.instances.get(key)
+        if previous is not None:
+            # Keep the original state from the first change.
+            snapshot.__dict__.pop("_orig_state", None)
+            if "_orig_state" in previous.__dict__:
+                snapshot.__dict__["_orig_state"] = previous.__dict__["_orig_state"]
+        self.instances[key] = snapshot
+        
+    ####################################################################
+    
+    def invalidate(self):
+        """Follows the invalidation paths from the changed instances, and their
+        original versions, with set-based queries, and invalidates the root
+        instances reached with one batch per database.
+        """
+        instances_by_db = dict()
+        for (model, pk), snapshot in self.instances.iteritems():
+            using = snapshot._state.db or DEFAULT_DB_ALIAS
+            instances_by_db.setdefault(using, dict()).setdefault(model, []).append(snapshot)
+        
+        for using, instances_by_model in instances_by_db.iteritems():
+            batch = InvalidationBatch()
+            for model, instances in instances_by_model.iteritems():
+                batch.add_changed_instances(model, instances, using)
+            deferred_invalidation.invalidate(batch, using)
+        
+        for instance in self.changed.itervalues():
+            # The current state becomes the orig state for any future invalidations.
+            Invalidator.copy_instance(instance.__class__, instance)
+
+########################################################################
+
+class BatchInvalidation(object):
+    """Collects the instances saved and deleted in the current thread for
+    the duration of a block or function, and invalidates their trees when
+    it ends, instead of once per save. Each changed instance is followed
+    along its invalidation paths once, with set-based queries, and the
+    root instances' keys are deleted with one delete_many (per database).
+    Nested batches are invalidated with the outermost one.
+    """
+    
+    _local = threading.local()
+    
+    @classmethod
+    def get_changed_instances(cls):
+        """Returns the ChangedInstances of the current thread's batch, or None
+        outside of a batch.
+        """
+        return getattr(cls._local, "changed_instances", None)
+    
+    ####################################################################
+    
+    def __enter__(self):
+        self.begin()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end()
+        
+    def __call__(self, function):
+        def wrapper(*args, **kwargs):
+            self.begin()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.end()
+        return wraps(function)(wrapper)
+    
+    ####################################################################
+    
+    def begin(self):
+        local = self._local
+        if getattr(local, "depth", 0) == 0:
+            local.changed_instances = ChangedInstances()
+            local.depth = 0
+        local.depth += 1
+        
+    def end(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0:
+            changed_instances = local.changed_instances
+            local.changed_instances = None
+            changed_instances.invalidate()
+
+def batch_invalidation():
+    """Returns a context manager, that can also be used as a decorator,
+    which invalidates the trees of the instances saved and deleted within it
+    in one batch when it ends. See BatchInvalidation.
+    """
+    return BatchInvalidation()
+        
+########################################################################
+
+class InvalidationQueue(object):
+    """The queue of snapshots of changed instances of one AsyncInvalidation
+    thread, bounded by number of snapshots, ``size``, and by the age of its
+    oldest snapshot, ``max_staleness``.
+    """
+    
+    def __init__(self, size=1000, max_staleness=5):
+        self.size = size
+        self.max_staleness = max_staleness
+        # Each item is a (queued, snapshot) tuple.
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._stopped = False
+        
+    def __len__(self):
+        return len(self._items)
+        
+    ####################################################################
+    
+    def put(self, snapshot):
+        """Queues the ``snapshot``. Returns False if the queue is full, or its
+        oldest snapshot was queued more than ``max_staleness`` seconds ago,
+        in which case the snapshot isn't queued.
+        """
+        now = time.time()
+        self._condition.acquire()
+        try:
+            items = self._items
+            if len(items) >= self.size or (items and now - items[0][0] > self.max_staleness):
+                return False
+            items.append((now, snapshot))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        return True
+    
+    def get(self, batch_size, block=True):
+        """Returns a list of up to ``batch_size`` of the oldest snapshots,
+        waiting for one to be queued if ``block`` is True. Returns None once
+        the queue is stopped and empty, or if it is empty and ``block`` is
+        False.
+        """
+        self._condition.acquire()
+        try:
+            items = self._items
+            while block and not items and not self._stopped:
+                self._condition.wait()
+            if not items:
+                return None
+            return [items.popleft()[1] for i in xrange(min(batch_size, len(items)))]
+        finally:
+            self._condition.release()
+            
+    def stop(self):
+        """Makes get() return None once the queue is empty.
+        """
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+########################################################################
+
+class AsyncInvalidation(object):
+    """Invalidates the trees of saved and deleted instances on a pool of
+    daemon threads, if CACHETREE_ASYNC_INVALIDATION is set, so that the
+    traversal of their invalidation paths isn't part of the save. The signal
+    handlers only queue a snapshot of each changed instance, with its
+    original state, on the queue of the thread that handles its model and
+    pk, so that the invalidations of an instance are made in the order it
+    was changed. The invalidations of different instances, even in the same
+    tree, may be made in any order. Each thread invalidates up to
+    ``batch_size`` of the snapshots queued since its last batch at a time,
+    as one ChangedInstances.
+    
+    A snapshot that can't be queued, because its thread's queue is full or
+    behind (see InvalidationQueue), is invalidated in the saving thread
+    instead. Snapshots of instances changed in a managed transaction are
+    queued when it is committed, and dropped if it is rolled back. With
+    ``threads`` set to 0, snapshots are queued on a single queue that is
+    only consumed by calls to drain().
+    """
+    
+    DEFAULTS = {
+        "threads": 1,
+        "queue_size": 1000,
+        "max_staleness": 5,
+        "batch_size": 100,
+    }
+    
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.settings = None
+        self._queues = None
+        
+    def configure(self, async_settings=None):
+        """Stops the current threads, once the snapshots already queued have
+        been invalidated, and enables asynchronous invalidation with the
+        ``async_settings``, a dictionary overriding any of the DEFAULTS, or
+        disables it if they are None.
+        """
+        self.stop()
+        if async_settings is None:
+            self.settings = None
+        else:
+            self.settings = dict(self.DEFAULTS)
+            self.settings.update(async_settings)
+            
+    def _get_pending(self):
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            pending = self._local.pending = dict()
+        return pending
+    
+    ####################################################################
+    
+    def add(self, instance):
+        """Queues a snapshot of the saved or deleted ``instance``, resets
+        its original state, and removes the trees of the root models that
+        may hold it from the current thread's identity map. Returns False if
+        asynchronous invalidation is disabled, in which case the caller
+        invalidates the instance.
+        """
+        if self.settings is None:
+            return False
+        snapshot = ChangedInstances.snapshot(instance)
+        # The current state becomes the orig state for any future invalidations.
+        Invalidator.copy_instance(instance.__class__, instance)
+        # The keys aren't known until the paths are followed, so the current
+        # thread stops memoizing any tree that may hold the instance.
+        key_prefixes = list()
+        for root_model in Invalidator.get_root_models(instance.__class__):
+            key_prefixes.extend(get_model_key_prefixes(root_model))
+        tree_cache.evict_key_prefixes(key_prefixes)
+        using = instance._state.db or DEFAULT_DB_ALIAS
+        if connections[using].is_managed():
+            self._get_pending().setdefault(using, []).append(snapshot)
+        else:
+            self._queue([snapshot])
+        return True
+    
+    def flush(self, using=DEFAULT_DB_ALIAS):
+        """Queues the snapshots of the transaction on the ``using`` database,
+        which has been committed.
+        """
+        snapshots = self._get_pending().pop(using, None)
+        if snapshots:
+            self._queue(snapshots)
+            
+    def discard(self, using=DEFAULT_DB_ALIAS):
+        """Drops the snapshots of the transaction on the ``using`` database,
+        which has been rolled back.
+        """
+        self._get_pending().pop(using, None)
+        
+    def _queue(self, snapshots):
+        if self.settings is None:
+            # Disabled since the snapshots were taken.
+            self._invalidate(snapshots)
+            return
+        queues = self._get_queues()
+        changed_instances = None
+        for snapshot in snapshots:
+            model = snapshot.__class__
+            queue = queues[hash((model, snapshot.pk)) % len(queues)]
+            if queue.put(snapshot):
+                stats.incr(model, "invalidations_queued")
+                continue
+            stats.incr(model, "invalidations_unqueued")
+            if changed_instances is None:
+                changed_instances = ChangedInstances()
+            changed_instances.add_snapshot(snapshot)
+        if changed_instances is not None:
+            changed_instances.invalidate()
+            
+    ####################################################################
+    
+    def drain(self):
+        """Invalidates the snapshots queued so far in the calling thread.
+        """
+        self._drain(self._queues or ())
+                
+    def stop(self):
+        """Stops the threads once the snapshots already queued have been
+        invalidated, or, with ``threads`` 0, invalidates them.
+        """
+        self._lock.acquire()
+        try:
+            queues, self._queues = self._queues, None
+        finally:
+            self._lock.release()
+        if not queues:
+            return
+        for queue in queues:
+            queue.stop()
+        if not self.settings["threads"]:
+            self._drain(queues)
+            
+    def _drain(self, queues):
+        for queue in queues:
+            while True:
+                snapshots = queue.get(self.settings["batch_size"], block=False)
+                if snapshots is None:
+                    break
+                self._invalidate(snapshots)
+            
+    ####################################################################
+    
+    def _get_queues(self):
+        self._lock.acquire()
+        try:
+            if self._queues is None:
+                settings = self.settings
+                threads = settings["threads"]
+                self._queues = [InvalidationQueue(settings["queue_size"], settings["max_staleness"])
+                                for i in xrange(threads or 1)]
+                for i in xrange(threads):
+                    thread = threading.Thread(target=self._work, args=(self._queues[i],),
+                                              name="cachetree-invalidation-%s" % i)
+                    thread.setDaemon(True)
+                    thread.start()
+            return self._queues
+        finally:
+            self._lock.release()
+            
+    def _work(self, queue):
+        batch_size = self.settings["batch_size"]
+        while True:
+            snapshots = queue.get(batch_size)
+            if snapshots is None:
+                return
+            try:
+                self._invalidate(snapshots)
+            except Exception:
+                # The trees stay in the cache until they expire, or are
+                # invalidated again.
+                logger.exception("Error invalidating cachetree trees")
+            finally:
+                # Don't leave this thread's connection idle in a transaction.
+                close_connection()
+                
+    @staticmethod
+    def _invalidate(snapshots):
+        changed_instances = ChangedInstances()
+        for snapshot in snapshots:
+            changed_instances.add_snapshot(snapshot)
+        changed_instances.invalidate()
+    
+async_invalidation = AsyncInvalidation()
+        
+########################################################################
+
+class KeyValues(object):
+    """Holds the field values, by attname, that the keys of a root instance
+    are generated from, in place of the instance.
+    """
+    
+    def __init__(self, values):
+        self.__dict__ = values
+        
+########################################################################
+
+class OriginalState(object):
+    """A snapshot of the values of an instance's concrete fields, by
+    ``attnames``, when it was loaded, or last invalidated. Takes a tuple,
+    rather than a copy of each instance's __dict__, so that loading
+    instances that are never saved costs little.
+    """
+    
+    __slots__ = ("attnames", "values")
+    
+    def __init__(self, attnames, values):
+        self.attnames = attnames
+        self.values = values
+        
+    def __getstate__(self):
+        return self.attnames, self.values
+    
+    def __setstate__(self, state):
+        self.attnames, self.values = state
+        
+    def has_changed(self, instance):
+        """Returns True if any of the fields of the ``instance`` have changed.
+        """
+        state = instance.__dict__
+        for attname, value in izip(self.attnames, self.values):
+            if state.get(attname, value) != value:
+                return True
+        return False
+    
+    def get_changed_attnames(self, instance, attnames=None):
+        """Returns a list of the attnames of the ``instance``'s fields, or of
+        those of the ``attnames``, whose values have changed.
+        """
+        state = instance.__dict__
+        return [attname for attname, value in izip(self.attnames, self.values)
+                if (attnames is None or attname in attnames)
+                and state.get(attname, value) != value]
+    
+    def make_original(self, instance):
+        """Returns a copy of the ``instance``'s fields, with their original
+        values, without the cached related instances, and without sending
+        post_init.
+        """
+        model = instance.__class__
+        orig_state = dict(izip(self.attnames, self.values))
+        orig_state["_state"] = instance.__dict__["_state"]
+        orig = model.__new__(model)
+        orig.__dict__ = orig_state
+        return orig
+    
+def get_orig_state(instance):
+    """Returns the OriginalState snapshot of the ``instance``, or None if it
+    has none. The plain copy of its __dict__ that earlier versions kept
+    (and pickled into cached trees) is treated as no snapshot, so that the
+    instance is invalidated in full.
+    """
+    orig_state = instance.__dict__.get("_orig_state")
+    if isinstance(orig_state, OriginalState):
+        return orig_state
+    return None
+
+########################################################################
+
+def _filter_in_chunks(model, lookup, values, using):
+    """Returns a list of the instances of ``model`` matching the ``lookup``
+    for any of the ``values``, with one query per chunk of values.
+    """
+    values = list(values)
+    instances = list()
+    chunk_size = Invalidator.BULK_CHUNK_SIZE
+    for start in xrange(0, len(values), chunk_size):
+        instances.extend(model._base_manager.using(using).filter(
+            **{lookup: values[start:start + chunk_size]}))
+    return instances
+
+def _values_in_chunks(model, fields, lookup, values, using):
+    """Returns a dictionary mapping the attname of each of the ``fields``, a
+    tuple of (name, attname) pairs of ``model``'s fields, to a set of its
+    values on the instances of ``model`` matching the ``lookup`` for any of
+    the ``values``, with one values_list query per chunk of values.
+    """
+    values = list(values)
+    result = dict((attname, set()) for name, attname in fields)
+    columns = [result[attname] for name, attname in fields]
+    names = [name for name, attname in fields]
+    chunk_size = Invalidator.BULK_CHUNK_SIZE
+    for start in xrange(0, len(values), chunk_size):
+        for row in model._base_manager.using(using).filter(
+                **{lookup: values[start:start + chunk_size]}).values_list(*names):
+            for column, value in izip(columns, row):
+                column.add(value)
+    return result
+    
+########################################################################
+
 def invalidate(*instances):
     if cachetree_settings.INVALIDATE and not cachetree_settings.DISABLE:
         for instance in instances:
@@ -444,17 +1573,147 @@ def invalidate(*instances):
         
 ########################################################################
 
-def no_invalidation(function):
-    """Function decorator that disables invalidation for the duration of the
-    function.
+def invalidate_model(*models):
+    """Invalidates every cached tree of each of the ``models`` at once, by
+    incrementing the generation in their keys, without having to know the
+    instances (for example, after a data migration or QuerySet.update). If
+    invalidation is enabled, models that are only cached within the trees
+    of root models invalidate those root models.
+    """
+    if cachetree_settings.DISABLE:
+        return
+    root_models = set()
+    for model in models:
+        invalidation_paths = Invalidator.INVALIDATION_PATHS.get(model)
+        if not invalidation_paths:
+            # Raises ValueError if the model isn't cached.
+            get_cache_settings(model)
+            root_models.add(model)
+        else:
+            root_models.update(Invalidator.get_root_models(model))
+    tree_cache.invalidate_models(root_models)
+    
+########################################################################
+
+def clear_negative_entries(sender, instance, created=False, **kwargs):
+    """Deletes the cached misses at the keys of a newly created root
+    ``instance``. Connected to post_save when invalidation is off, which
+    otherwise does this as part of invalidating the instance.
+    """
+    if created and not NoInvalidation.is_skipped(sender):
+        plan = get_cache_plan(sender)
+        tree_cache.delete_many(plan.make_instance_keys([instance]), [sender])
+        
+def connect_negative_entry_signals(action="connect"):
+    """Connects or disconnects clear_negative_entries for each cached model.
+    """
+    for app_label, model in get_cached_models():
+        dispatch_uid = "negative:%s:%s" % (model._meta.app_label, model.__name__)
+        getattr(post_save, action)(clear_negative_entries, sender=model, dispatch_uid=dispatch_uid)
+        
+########################################################################
+
+class NoInvalidation(object):
+    """Skips the invalidation of the instances saved and deleted in the
+    current thread for the duration of a block or function, either of every
+    model, or only of the ``models``, without disconnecting the signal
+    handlers, so other threads still invalidate. If ``invalidate_after`` is
+    True, the skipped instances are recorded and invalidated in one batch
+    when it ends, as with batch_invalidation.
+    """
+    
+    _local = threading.local()
+    
+    def __init__(self, models=None, invalidate_after=False):
+        if models is not None:
+            models = frozenset(models)
+        self.models = models
+        self.invalidate_after = invalidate_after
+        
+    ####################################################################
+    
+    @classmethod
+    def _get_scopes(cls):
+        scopes = getattr(cls._local, "scopes", None)
+        if scopes is None:
+            scopes = cls._local.scopes = list()
+        return scopes
+    
+    @classmethod
+    def _get_scope(cls, model):
+        """Returns the innermost of the current thread's scopes that skips
+        ``model``, or None.
+        """
+        for scope in reversed(cls._get_scopes()):
+            models = scope[0]
+            if models is None or model in models:
+                return scope
+        return None
+    
+    @classmethod
+    def is_skipped(cls, model):
+        """Returns True if invalidation of the ``model`` is skipped in the
+        current thread.
+        """
+        return cls._get_scope(model) is not None
+    
+    @classmethod
+    def skip(cls, instance):
+        """Returns True if invalidation of the ``instance`` is skipped in the
+        current thread, recording the instance if it is to be invalidated
+        later.
+        """
+        scope = cls._get_scope(instance.__class__)
+        if scope is None:
+            return False
+        changed_instances = scope[1]
+        if changed_instances is not None:
+            changed_instances.add(instance)
+        return True
+    
+    ####################################################################
+    
+    def __enter__(self):
+        self.begin()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end()
+        
+    def __call__(self, function):
+        def wrapper(*args, **kwargs):
+            self.begin()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.end()
+        return wraps(function)(wrapper)
+    
+    ####################################################################
+    
+    def begin(self):
+        # The scope is kept per thread rather than on self, as a decorated
+        # function may run in several threads at once.
+        changed_instances = None
+        if self.invalidate_after:
+            changed_instances = ChangedInstances()
+        self._get_scopes().append((self.models, changed_instances))
+        
+    def end(self):
+        changed_instances = self._get_scopes().pop()[1]
+        if changed_instances is not None:
+            changed_instances.invalidate()
+
+def no_invalidation(*models, **kwargs):
+    """Returns a context manager, that can also be used as a decorator, which
+    skips invalidation in the current thread, of every model or only of the
+    ``models``. Pass ``invalidate_after=True`` to invalidate the skipped
+    instances in one batch at the end. See NoInvalidation.
+    
+    For backwards compatibility, it can also decorate a function directly.
     """
-    def wrapper(*args, **kwargs):
-        if cachetree_settings.INVALIDATE and not cachetree_settings.DISABLE:
-            Invalidator.disconnect_signals()
-        returned = function(*args, **kwargs)
-        if cachetree_settings.INVALIDATE and not cachetree_settings.DISABLE:
-            Invalidator.connect_signals()
-        return returned
-    return wraps(function)(wrapper)
+    if len(models) == 1 and not kwargs and not isinstance(models[0], ModelBase):
+        return NoInvalidation()(models[0])
+    return NoInvalidation(models or None, **kwargs)
 
 ########################################################################
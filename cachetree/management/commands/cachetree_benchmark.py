@@ -0,0 +1,48 @@
+"""
+Cachetree benchmark command
+"""
+
+########################################################################
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.loading import get_model
+from cachetree.benchmarks import BENCHMARKS
+from cachetree.utils import get_cached_models
+
+########################################################################
+
+class Command(BaseCommand):
+    help = ("Runs a cachetree benchmark against the cached models (or the "
+            "given models) using the configured database and cache.")
+    args = "benchmark [app_label.Model ...]"
+    
+    option_list = BaseCommand.option_list + (
+        make_option("--iterations", action="store", type="int", dest="iterations",
+            default=10000, help="Number of iterations to time. Defaults to 10000."),
+    )
+    
+    def handle(self, benchmark_name=None, *model_labels, **options):
+        if benchmark_name not in BENCHMARKS:
+            raise CommandError("Choose a benchmark: %s" % ", ".join(sorted(BENCHMARKS)))
+        benchmark = BENCHMARKS[benchmark_name]
+        
+        if model_labels:
+            models = []
+            for label in model_labels:
+                model = get_model(*label.split(".", 1))
+                if model is None:
+                    raise CommandError("Unknown model: %s" % label)
+                models.append(model)
+        else:
+            models = [model for app_label, model in get_cached_models()]
+            
+        for model in models:
+            results = benchmark(model, iterations=options["iterations"])
+            if not results:
+                self.stdout.write("%s.%s: no instances to benchmark\n" % (
+                    model._meta.app_label, model.__name__))
+                continue
+            self.stdout.write("%s.%s\n" % (model._meta.app_label, model.__name__))
+            for name, seconds in results:
+                self.stdout.write("    %-60s %12.2f us\n" % (name, seconds * 1000000))
@@ -4,14 +4,29 @@ Cachetree Manager
 
 ########################################################################
 
+import operator
+import time
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.db import connections
+from django.db.models import Q
 from django.db.models.manager import Manager
+from django.db.models.fields.related import (
+    SingleRelatedObjectDescriptor, ReverseSingleRelatedObjectDescriptor,
+    ForeignRelatedObjectsDescriptor, ManyRelatedObjectsDescriptor,
+    ReverseManyRelatedObjectsDescriptor)
 from django.db.models.fields import FieldDoesNotExist
-from django.db.models.query_utils import select_related_descend
-from utils import generate_base_key, get_cache_settings
+from plans import get_cache_plan, get_select_related
 from exceptions import ImproperlyConfigured
 import settings as cachetree_settings
-from cache import cache
+from cache import cache, tree_cache, get_side_key, Pointer
+from refresh import refresher
+import stats
+
+########################################################################
+
+# The number of seconds after which a stale tree's refresh is assumed to
+# have failed, and another one can be scheduled.
+REFRESH_LOCK_TIMEOUT = 30
 
 ########################################################################
 
@@ -20,184 +35,565 @@ class CacheManagerMixin:
     ####################################################################
     
     def _get_select_related_from_attrs(self, model, attrs):
-        opts = model._meta
-        related = list()
-        for attr_name, child_attrs in attrs.iteritems():
-            try:
-                field = opts.get_field(attr_name)
-            except FieldDoesNotExist:
-                pass
-            else:
-                if select_related_descend(field, False, []):
-                    if child_attrs:
-                        subrelated = self._get_select_related_from_attrs(field.rel, child_attrs)
-                        if subrelated:
-                            for entry in subrelated:
-                                related.append('%s__%s' % (attr_name, entry))
-                        else:
-                            related.append(attr_name)
-                    else:
-                        related.append(attr_name)
-        return related
+        return get_select_related(model, attrs)
+    
+    def _get_base_queryset(self, plan):
+        if plan.select_related:
+            return self.all().select_related(*plan.select_related)
+        return self.all()
     
     def get_cached(self, **kwargs):
         """Gets the model instance from the cache, or, if the instance is not in
         the cache, gets it from the database and puts it in the cache.
         """
-        cache_settings = get_cache_settings(self.model)
-        lookups = cache_settings.get("lookups")
-        prefetch = cache_settings.get("prefetch")
-        
-        related = self._get_select_related_from_attrs(self.model, prefetch)
-        if related:
-            base_qs = self.all().select_related(*related)
-        else:
-            base_qs = self.all()
-        
-        keys = kwargs.keys()
-        single_kwarg_match = len(keys) == 1 and keys[0] in lookups
-        multi_kwarg_match = len(keys) != 1 and any(
-            sorted(keys) == sorted(lookup) for lookup in lookups if isinstance(lookup, (list, tuple)))
-        if not single_kwarg_match and not multi_kwarg_match:
-            raise ValueError("Caching not allowed with kwargs %s" % ", ".join(keys))
+        plan = get_cache_plan(self.model)
+        if not plan.allows(kwargs):
+            raise ValueError("Caching not allowed with kwargs %s" % ", ".join(kwargs.keys()))
         
         # Get object from cache or db.
-        key = generate_base_key(self.model, **kwargs)
-        obj = cache.get(key)
+        key = plan.make_key(kwargs)
+        on_stale = None
+        if plan.stale_ttl is not None:
+            on_stale = lambda key: self._schedule_refresh(key, kwargs, plan)
+        obj = tree_cache.get(key, plan, on_stale)
+        if isinstance(obj, Pointer):
+            objects = {key: obj}
+            self._resolve_pointers(objects, plan)
+            obj = objects.get(key)
         if obj is not None:
-            if isinstance(obj, ObjectDoesNotExist):
-                raise self.model.DoesNotExist(repr(obj))
-            elif isinstance(obj, MultipleObjectsReturned):
-                raise self.model.MultipleObjectsReturned(repr(obj))
-            else:
-                return obj
+            return self._from_cached(obj)
+        
+        lock_key = None
+        if plan.fill_lock is not None:
+            lock_key, obj = self._acquire_fill_lock(key, plan)
+            if obj is not None:
+                return self._from_cached(obj)
         try:
-            obj = base_qs.get(**kwargs)
+            return self._fill(key, kwargs, plan)
+        finally:
+            if lock_key is not None:
+                cache.delete(lock_key)
+    
+    def _fill(self, key, kwargs, plan):
+        """Gets the instance matching the ``kwargs`` from the database, with
+        its related objects, and puts it in the cache at ``key``.
+        """
+        if plan.pointers and kwargs.keys() != ["pk"]:
+            # The tree may still be cached under the pk key, so look up the
+            # pk alone before building the tree.
+            pks = list(self.filter(**kwargs).values_list("pk", flat=True)[:2])
+            if len(pks) == 1:
+                pk = pks[0]
+                on_stale = None
+                if plan.stale_ttl is not None:
+                    on_stale = lambda pk_key: self._schedule_refresh(pk_key, dict(pk=pk), plan)
+                obj = tree_cache.get(plan.make_pk_key(pk), plan, on_stale)
+                if isinstance(obj, self.model):
+                    tree_cache.set_pointers({key: pk}, plan)
+                    return obj
+        
+        try:
+            obj = self._get_base_queryset(plan).get(**kwargs)
         except (ObjectDoesNotExist, MultipleObjectsReturned), e:
-            # The model-specific subclasses of these exceptions are not
-            # pickleable, so we cache the base exception and reconstruct the
-            # specific exception when fetching from the cache.
+            # The base exception is cached (as a sentinel, see
+            # serializers.dumps), and the model-specific exception is
+            # reconstructed when fetching from the cache.
             obj = e.__class__.__base__(repr(e))
-            cache.set(key, obj, cache_settings.get("timeout"))
+            tree_cache.set(key, obj, plan)
             raise
         
-        self._prefetch_related(obj, prefetch)
+        self._prefetch_related(obj, plan.prefetch)
         self._tag_object_as_from_cache(obj)
-        cache.set(key, obj, cache_settings.get("timeout"))
+        self._cache_trees({key: obj}, plan)
         return obj
     
-    def get_many_cached(self, list_of_kwargs):
-        """Gets the model instance from the cache, or, if the instance is not in
-        the cache, gets it from the database and puts it in the cache.
+    def _cache_trees(self, objects, plan):
+        """Puts the trees in the ``objects`` dictionary in the cache, at their
+        keys. If the model uses pointers, trees are put at their pk keys
+        instead, and their other keys point to them.
         """
-        cache_settings = get_cache_settings(self.model)
-        lookups = cache_settings.get("lookups")
-        prefetch = cache_settings.get("prefetch")
+        if not plan.pointers:
+            if len(objects) == 1:
+                tree_cache.set(objects.keys()[0], objects.values()[0], plan)
+            else:
+                tree_cache.set_many(objects, plan)
+            return
         
-        related = self._get_select_related_from_attrs(self.model, prefetch)
-        if related:
-            base_qs = self.all().select_related(*related)
-        else:
-            base_qs = self.all()
+        trees = dict()
+        pointers = dict()
+        for key, obj in objects.iteritems():
+            if isinstance(obj, (ObjectDoesNotExist, MultipleObjectsReturned)):
+                trees[key] = obj
+            else:
+                pk_key = plan.make_pk_key(obj.pk)
+                trees[pk_key] = obj
+                if key != pk_key:
+                    pointers[key] = obj.pk
+        tree_cache.set_many(trees, plan)
+        if pointers:
+            tree_cache.set_pointers(pointers, plan)
+    
+    def _resolve_pointers(self, objects, plan):
+        """Replaces each Pointer in the ``objects`` dictionary with the tree
+        it points to, using one get_many. Pointers to trees that are no
+        longer cached are removed, making them misses.
+        """
+        pks = dict()
+        for key, obj in objects.iteritems():
+            if isinstance(obj, Pointer):
+                pks[key] = obj.pk
+        if not pks:
+            return
+        
+        pk_keys = dict((key, plan.make_pk_key(pk)) for key, pk in pks.iteritems())
+        on_stale = None
+        if plan.stale_ttl is not None:
+            pks_by_pk_key = dict((pk_keys[key], pk) for key, pk in pks.iteritems())
+            on_stale = lambda pk_key: self._schedule_refresh(
+                pk_key, dict(pk=pks_by_pk_key[pk_key]), plan)
+        trees = tree_cache.get_many(list(set(pk_keys.itervalues())), plan, on_stale)
+        for key, pk_key in pk_keys.iteritems():
+            tree = trees.get(pk_key)
+            if tree is None or isinstance(tree, Pointer):
+                del objects[key]
+            else:
+                objects[key] = tree
+    
+    def _schedule_refresh(self, key, kwargs, plan):
+        """Schedules a refresh of the stale tree at ``key``, unless a refresh
+        of it is already scheduled by any process.
+        """
+        stats.incr(self.model, "stale_hits")
+        refresh_key = get_side_key(key, "refresh")
+        if not cache.add(refresh_key, 1, REFRESH_LOCK_TIMEOUT):
+            return
+        
+        def refresh():
+            try:
+                try:
+                    self._fill(key, kwargs, plan)
+                except (ObjectDoesNotExist, MultipleObjectsReturned):
+                    pass
+                stats.incr(self.model, "stale_refreshes")
+            finally:
+                cache.delete(refresh_key)
+        
+        if not refresher.schedule(refresh):
+            cache.delete(refresh_key)
+    
+    def _from_cached(self, obj):
+        """Returns the cached ``obj``, or raises the model-specific exception
+        if a DoesNotExist or MultipleObjectsReturned was cached.
+        """
+        if isinstance(obj, ObjectDoesNotExist):
+            raise self.model.DoesNotExist(
+                str(obj) or "%s matching query does not exist." % self.model._meta.object_name)
+        elif isinstance(obj, MultipleObjectsReturned):
+            raise self.model.MultipleObjectsReturned(
+                str(obj) or "get() returned more than one %s." % self.model._meta.object_name)
+        return obj
+    
+    def _acquire_fill_lock(self, key, plan):
+        """Tries to become the only process filling the cache at ``key``.
+        Returns a (lock_key, obj) tuple: the lock key if the lock was
+        acquired, or the cached object if another process filled the key
+        while we waited. Both are None if the wait timed out, in which case
+        the caller fills the key without the lock.
+        """
+        fill_lock = plan.fill_lock
+        lock_key = get_side_key(key, "lock")
+        if cache.add(lock_key, 1, fill_lock["timeout"]):
+            stats.incr(self.model, "fill_lock_acquired")
+            return lock_key, None
+        
+        stats.incr(self.model, "fill_lock_waits")
+        deadline = time.time() + fill_lock["wait"]
+        while time.time() < deadline:
+            time.sleep(fill_lock["interval"])
+            obj = tree_cache.get(key, plan)
+            if isinstance(obj, Pointer):
+                # A pointer to a tree that is gone is still a miss.
+                objects = {key: obj}
+                self._resolve_pointers(objects, plan)
+                obj = objects.get(key)
+            if obj is not None:
+                return None, obj
+            # The lock holder may have failed, or its lock expired.
+            if cache.add(lock_key, 1, fill_lock["timeout"]):
+                stats.incr(self.model, "fill_lock_acquired")
+                return lock_key, None
+        
+        stats.incr(self.model, "fill_lock_timeouts")
+        return None, None
+    
+    def get_many_cached(self, list_of_kwargs):
+        """Gets the model instances from the cache, or, if any of the instances
+        are not in the cache, gets them from the database and puts them in the
+        cache.
+        
+        Cache misses that share the same lookup fields are filled with a single
+        query per chunk of ``GET_MANY_CHUNK_SIZE`` lookups, and all new
+        entries are set in the cache with a single ``set_many``. The
+        instances are returned in the order of ``list_of_kwargs``, with
+        duplicate lookups removed.
+        """
+        plan = get_cache_plan(self.model)
         
         cache_keys = dict()
+        ordered_keys = list()
         
         for kwargs in list_of_kwargs:
-            keys = kwargs.keys()
-            single_kwarg_match = len(keys) == 1 and keys[0] in lookups
-            multi_kwarg_match = len(keys) != 1 and any(
-                sorted(keys) == sorted(lookup) for lookup in lookups if isinstance(lookup, (list, tuple)))
-            if not single_kwarg_match and not multi_kwarg_match:
-                raise ValueError("Caching not allowed with kwargs %s" % ", ".join(keys))
+            if not plan.allows(kwargs):
+                raise ValueError("Caching not allowed with kwargs %s" % ", ".join(kwargs.keys()))
             
-            # Get object from cache or db.
-            key = generate_base_key(self.model, **kwargs)
-            cache_keys[key] = kwargs
+            key = plan.make_key(kwargs)
+            if key not in cache_keys:
+                cache_keys[key] = kwargs
+                ordered_keys.append(key)
+        
+        on_stale = None
+        if plan.stale_ttl is not None:
+            on_stale = lambda key: self._schedule_refresh(key, cache_keys[key], plan)
+        objects = tree_cache.get_many(ordered_keys, plan, on_stale)
+        if plan.pointers:
+            self._resolve_pointers(objects, plan)
+        
+        # Group the misses by the names of their lookup fields, so that each
+        # group can be filled with one query.
+        missed_keys = dict()
+        for key in ordered_keys:
+            if objects.get(key, None) is None:
+                lookup_names = tuple(sorted(cache_keys[key].keys()))
+                missed_keys.setdefault(lookup_names, []).append(key)
         
-        objects = cache.get_many(cache_keys.keys())
         pending_cache_update = dict()
-        cached_objects = list()
+        filled_objects = list()
+        base_qs = self._get_base_queryset(plan)
         
-        for key, kwargs in cache_keys.iteritems():
-            obj = objects.get(key, None)
-            if obj is not None:
-                if isinstance(obj, ObjectDoesNotExist):
-                    raise self.model.DoesNotExist(repr(obj))
-                elif isinstance(obj, MultipleObjectsReturned):
-                    raise self.model.MultipleObjectsReturned(repr(obj))
+        for lookup_names, keys in missed_keys.iteritems():
+            if self._can_batch_fill(lookup_names):
+                found, missing = self._batch_fill(plan, base_qs, lookup_names, 
+                                                  [cache_keys[key] for key in keys])
+            else:
+                found, missing = {}, set()
+            for key in keys:
+                matches = found.get(key, [])
+                if len(matches) == 1:
+                    obj = matches[0]
+                    filled_objects.append(obj)
+                elif key in missing:
+                    obj = ObjectDoesNotExist()
                 else:
-                    cached_objects.append(obj)
-                    continue
-            try:
-                obj = base_qs.get(**kwargs)
-            except (ObjectDoesNotExist, MultipleObjectsReturned), e:
-                # The model-specific subclasses of these exceptions are not
-                # pickleable, so we cache the base exception and reconstruct the
-                # specific exception when fetching from the cache.
-                obj = e.__class__.__base__(repr(e))
-                cache.set(key, obj, cache_settings.get("timeout"))
-                raise
-            
-            self._prefetch_related(obj, prefetch)
-            self._tag_object_as_from_cache(obj)
-            pending_cache_update[key] = obj
-            cached_objects.append(obj)
+                    # Either the lookup didn't match exactly one row, or the
+                    # database matched it differently than the key did (for
+                    # example, with a case-insensitive collation), so let
+                    # get() decide.
+                    try:
+                        obj = base_qs.get(**cache_keys[key])
+                    except (ObjectDoesNotExist, MultipleObjectsReturned), e:
+                        # The base exception is cached, and the
+                        # model-specific exception is reconstructed when
+                        # fetching from the cache.
+                        obj = e.__class__.__base__(repr(e))
+                    else:
+                        filled_objects.append(obj)
+                pending_cache_update[key] = obj
+                objects[key] = obj
+        
+        if filled_objects:
+            self._prefetch_related(filled_objects, plan.prefetch)
+            for obj in filled_objects:
+                self._tag_object_as_from_cache(obj)
         
         if pending_cache_update:
-            cache.set_many(pending_cache_update, cache_settings.get("timeout"))
+            self._cache_trees(pending_cache_update, plan)
+        
+        cached_objects = list()
+        for key in ordered_keys:
+            cached_objects.append(self._from_cached(objects[key]))
         return cached_objects
+    
+    ####################################################################
+    
+    GET_MANY_CHUNK_SIZE = 500
+    
+    def _get_lookup_attname(self, name):
+        """Returns the attribute name holding the value of the lookup field
+        ``name`` on an instance, or None if the lookup doesn't map to a
+        concrete field (e.g. a reverse relation).
+        """
+        opts = self.model._meta
+        if name == "pk":
+            return opts.pk.attname
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field not in opts.fields:
+            return None
+        if field.rel and field.rel.get_related_field() is not field.rel.to._meta.pk:
+            # The key is generated from the related instance's pk, but the
+            # instance only holds the to_field value.
+            return None
+        return field.attname
+    
+    def _can_batch_fill(self, lookup_names):
+        return all(self._get_lookup_attname(name) for name in lookup_names)
+    
+    def _batch_fill(self, plan, base_qs, lookup_names, list_of_kwargs):
+        """Fetches the instances matching ``list_of_kwargs``, all of which
+        use the ``lookup_names``, with one query per chunk. Returns a
+        dictionary mapping each cache key to the list of instances found for
+        it, and a set of the keys that are known not to match any instance.
+        
+        Only single-field lookups can be known not to match: the query
+        matched nothing for the key, and every instance it returned was
+        found for one of the chunk's keys, none of whose values differ from
+        another's only by case or surrounding whitespace, so the database
+        can't have matched the key to another key's instance (for example,
+        with a case-insensitive collation).
+        """
+        attnames = [self._get_lookup_attname(name) for name in lookup_names]
+        chunk_size = max(1, self.GET_MANY_CHUNK_SIZE // len(lookup_names))
+        found = dict()
+        missing = set()
+        
+        for start in xrange(0, len(list_of_kwargs), chunk_size):
+            chunk = list_of_kwargs[start:start + chunk_size]
+            if len(lookup_names) == 1:
+                name = lookup_names[0]
+                values = [kwargs[name] for kwargs in chunk]
+                queryset = base_qs.filter(**{"%s__in" % name: values})
+            else:
+                queryset = base_qs.filter(reduce(operator.or_, [Q(**kwargs) for kwargs in chunk]))
+            
+            chunk_keys = set([plan.make_key(kwargs) for kwargs in chunk])
+            unmatched_rows = False
+            for obj in queryset:
+                key = plan.make_key(dict(
+                    (name, getattr(obj, attname)) for name, attname in zip(lookup_names, attnames)))
+                found.setdefault(key, []).append(obj)
+                if key not in chunk_keys:
+                    unmatched_rows = True
+            
+            if len(lookup_names) == 1 and not unmatched_rows:
+                folded_values = set([_fold(value) for value in values])
+                if len(folded_values) == len(chunk_keys):
+                    missing.update([key for key in chunk_keys if key not in found])
+                
+        return found, missing
    
     ####################################################################
     
     def _prefetch_related(self, objs, attrs):
-        """Recursively follows the `attrs` on each of the `objs` in order to
-        populate the objects' caches.
+        """Follows the ``attrs`` on the ``objs`` in order to populate the
+        objects' caches.
+        
+        The tree is prefetched level by level: for each attribute in
+        ``attrs``, the related instances of all the ``objs`` are fetched
+        together with a single query, and the combined set of related
+        instances is then used to prefetch the next level.
         """
         if not isinstance(objs, (list, tuple)):
             objs = [objs]
-            
-        for obj in objs:
+        if not objs or not attrs:
+            return
         
-            for attr_name, child_attrs in attrs.iteritems():
+        for attr_name, child_attrs in attrs.iteritems():
+            descriptor = getattr(objs[0].__class__, attr_name, None)
+            
+            if isinstance(descriptor, ReverseSingleRelatedObjectDescriptor):
+                related_objs = self._prefetch_forward_single(objs, descriptor, child_attrs)
+            elif isinstance(descriptor, SingleRelatedObjectDescriptor):
+                related_objs = self._prefetch_reverse_single(objs, descriptor, child_attrs)
+            elif isinstance(descriptor, (ForeignRelatedObjectsDescriptor,
+                                         ManyRelatedObjectsDescriptor,
+                                         ReverseManyRelatedObjectsDescriptor)):
+                related_objs = self._prefetch_many(objs, attr_name, descriptor, child_attrs)
+            else:
+                related_objs = self._prefetch_attr_per_instance(objs, attr_name)
                 
-                try:
-                    attr = getattr(obj, attr_name)
-                    
-                # If the object doesn't exist, we can't prefetch it.
-                except ObjectDoesNotExist:
-                    continue
+            if child_attrs and related_objs:
+                self._prefetch_related(related_objs, child_attrs)
                 
-                # attr might be a method that we need to call (presumably to
-                # fill its own local cache). This is an undocumented feature.
-                if callable(attr):
-                    attr = attr()
+    def _get_prefetch_queryset(self, manager, child_attrs):
+        related = get_select_related(manager.model, child_attrs)
+        if related:
+            return manager.all().select_related(*related)
+        return manager.all()
+    
+    def _prefetch_forward_single(self, objs, descriptor, child_attrs):
+        """Prefetches a ForeignKey or OneToOneField for all the ``objs``,
+        skipping any that were already populated by select_related.
+        """
+        field = descriptor.field
+        cache_name = field.get_cache_name()
+        to_field = field.rel.get_related_field()
+        
+        missing = [obj for obj in objs 
+                   if cache_name not in obj.__dict__ and getattr(obj, field.attname) is not None]
+        if missing:
+            queryset = self._get_prefetch_queryset(field.rel.to._base_manager, child_attrs)
+            values = set(getattr(obj, field.attname) for obj in missing)
+            related_by_value = dict(
+                (getattr(related_obj, to_field.attname), related_obj) 
+                for related_obj in queryset.filter(**{"%s__in" % to_field.name: list(values)}))
+            for obj in missing:
+                # If the related object doesn't exist, we can't prefetch it.
+                related_obj = related_by_value.get(getattr(obj, field.attname))
+                if related_obj is not None:
+                    setattr(obj, cache_name, related_obj)
+        
+        return _unique(obj.__dict__.get(cache_name) for obj in objs)
+    
+    def _prefetch_reverse_single(self, objs, descriptor, child_attrs):
+        """Prefetches the reverse side of a OneToOneField for all the
+        ``objs``.
+        """
+        field = descriptor.related.field
+        related_attname = field.rel.get_related_field().attname
+        
+        missing = [obj for obj in objs if descriptor.cache_name not in obj.__dict__]
+        if missing:
+            queryset = self._get_prefetch_queryset(descriptor.related.model._base_manager, child_attrs)
+            values = [getattr(obj, related_attname) for obj in missing]
+            related_by_value = dict(
+                (getattr(related_obj, field.attname), related_obj) 
+                for related_obj in queryset.filter(**{"%s__in" % field.name: values}))
+            for obj in missing:
+                # If the related object doesn't exist, we leave the cache
+                # empty so that accessing it still raises DoesNotExist.
+                related_obj = related_by_value.get(getattr(obj, related_attname))
+                if related_obj is not None:
+                    setattr(obj, descriptor.cache_name, related_obj)
                     
-                # If attr returns a subclass of models.Manager, use all() to
-                # get a queryset of all results and iterate over it to fill
-                # the queryset cache with those results. Then, on the parent
-                # object, stored the queryset in a cached attribute.
-                elif isinstance(attr, Manager):
-                    related = self._get_select_related_from_attrs(attr.model, child_attrs)
-                    if related:
-                        queryset = attr.all().select_related(*related)
-                    else:
-                        queryset = attr.all()
-                    related_instances = []
-                    for instance in queryset:
-                        related_instances.append(instance)
-                    cached_attr_name = "%s%s" % (cachetree_settings.CACHETREE_MANY_RELATED_PREFIX, attr_name)
-                    if hasattr(obj, cached_attr_name):
-                        raise ImproperlyConfigured(
-                            "Cannot store %s on %s instance because it already has an attribute with that name. Try setting CACHETREE_MANY_RELATED_PREFIX to a different value." % (
-                                cached_attr_name, obj.__class__.__name__))
-                    setattr(obj, cached_attr_name, queryset)
-                    attr = related_instances
+        return _unique(obj.__dict__.get(descriptor.cache_name) for obj in objs)
+    
+    def _prefetch_many(self, objs, attr_name, descriptor, child_attrs):
+        """Prefetches a reverse ForeignKey or a ManyToManyField (forward or
+        reverse) for all the ``objs`` with a single query, and stores each
+        object's evaluated queryset under its CACHETREE_MANY_RELATED_PREFIX
+        attribute.
+        """
+        cached_attr_name = "%s%s" % (cachetree_settings.CACHETREE_MANY_RELATED_PREFIX, attr_name)
+        for obj in objs:
+            if hasattr(obj, cached_attr_name):
+                raise ImproperlyConfigured(
+                    "Cannot store %s on %s instance because it already has an attribute with that name. Try setting CACHETREE_MANY_RELATED_PREFIX to a different value." % (
+                        cached_attr_name, obj.__class__.__name__))
+        
+        if isinstance(descriptor, ForeignRelatedObjectsDescriptor):
+            field = descriptor.related.field
+            source_attname = field.rel.get_related_field().attname
+            queryset = self._get_prefetch_queryset(
+                descriptor.related.model._default_manager, child_attrs).filter(
+                **{"%s__in" % field.name: [getattr(obj, source_attname) for obj in objs]})
+            
+            def get_source_value(related_obj):
+                return getattr(related_obj, field.attname)
+        else:
+            if isinstance(descriptor, ManyRelatedObjectsDescriptor):
+                m2m_field = descriptor.related.field
+                model = descriptor.related.model
+                query_name = m2m_field.name
+                source_field_name = m2m_field.m2m_reverse_field_name()
+            else:
+                m2m_field = descriptor.field
+                model = m2m_field.rel.to
+                query_name = m2m_field.related_query_name()
+                source_field_name = m2m_field.m2m_field_name()
+            
+            # Select the source pk from the join table along with each
+            # related instance, as Django does for the related manager.
+            through_opts = m2m_field.rel.through._meta
+            qn = connections[self.db].ops.quote_name
+            source_column = "%s.%s" % (
+                qn(through_opts.db_table), qn(through_opts.get_field(source_field_name).column))
+            source_attname = objs[0]._meta.pk.attname
+            queryset = self._get_prefetch_queryset(model._default_manager, child_attrs).filter(
+                **{"%s__in" % query_name: [getattr(obj, source_attname) for obj in objs]}
+                ).extra(select={"_cachetree_source": source_column})
+            
+            def get_source_value(related_obj):
+                return related_obj.__dict__.pop("_cachetree_source")
+        
+        related_by_value = dict()
+        related_objs = list()
+        for related_obj in queryset:
+            related_by_value.setdefault(get_source_value(related_obj), []).append(related_obj)
+            related_objs.append(related_obj)
+        
+        for obj in objs:
+            # Use the manager's own queryset, so the cached results behave
+            # like the ones all() would have returned.
+            manager_queryset = getattr(obj, attr_name).all()
+            manager_queryset._result_cache = related_by_value.get(getattr(obj, source_attname), [])
+            setattr(obj, cached_attr_name, manager_queryset)
+            
+        return related_objs
+        
+    def _prefetch_attr_per_instance(self, objs, attr_name):
+        """Follows ``attr_name`` on each of the ``objs`` separately, for
+        attributes that aren't related model descriptors.
+        """
+        related_objs = list()
+        for obj in objs:
+            try:
+                attr = getattr(obj, attr_name)
                 
-                if child_attrs:
-                    self._prefetch_related(attr, child_attrs)
+            # If the object doesn't exist, we can't prefetch it.
+            except ObjectDoesNotExist:
+                continue
+            
+            # attr might be a method that we need to call (presumably to
+            # fill its own local cache). This is an undocumented feature.
+            if callable(attr):
+                attr = attr()
+
+            # If attr returns a subclass of models.Manager, use all() to
+            # get a queryset of all results and iterate over it to fill
+            # the queryset cache with those results. Then, on the parent
+            # object, stored the queryset in a cached attribute.
+            elif isinstance(attr, Manager):
+                queryset = attr.all()
+                attr = list(queryset)
+                cached_attr_name = "%s%s" % (cachetree_settings.CACHETREE_MANY_RELATED_PREFIX, attr_name)
+                if hasattr(obj, cached_attr_name):
+                    raise ImproperlyConfigured(
+                        "Cannot store %s on %s instance because it already has an attribute with that name. Try setting CACHETREE_MANY_RELATED_PREFIX to a different value." % (
+                            cached_attr_name, obj.__class__.__name__))
+                setattr(obj, cached_attr_name, queryset)
+
+            if isinstance(attr, (list, tuple)):
+                related_objs.extend(attr)
+            elif attr is not None:
+                related_objs.append(attr)
+        return related_objs
     
     def _tag_object_as_from_cache(self, obj):
         obj._from_cachetree = True
 
 ########################################################################
 
+def _unique(objs):
+    """Returns the objects in ``objs`` that are not None, without repeating
+    any object.
+    """
+    seen = set()
+    unique_objs = list()
+    for obj in objs:
+        if obj is not None and id(obj) not in seen:
+            seen.add(id(obj))
+            unique_objs.append(obj)
+    return unique_objs
+
+def _fold(value):
+    """Returns the lookup ``value`` as a database with a case-insensitive,
+    space-padded collation may compare it.
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower()
+    return value
+
+########################################################################
+
@@ -0,0 +1,31 @@
+"""
+Cachetree Middleware
+"""
+
+########################################################################
+
+from cache import tree_cache
+
+########################################################################
+
+class IdentityMapMiddleware(object):
+    """Memoizes the results of get_cached and get_many_cached for the
+    duration of each request. See cachetree.IdentityMap.
+    """
+    
+    def process_request(self, request):
+        # Each request starts a fresh scope, in case a previous request on
+        # this thread didn't end its own (for example, if a response
+        # middleware raised before process_response was called).
+        tree_cache.reset_identity_map()
+        request._cachetree_identity_map = True
+        
+    def process_response(self, request, response):
+        # The response middleware runs even if process_request didn't (for
+        # example, if an earlier middleware returned a response).
+        if getattr(request, "_cachetree_identity_map", False):
+            del request._cachetree_identity_map
+            tree_cache.end_identity_map()
+        return response
+    
+########################################################################
@@ -0,0 +1,326 @@
+"""
+Cachetree Plans
+"""
+
+########################################################################
+
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query_utils import select_related_descend
+from utils import (get_cache_settings, get_cached_models, get_key_prefix, make_key,
+                   make_key_from_raw)
+from exceptions import ImproperlyConfigured
+from serializers import get_serializer_by_name
+import settings as cachetree_settings
+
+########################################################################
+
+# PLANS is a dictionary mapping each cached model to its CachePlan. It is
+# filled by compile_plans() when cachetree is installed, and lazily by
+# get_cache_plan() for any model that was added to CACHETREE later.
+PLANS = {}
+
+# The defaults for a model's "fill_lock" setting.
+FILL_LOCK_DEFAULTS = {
+    "timeout": 10,
+    "wait": 2,
+    "interval": 0.05,
+}
+
+# The defaults for the "compression" setting.
+COMPRESSION_DEFAULTS = {
+    "threshold": 10 * 1024,
+    "level": 6,
+}
+
+########################################################################
+
+class FrozenDict(dict):
+    """A dictionary that can't be modified after it is created.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s is immutable" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    @classmethod
+    def freeze(cls, attrs):
+        """Recursively freezes a ``prefetch`` tree of attribute names.
+        """
+        return cls((attr_name, cls.freeze(child_attrs or {}))
+                   for attr_name, child_attrs in (attrs or {}).iteritems())
+
+########################################################################
+
+class CachePlan(object):
+    """Everything get_cached needs to know about a cached model, computed once
+    from the model's CACHETREE settings:
+
+    ``lookups``
+        The configured lookups, each as a tuple of kwarg names.
+    ``lookup_signatures``
+        A frozenset containing a frozenset of kwarg names for each lookup,
+        used to check the kwargs passed to get_cached.
+    ``select_related``
+        The arguments to pass to select_related when fetching root
+        instances.
+    ``prefetch``
+        The ``prefetch`` tree, as nested FrozenDicts.
+    ``timeout``
+        The timeout to use when setting root instances in the cache.
+    ``negative_timeout``
+        The timeout to use when caching DoesNotExist and
+        MultipleObjectsReturned errors.
+    ``key_prefix``
+        The model's part of every cache key generated for it, before its key
+        generation (see get_key_prefix).
+    ``pointers``
+        True if trees are only stored under their instance's pk key, with
+        the other lookup keys holding pointers to it.
+    ``key_lookups``
+        The lookups whose keys hold trees or pointers: the lookups, plus
+        ``("pk",)`` if ``pointers`` is True and it isn't one of them.
+    ``lookup_templates``
+        For each of the ``key_lookups``, a tuple of the raw key template
+        and the attnames whose values fill it in, after the key prefix, or
+        None if the lookup isn't on concrete fields. Used to generate the
+        keys of instances.
+    ``key_fields``
+        The fields whose values fill in the ``lookup_templates``, so that
+        only those need to be loaded to generate the keys of instances.
+    ``fill_lock``
+        A FrozenDict of the model's fill lock settings, or None if fills are
+        not locked.
+    ``stale_ttl``
+        The number of seconds a stale tree can be served while it is
+        refreshed, or None if trees are never served stale.
+    ``compression``
+        A FrozenDict of the model's compression settings, or None if trees
+        are not compressed.
+    ``serializer``
+        The serializer of the model's trees.
+    ``ignore_fields``
+        A frozenset of the attnames of the fields whose changes don't
+        invalidate the model's trees.
+    ``write_through``
+        True if changes to the instances in the model's trees are patched
+        into the cached trees, where possible, instead of deleting them.
+    """
+
+    __slots__ = ("model", "lookups", "lookup_signatures", "select_related",
+                 "prefetch", "timeout", "negative_timeout", "key_prefix", "pointers",
+                 "key_lookups", "lookup_templates", "key_fields", "fill_lock",
+                 "stale_ttl", "compression", "serializer", "ignore_fields",
+                 "write_through")
+
+    def __init__(self, model, cache_settings):
+        lookups = tuple(
+            tuple(lookup) if isinstance(lookup, (list, tuple)) else (lookup,)
+            for lookup in cache_settings.get("lookups"))
+        prefetch = FrozenDict.freeze(cache_settings.get("prefetch"))
+
+        set_attr = super(CachePlan, self).__setattr__
+        set_attr("model", model)
+        set_attr("lookups", lookups)
+        set_attr("lookup_signatures", frozenset(frozenset(lookup) for lookup in lookups))
+        set_attr("select_related", tuple(get_select_related(model, prefetch)))
+        set_attr("prefetch", prefetch)
+        set_attr("timeout", cache_settings.get("timeout"))
+        negative_timeout = cache_settings.get("negative_timeout", cachetree_settings.NEGATIVE_TIMEOUT)
+        if negative_timeout is None:
+            negative_timeout = self.timeout
+        set_attr("negative_timeout", negative_timeout)
+        set_attr("key_prefix", "%s.%s." % (model._meta.app_label, model.__name__))
+        pointers = bool(cache_settings.get("pointers"))
+        key_lookups = lookups
+        if pointers and ("pk",) not in lookups:
+            key_lookups += (("pk",),)
+        set_attr("pointers", pointers)
+        set_attr("key_lookups", key_lookups)
+        set_attr("lookup_templates", tuple(
+            get_lookup_template(model, lookup) for lookup in key_lookups))
+        key_attnames = set()
+        for lookup_template in self.lookup_templates:
+            if lookup_template is not None:
+                key_attnames.update(lookup_template[1])
+        set_attr("key_fields", tuple(
+            field for field in model._meta.fields if field.attname in key_attnames))
+        set_attr("fill_lock", get_fill_lock_settings(cache_settings.get("fill_lock")))
+        set_attr("stale_ttl", cache_settings.get("stale_ttl"))
+        set_attr("compression", get_compression_settings(
+            cache_settings.get("compression", cachetree_settings.COMPRESSION)))
+        set_attr("serializer", get_serializer_by_name(
+            cache_settings.get("serializer", cachetree_settings.SERIALIZER)))
+        set_attr("ignore_fields", get_ignore_fields(model, cache_settings.get("ignore_fields")))
+        set_attr("write_through", bool(cache_settings.get("write_through")))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def allows(self, kwargs):
+        """Returns True if the ``kwargs`` match one of the lookups.
+        """
+        return frozenset(kwargs) in self.lookup_signatures
+
+    def make_key(self, kwargs):
+        """Returns the cache key for the ``kwargs``. Equivalent to
+        generate_base_key(self.model, **kwargs).
+        """
+        return make_key(self.get_key_prefix(), kwargs)
+
+    def make_pk_key(self, pk):
+        """Returns the key of the tree of the instance with the ``pk``.
+        """
+        return make_key_from_raw("%spk:%s" % (self.get_key_prefix(), pk), 1)
+
+    def get_key_prefix(self):
+        """Returns the ``key_prefix`` followed by the model's current key
+        generation.
+        """
+        return get_key_prefix(self.model, self.key_prefix)
+
+    def make_instance_keys(self, instances, changed_attnames=None):
+        """Returns the cache keys of every one of the ``key_lookups`` for
+        each of the ``instances``, using their current field values, or, if
+        ``changed_attnames`` are given, of only the lookups on any of them.
+        """
+        keys = list()
+        key_prefix = self.get_key_prefix()
+        for lookup, lookup_template in zip(self.key_lookups, self.lookup_templates):
+            if lookup_template is None:
+                raise ImproperlyConfigured(
+                    "Cannot generate the %s.%s keys of lookup %s from instances." % (
+                        self.model._meta.app_label, self.model.__name__, ", ".join(lookup)))
+            template, attnames = lookup_template
+            if changed_attnames is not None and not set(attnames).intersection(changed_attnames):
+                continue
+            field_count = len(attnames)
+            if field_count == 1:
+                attname = attnames[0]
+                for instance in instances:
+                    keys.append(make_key_from_raw(
+                        key_prefix + template % getattr(instance, attname), 1))
+            else:
+                for instance in instances:
+                    raw_key = key_prefix + template % tuple(
+                        [getattr(instance, attname) for attname in attnames])
+                    keys.append(make_key_from_raw(raw_key, field_count))
+        return keys
+
+########################################################################
+
+def get_lookup_template(model, lookup):
+    """Returns a tuple of the raw key template for the ``lookup``, without
+    the key prefix, with the fields in the order make_key uses, and the
+    attnames whose values fill it in. Returns None if the lookup includes
+    names that aren't concrete fields of the ``model``.
+    """
+    parts = list()
+    attnames = list()
+    for name in sorted(lookup):
+        if name == "pk":
+            field = model._meta.pk
+        else:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+        parts.append("%s:%%s" % name)
+        attnames.append(field.attname)
+    return ";".join(parts), tuple(attnames)
+
+########################################################################
+
+def get_select_related(model, attrs):
+    """Returns the select_related arguments needed to follow the forward
+    ForeignKeys and OneToOneFields in the ``attrs`` tree from ``model``.
+    """
+    opts = model._meta
+    related = list()
+    for attr_name, child_attrs in attrs.iteritems():
+        try:
+            field = opts.get_field(attr_name)
+        except FieldDoesNotExist:
+            pass
+        else:
+            # Many to many fields can't be followed by select_related.
+            if field in opts.many_to_many:
+                continue
+            if select_related_descend(field, False, []):
+                if child_attrs:
+                    subrelated = get_select_related(field.rel.to, child_attrs)
+                    if subrelated:
+                        for entry in subrelated:
+                            related.append('%s__%s' % (attr_name, entry))
+                    else:
+                        related.append(attr_name)
+                else:
+                    related.append(attr_name)
+    return related
+
+########################################################################
+
+def get_ignore_fields(model, field_names):
+    """Returns a frozenset of the attnames of the ``model``'s fields named in
+    the ``ignore_fields`` setting. Raises ImproperlyConfigured if any of
+    them aren't concrete fields of the model.
+    """
+    attnames = set()
+    for name in field_names or ():
+        try:
+            field = model._meta.get_field(name, many_to_many=False)
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured(
+                "Cannot ignore %s.%s.%s, which isn't a concrete field." % (
+                    model._meta.app_label, model.__name__, name))
+        attnames.add(field.attname)
+    return frozenset(attnames)
+
+def get_fill_lock_settings(fill_lock):
+    """Returns the ``fill_lock`` setting (True, or a dictionary overriding
+    some of FILL_LOCK_DEFAULTS) as a FrozenDict, or None if it is disabled.
+    """
+    if not fill_lock:
+        return None
+    fill_lock_settings = dict(FILL_LOCK_DEFAULTS)
+    if isinstance(fill_lock, dict):
+        fill_lock_settings.update(fill_lock)
+    return FrozenDict(fill_lock_settings)
+
+def get_compression_settings(compression):
+    """Returns the ``compression`` setting (True, or a dictionary overriding
+    some of COMPRESSION_DEFAULTS) as a FrozenDict, or None if it is
+    disabled.
+    """
+    if not compression:
+        return None
+    compression_settings = dict(COMPRESSION_DEFAULTS)
+    if isinstance(compression, dict):
+        compression_settings.update(compression)
+    return FrozenDict(compression_settings)
+
+########################################################################
+
+def compile_plans():
+    """Compiles a CachePlan for each model in the CACHETREE setting.
+    """
+    PLANS.clear()
+    for app_label, model in get_cached_models():
+        PLANS[model] = CachePlan(model, get_cache_settings(model))
+
+########################################################################
+
+def get_cache_plan(model):
+    """Returns the CachePlan for the ``model``. Raises ValueError if the model
+    is not in the CACHETREE setting.
+    """
+    try:
+        return PLANS[model]
+    except KeyError:
+        plan = PLANS[model] = CachePlan(model, get_cache_settings(model))
+        return plan
+
+########################################################################
@@ -0,0 +1,106 @@
+"""
+Cachetree Refresh
+"""
+
+########################################################################
+
+import logging
+import threading
+import Queue
+from django.db import close_connection
+
+logger = logging.getLogger("cachetree")
+
+########################################################################
+
+class Refresher(object):
+    """Runs the refreshes of stale trees on a bounded pool of daemon threads.
+    Refreshes are dropped when ``queue_size`` of them are already waiting,
+    since the stale tree will be served (and its refresh scheduled again)
+    on a later read. With ``threads`` set to 0, refreshes run in the
+    calling thread.
+    """
+
+    def __init__(self, threads=2, queue_size=100):
+        self._lock = threading.Lock()
+        self._queue = None
+        self.configure(threads, queue_size)
+
+    def configure(self, threads=2, queue_size=100):
+        """Stops the current threads, if any, and changes the settings used to
+        start new ones.
+        """
+        self.stop()
+        self.threads = threads
+        self.queue_size = queue_size
+
+    ####################################################################
+
+    def schedule(self, function):
+        """Schedules a call to ``function``. Returns False if the call was
+        dropped.
+        """
+        if not self.threads:
+            function()
+            return True
+        # Holding the lock keeps stop() from retiring the queue between the
+        # check and the put, which would leave the call on a queue no thread
+        # reads.
+        self._lock.acquire()
+        try:
+            queue = self._queue
+            if queue is None:
+                queue = self._start()
+            try:
+                queue.put_nowait(function)
+            except Queue.Full:
+                return False
+            return True
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """Stops the threads once the refreshes already scheduled have run.
+        """
+        self._lock.acquire()
+        try:
+            if self._queue is not None:
+                for i in xrange(self.threads):
+                    self._queue.put(None)
+                self._queue = None
+        finally:
+            self._lock.release()
+
+    ####################################################################
+
+    def _start(self):
+        # Called with the lock held.
+        queue = self._queue = Queue.Queue(self.queue_size)
+        for i in xrange(self.threads):
+            thread = threading.Thread(target=self._work, args=(queue,),
+                                      name="cachetree-refresh-%s" % i)
+            thread.setDaemon(True)
+            thread.start()
+        return queue
+
+    @staticmethod
+    def _work(queue):
+        while True:
+            function = queue.get()
+            if function is None:
+                return
+            try:
+                function()
+            except Exception:
+                # The stale tree stays in the cache, and its refresh will be
+                # scheduled again on a later read.
+                logger.exception("Error refreshing a stale cachetree tree")
+            finally:
+                # Don't leave this thread's connection idle in a transaction.
+                close_connection()
+
+########################################################################
+
+refresher = Refresher()
+
+########################################################################
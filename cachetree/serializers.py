@@ -0,0 +1,364 @@
+"""
+Cachetree Serializers
+"""
+
+########################################################################
+
+import marshal
+import zlib
+from itertools import izip
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.db.models import Model
+from django.db.models.base import ModelState
+from django.db.models.signals import post_init
+from django.db.models.loading import get_model
+from django.db.models.query import QuerySet
+from django.dispatch.dispatcher import _make_id
+from django.utils.importlib import import_module
+from exceptions import ImproperlyConfigured
+import settings as cachetree_settings
+
+########################################################################
+
+class UnserializableTree(Exception):
+    """Raised by a serializer that can't serialize a tree, which is then
+    serialized by the serializer class named by its ``fallback`` attribute.
+    """
+
+########################################################################
+
+class PickleSerializer(object):
+    """Serializes trees as pickled model instances.
+    """
+
+    id = 1
+
+    fallback = None
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+########################################################################
+
+class RowSerializer(object):
+    """Serializes a tree of model instances as a tuple of model classes and
+    a list of rows, one per instance, without pickling the instances
+    themselves. Each row is a ``(model_index, db, values, links)`` tuple:
+
+    ``values``
+        The values of the model's concrete fields, in the order of
+        ``_meta.fields``. The instance is rebuilt from them as
+        ``Model(*values)`` would, sending ``post_init`` once.
+    ``links``
+        A tuple of ``(name, kind, data)`` tuples for the rest of the
+        instance's ``__dict__``: related instances (``REF``, with the index
+        of the related instance's row), lists of related instances
+        (``LIST``, with the indexes of their rows), and any other value
+        (``VALUE``, pickled as it is).
+
+    Prefetched many related querysets are stored as lists of related
+    instances, and turned back into querysets the first time they are used.
+
+    The root instance's row comes first. Each instance has one row, however
+    many times it appears in the tree, so instances shared within the tree
+    (and reference cycles) are preserved.
+    """
+
+    id = 2
+
+    fallback = PickleSerializer
+
+    VALUE, REF, LIST = 0, 1, 2
+
+    # Attributes that are rebuilt, not stored: ``_state`` is rebuilt from the
+    # row's ``db``, and ``_orig_state`` by invalidation's post_init handler.
+    REBUILT_ATTRIBUTES = frozenset(["_state", "_orig_state"])
+
+    def __init__(self):
+        # Maps each (model, CACHETREE_MANY_RELATED_PREFIX) pair to a tuple
+        # of the model's concrete field attnames, the set of its attributes
+        # that aren't links, and the set of its prefetched many related
+        # attribute names.
+        self._model_info = {}
+
+    ####################################################################
+
+    def _get_model_info(self, model):
+        prefix = cachetree_settings.CACHETREE_MANY_RELATED_PREFIX
+        info = self._model_info.get((model, prefix))
+        if info is None:
+            opts = model._meta
+            attnames = tuple(field.attname for field in opts.fields)
+            # Symmetrical many to many relations have no accessor name.
+            many_names = [related.get_accessor_name() for related in
+                          opts.get_all_related_objects() + opts.get_all_related_many_to_many_objects()]
+            many_names.extend(field.name for field in opts.many_to_many)
+            info = self._model_info[(model, prefix)] = (
+                attnames,
+                self.REBUILT_ATTRIBUTES.union(attnames),
+                frozenset(prefix + name for name in many_names if name))
+        return info
+
+    ####################################################################
+
+    def dumps(self, obj):
+        models, rows = self.get_rows(obj)
+        return pickle.dumps((models, rows), pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        models, rows = pickle.loads(data)
+        return self.build_tree(models, rows)
+
+    ####################################################################
+
+    def get_rows(self, obj):
+        """Returns a tuple of the model classes in the tree ``obj`` and a
+        list of its rows.
+        """
+        if not isinstance(obj, Model):
+            raise UnserializableTree("%r is not a model instance" % obj)
+
+        models = list()
+        model_indexes = dict()
+        instances = [obj]
+        instance_indexes = {id(obj): 0}
+        rows = list()
+
+        def ref(instance):
+            index = instance_indexes.get(id(instance))
+            if index is None:
+                index = instance_indexes[id(instance)] = len(instances)
+                instances.append(instance)
+            return index
+
+        # instances grows as new related instances are found.
+        for instance in instances:
+            model = instance.__class__
+            model_index = model_indexes.get(model)
+            if model_index is None:
+                model_index = model_indexes[model] = len(models)
+                models.append(model)
+            attnames, skipped_names, many_names = self._get_model_info(model)
+
+            instance_dict = instance.__dict__
+            try:
+                values = tuple([instance_dict[attname] for attname in attnames])
+            except KeyError:
+                # Instances with deferred fields can't be rebuilt from rows.
+                raise UnserializableTree("%r has deferred fields" % instance)
+
+            links = list()
+            for name, value in instance_dict.iteritems():
+                if name in skipped_names:
+                    continue
+                if isinstance(value, Model):
+                    links.append((name, self.REF, ref(value)))
+                elif (name in many_names and isinstance(value, QuerySet)
+                      and value._result_cache is not None):
+                    links.append((name, self.LIST, tuple([ref(related) for related in value._result_cache])))
+                elif (isinstance(value, list) and value
+                      and all(isinstance(related, Model) for related in value)):
+                    links.append((name, self.LIST, tuple([ref(related) for related in value])))
+                else:
+                    links.append((name, self.VALUE, value))
+
+            rows.append((model_index, instance._state.db, values, tuple(links)))
+
+        return tuple(models), rows
+
+    def build_tree(self, models, rows):
+        """Rebuilds the tree from the ``models`` and ``rows`` returned by
+        get_rows, and returns its root instance.
+        """
+        # Rebuild the instances the way Model.__init__ would, without its
+        # per-field setattr calls, and look up each model's post_init
+        # receivers once instead of once per instance.
+        model_info = [(model, self._get_model_info(model)[0],
+                       post_init._live_receivers(_make_id(model)))
+                      for model in models]
+        instances = list()
+        for model_index, db, values, links in rows:
+            model, attnames, receivers = model_info[model_index]
+            instance = model.__new__(model)
+            instance.__dict__ = dict(izip(attnames, values))
+            state = instance._state = ModelState(db)
+            state.adding = False
+            for receiver in receivers:
+                receiver(signal=post_init, sender=model, instance=instance)
+            instances.append(instance)
+
+        REF, LIST = self.REF, self.LIST
+        for instance, row in izip(instances, rows):
+            instance_dict = instance.__dict__
+            for name, kind, value in row[3]:
+                if kind == REF:
+                    instance_dict[name] = instances[value]
+                elif kind == LIST:
+                    instance_dict[name] = [instances[index] for index in value]
+                else:
+                    instance_dict[name] = value
+
+        return instances[0]
+
+########################################################################
+
+class MarshalRowSerializer(RowSerializer):
+    """Serializes trees like RowSerializer, but with marshal instead of
+    pickle, storing models by label. Marshal is faster than pickle but only
+    handles built-in types, so trees with other values (such as dates or
+    decimals) are serialized by RowSerializer instead.
+    """
+
+    id = 3
+
+    fallback = RowSerializer
+
+    def __init__(self):
+        super(MarshalRowSerializer, self).__init__()
+        # Maps each (app_label, model name) label to its model.
+        self._models = {}
+
+    def dumps(self, obj):
+        models, rows = self.get_rows(obj)
+        labels = tuple([(model._meta.app_label, model.__name__) for model in models])
+        try:
+            return marshal.dumps((labels, rows))
+        except ValueError, e:
+            raise UnserializableTree(str(e))
+
+    def loads(self, data):
+        labels, rows = marshal.loads(data)
+        models = list()
+        for label in labels:
+            model = self._models.get(label)
+            if model is None:
+                model = self._models[label] = get_model(*label)
+            models.append(model)
+        return self.build_tree(models, rows)
+
+########################################################################
+
+# Maps each serializer's id, which is stored in the header byte of every
+# value it serializes, to the serializer.
+SERIALIZERS = {}
+
+# Set in the header byte of compressed values.
+COMPRESSED = 0x80
+
+# The values that cached DoesNotExist and MultipleObjectsReturned errors are
+# serialized as. Their header byte, 0, isn't the id of any serializer.
+DOES_NOT_EXIST = "\x00D"
+MULTIPLE_OBJECTS_RETURNED = "\x00M"
+
+def get_serializer(serializer_class):
+    """Returns the instance of the ``serializer_class``, registering it if
+    necessary. A serializer class has an ``id`` between 1 and 127, which
+    identifies the values it serializes, a ``fallback`` serializer class
+    (or None), and ``dumps(obj)`` and ``loads(data)`` methods; ``dumps``
+    returns a string, or raises UnserializableTree to have the tree
+    serialized by the fallback.
+    """
+    serializer = SERIALIZERS.get(serializer_class.id)
+    if serializer is None:
+        if not 0 < serializer_class.id < COMPRESSED:
+            raise ImproperlyConfigured(
+                "Serializer %s has id %s. Ids must be between 1 and %s." % (
+                    serializer_class.__name__, serializer_class.id, COMPRESSED - 1))
+        serializer = SERIALIZERS[serializer_class.id] = serializer_class()
+    elif serializer.__class__ is not serializer_class:
+        raise ImproperlyConfigured(
+            "Serializers %s and %s have the same id, %s." % (
+                serializer.__class__.__name__, serializer_class.__name__, serializer_class.id))
+    return serializer
+
+pickle_serializer = get_serializer(PickleSerializer)
+row_serializer = get_serializer(RowSerializer)
+marshal_serializer = get_serializer(MarshalRowSerializer)
+
+# The serializers that can be named in the "serializer" setting.
+BUILTIN_SERIALIZERS = {
+    "pickle": pickle_serializer,
+    "row": row_serializer,
+    "marshal": marshal_serializer,
+}
+
+def get_serializer_by_name(name):
+    """Returns the serializer for the "serializer" setting ``name``: one of
+    the BUILTIN_SERIALIZERS, or the dotted path to a serializer class.
+    """
+    if name in BUILTIN_SERIALIZERS:
+        return BUILTIN_SERIALIZERS[name]
+    module_name, dot, class_name = name.rpartition(".")
+    try:
+        serializer_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError):
+        raise ImproperlyConfigured(
+            'Serializer "%s" is not one of %s or the path to a serializer class.' % (
+                name, ", ".join(sorted(BUILTIN_SERIALIZERS))))
+    return get_serializer(serializer_class)
+
+########################################################################
+
+def dumps(obj, serializer=row_serializer, compression=None):
+    """Serializes the tree ``obj`` with the ``serializer``, or, if it can't
+    serialize it, with the first of its fallbacks that can. If
+    ``compression`` settings are given (a dictionary of ``threshold`` and
+    ``level``), serialized trees of at least ``threshold`` bytes are
+    compressed with zlib. Returns a string whose first byte identifies the
+    serializer and whether the rest is compressed.
+
+    DoesNotExist and MultipleObjectsReturned errors are serialized as
+    DOES_NOT_EXIST and MULTIPLE_OBJECTS_RETURNED.
+    """
+    if isinstance(obj, ObjectDoesNotExist):
+        return DOES_NOT_EXIST
+    if isinstance(obj, MultipleObjectsReturned):
+        return MULTIPLE_OBJECTS_RETURNED
+    while True:
+        try:
+            data = serializer.dumps(obj)
+        except UnserializableTree:
+            serializer = get_serializer(serializer.fallback)
+        else:
+            break
+    header = serializer.id
+    if compression is not None and len(data) >= compression["threshold"]:
+        compressed = zlib.compress(data, compression["level"])
+        if len(compressed) < len(data):
+            data = compressed
+            header |= COMPRESSED
+    return chr(header) + data
+
+def loads(value):
+    """Returns the tree serialized by dumps in ``value``. Any other value,
+    such as a tree cached by an earlier version of cachetree, is returned as
+    it is.
+    """
+    if not isinstance(value, str) or not value:
+        return value
+    if value == DOES_NOT_EXIST:
+        return ObjectDoesNotExist()
+    if value == MULTIPLE_OBJECTS_RETURNED:
+        return MultipleObjectsReturned()
+    header = ord(value[0])
+    serializer = SERIALIZERS.get(header & ~COMPRESSED)
+    if serializer is None:
+        return value
+    if header & COMPRESSED:
+        return serializer.loads(zlib.decompress(value[1:]))
+    return serializer.loads(value[1:])
+
+def is_negative(value):
+    """Returns True if the serialized ``value`` is a cached DoesNotExist or
+    MultipleObjectsReturned error.
+    """
+    return value == DOES_NOT_EXIST or value == MULTIPLE_OBJECTS_RETURNED
+
+########################################################################
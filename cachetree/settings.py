@@ -4,3 +4,12 @@ CACHETREE_MANY_RELATED_PREFIX = getattr(django_settings, "CACHETREE_MANY_RELATED
 INVALIDATE = getattr(django_settings, "CACHETREE_INVALIDATE", True)
 DISABLE = getattr(django_settings, "CACHETREE_DISABLE", False)
 CACHETREE = getattr(django_settings, "CACHETREE", {})
+LOCAL_CACHE = getattr(django_settings, "CACHETREE_LOCAL_CACHE", None)
+STALE_REFRESH = getattr(django_settings, "CACHETREE_STALE_REFRESH", None)
+COMPRESSION = getattr(django_settings, "CACHETREE_COMPRESSION", None)
+SERIALIZER = getattr(django_settings, "CACHETREE_SERIALIZER", "row")
+NEGATIVE_TIMEOUT = getattr(django_settings, "CACHETREE_NEGATIVE_TIMEOUT", None)
+NEGATIVE_FILTER = getattr(django_settings, "CACHETREE_NEGATIVE_FILTER", None)
+GENERATION_CHECK_INTERVAL = getattr(django_settings, "CACHETREE_GENERATION_CHECK_INTERVAL", 1)
+DEFER_INVALIDATION = getattr(django_settings, "CACHETREE_DEFER_INVALIDATION", None)
+ASYNC_INVALIDATION = getattr(django_settings, "CACHETREE_ASYNC_INVALIDATION", None)
@@ -0,0 +1,45 @@
+"""
+Cachetree Stats
+"""
+
+########################################################################
+
+import threading
+
+########################################################################
+
+_lock = threading.Lock()
+_counters = {}
+
+########################################################################
+
+def incr(model, name, count=1):
+    """Increments the ``model``'s counter called ``name`` by ``count``.
+    """
+    label = "%s.%s" % (model._meta.app_label, model.__name__)
+    _lock.acquire()
+    try:
+        model_counters = _counters.setdefault(label, {})
+        model_counters[name] = model_counters.get(name, 0) + count
+    finally:
+        _lock.release()
+
+def get_stats():
+    """Returns the counters of this process, as a dictionary mapping each
+    model's "app_label.Model" label to a dictionary of its counters.
+    """
+    _lock.acquire()
+    try:
+        return dict((label, dict(model_counters)) 
+                    for label, model_counters in _counters.iteritems())
+    finally:
+        _lock.release()
+
+def reset_stats():
+    _lock.acquire()
+    try:
+        _counters.clear()
+    finally:
+        _lock.release()
+
+########################################################################
@@ -3,23 +3,38 @@
 ########################################################################
 
 from __future__ import with_statement
+import threading
+from decimal import Decimal
 import time
 from copy import deepcopy
-from django.db import models
+from django.db import models, connection
+from django.db.models.signals import post_init, post_save
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
 from django.test import TestCase
 from django.utils.unittest import skipUnless, SkipTest
 from django.conf import settings as django_settings
+from django.http import HttpRequest, HttpResponse
 from django.core.cache import get_cache, DEFAULT_CACHE_ALIAS
 from django.core.cache.backends import locmem
-from . import install, uninstall, _Installer
-from cache import cache
+from . import (install, uninstall, _Installer, get_stats, reset_stats, invalidate_model,
+               bulk_update, bulk_delete, bulk_create, BulkInvalidationManagerMixin,
+               batch_invalidation)
+from cache import (cache, tree_cache, key_generations, get_side_key, incr_counter, LocalCache,
+                   IdentityMap)
+from middleware import IdentityMapMiddleware
+from refresh import Refresher
+from bulk import _values_in_pk_chunks
 from auth import CachedModelBackend
 import settings as cachetree_settings
 from shortcuts import get_cached_object_or_404
 from exceptions import ImproperlyConfigured
-from invalidation import Invalidator, no_invalidation
+from invalidation import (Invalidator, InvalidationBatch, NoInvalidation, OriginalState,
+                          InvalidationQueue, no_invalidation, deferred_invalidation, 
+                          async_invalidation)
+from plans import PLANS
+import serializers
+from utils import generate_base_key, get_key_prefix
 
 ########################################################################
 
@@ -68,6 +83,12 @@ class EntryLink(models.Model):
     to_entry = models.ForeignKey("Entry", related_name="links_to")
     opens_new_window = models.BooleanField()
     
+class TestSerializer(serializers.PickleSerializer):
+    id = 100
+    
+class ConflictingSerializer(serializers.PickleSerializer):
+    id = serializers.PickleSerializer.id
+    
 ########################################################################
 
 class CachetreeBaseTestCase(TestCase):
@@ -156,7 +177,16 @@ class CachetreeBaseTestCase(TestCase):
         return dict(
             DISABLE=False,
             CACHETREE=self.CACHETREE,
-            INVALIDATE=False
+            INVALIDATE=False,
+            LOCAL_CACHE=None,
+            STALE_REFRESH=None,
+            COMPRESSION=None,
+            SERIALIZER="row",
+            NEGATIVE_TIMEOUT=None,
+            NEGATIVE_FILTER=None,
+            GENERATION_CHECK_INTERVAL=1,
+            DEFER_INVALIDATION=None,
+            ASYNC_INVALIDATION=None,
         )
         
     ####################################################################
@@ -234,7 +264,182 @@ class CachetreeTestCase(CachetreeBaseTestCase):
             Author.objects.get_cached(first_name="Joe", last_name="Blog")
             
     ####################################################################
-    
+
+    def test_get_many_cached(self):
+        """Tests that get_many_cached fills cache misses that share the same
+        lookup fields with a single query, and returns the instances in the
+        order they were requested.
+        """
+        Tag.objects.get_cached(name="views")
+        names = ["models", "views", "tests", "urls"]
+
+        # One query fills the 3 misses, and one query prefetches the
+        # entry_set of all 3 tags.
+        with self.assertNumQueries(2):
+            tags = Tag.objects.get_many_cached([dict(name=name) for name in names])
+        self.assertEqual([tag.name for tag in tags], names)
+
+        with self.assertNumQueries(0):
+            tags = Tag.objects.get_many_cached([dict(name=name) for name in names])
+        self.assertEqual([tag.name for tag in tags], names)
+
+    ####################################################################
+
+    def test_get_many_cached_multi_kwarg_lookup(self):
+        """Tests that get_many_cached batches multi-kwarg lookups.
+        """
+        Author.objects.get_many_cached([
+            dict(first_name="Joe", last_name="Blog"),
+            dict(first_name="Arthur", last_name="Smith"),
+        ])
+        with self.assertNumQueries(0):
+            authors = Author.objects.get_many_cached([
+                dict(first_name="Arthur", last_name="Smith"),
+                dict(first_name="Joe", last_name="Blog"),
+            ])
+        self.assertEqual([author.pk for author in authors], [2, 1])
+
+    ####################################################################
+
+    def test_get_many_cached_prefetches_by_level(self):
+        """Tests that get_many_cached prefetches each level of the tree for
+        all the root instances with a single query per relation.
+        """
+        # One query for the authors, and one each for the authorprofiles,
+        # the entries, and the comments (with their commenters).
+        with self.assertNumQueries(4):
+            authors = Author.objects.get_many_cached([dict(pk=1), dict(pk=2)])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(authors[0].authorprofile.city, "Asheville")
+            self.assertEqual(len(authors[1].entry_set.all()), 2)
+            first_entry = authors[0].entry_set.all()[0]
+            first_comment = first_entry.comment_set.all()[0]
+            self.assertEqual(first_comment.commenter.first_name, "Alice")
+
+    ####################################################################
+
+    def test_get_many_cached_prefetches_m2m_by_level(self):
+        """Tests that get_many_cached prefetches many to many relations
+        (forward and reverse, with auto-created and custom intermediary
+        tables) for all the root instances with a single query per relation,
+        and that each instance gets its own related instances.
+        """
+        titles = list(Entry.objects.order_by("pk").values_list("title", flat=True))
+        
+        # One query for the entries (with their authors), and one for each
+        # of the 7 many-related attributes.
+        with self.assertNumQueries(8):
+            entries = Entry.objects.get_many_cached([dict(title=title) for title in titles])
+        
+        attr_names = ("tags", "categories", "entrycategories", "linked_entries",
+                      "links_from", "linking_entries", "links_to")
+        expected = dict()
+        for entry in Entry.objects.all():
+            expected[entry.pk] = dict(
+                (attr_name, [obj.pk for obj in getattr(entry, attr_name).all()])
+                for attr_name in attr_names)
+        
+        with self.assertNumQueries(0):
+            for entry in entries:
+                for attr_name in attr_names:
+                    self.assertEqual(
+                        [obj.pk for obj in getattr(entry, attr_name).all()],
+                        expected[entry.pk][attr_name])
+        
+    ####################################################################
+
+    def test_get_many_cached_DoesNotExist(self):
+        """Tests that get_many_cached raises and caches DoesNotExist, while
+        still caching the instances that were found.
+        """
+        self.assertRaises(
+            Tag.DoesNotExist,
+            Tag.objects.get_many_cached,
+            [dict(name="models"), dict(name="invalid tag")]
+        )
+
+        with self.assertNumQueries(0):
+            Tag.objects.get_cached(name="models")
+            self.assertRaises(
+                Tag.DoesNotExist,
+                Tag.objects.get_cached,
+                name="invalid tag"
+            )
+
+    ####################################################################
+
+    def test_get_many_cached_misses(self):
+        """Tests that get_many_cached caches the misses of single-field
+        lookups that the batch query didn't match without looking each one
+        up, unless their values may match the same instance.
+        """
+        with self.assertNumQueries(1):
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_many_cached,
+                              [dict(name="invalid tag"), dict(name="other tag")])
+        with self.assertNumQueries(0):
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="other tag")
+
+        # Values that only differ by case are looked up one at a time.
+        with self.assertNumQueries(3):
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_many_cached,
+                              [dict(name="Missing"), dict(name="missing")])
+
+    ####################################################################
+
+    def test_cache_plan(self):
+        """Tests that install() compiles an immutable cache plan for each
+        cached model.
+        """
+        plan = PLANS[Author]
+        self.assertEqual(plan.lookup_signatures, frozenset([
+            frozenset(["pk"]), frozenset(["first_name", "last_name"])]))
+        self.assertEqual(plan.key_prefix, "cachetree.Author.")
+        self.assertEqual(plan.make_key(dict(pk=1)), generate_base_key(Author, pk=1))
+        self.assertEqual(PLANS[AuthorProfile].select_related, ("author",))
+
+        self.assertRaises(AttributeError, setattr, plan, "timeout", 1)
+        self.assertRaises(TypeError, plan.prefetch.__setitem__, "entry_set", {})
+        self.assertRaises(TypeError, plan.prefetch["entry_set"].pop, "comment_set")
+
+    ####################################################################
+
+    def test_generate_base_key(self):
+        """Tests that short keys with safe characters are not hashed, and
+        that other keys are.
+        """
+        prefix = get_key_prefix(Author)
+        self.assertTrue(prefix.startswith("cachetree.Author.g"))
+        self.assertEqual(generate_base_key(Author, pk=1), "cachetree:%spk:1" % prefix)
+        self.assertEqual(generate_base_key(Author, last_name="Smith", first_name="Joe"), 
+                         "cachetree:%sfirst_name:Joe;last_name:Smith" % prefix)
+        author = Author.objects.get(pk=1)
+        self.assertEqual(generate_base_key(AuthorProfile, author=author), 
+                         "cachetree:%sauthor:1" % get_key_prefix(AuthorProfile))
+        
+        for kwargs in (dict(first_name="Joe Bob", last_name="Smith"),
+                       dict(first_name="Joe;last_name:Smith", last_name=""),
+                       dict(first_name=u"Jos\xe9", last_name="Smith"),
+                       dict(first_name="Joe" * 100, last_name="Smith")):
+            key = generate_base_key(Author, **kwargs)
+            self.assertTrue(key.startswith("cachetree.%sfirst_name:" % prefix))
+            self.assertTrue(len(key) <= 250)
+
+    ####################################################################
+
+    def test_make_instance_keys(self):
+        """Tests that a cache plan generates the same keys from instances as
+        from lookup kwargs.
+        """
+        plan = PLANS[Author]
+        authors = list(Author.objects.all())
+        self.assertEqual(plan.make_instance_keys(authors), 
+            [plan.make_key(dict(pk=author.pk)) for author in authors] + 
+            [plan.make_key(dict(first_name=author.first_name, last_name=author.last_name)) 
+             for author in authors])
+
+    ####################################################################
+
     def test_one_to_one_field_lookup(self):
         """Tests caching a root instance using a one to one field lookup.
         """
@@ -848,20 +1053,324 @@ class CachetreeInvalidationTestCase(CachetreeBaseTestCase):
         
         commenter.first_name = "Linda"
         
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             
             commenter.save(force_update=True)
             # This triggers the following queries: 
             # UPDATE cachetree_commenter SET first_name = Linda WHERE cachetree_commenter.id = 6
-            # The following query will run twice, once for the original state of 
-            # commenter and once for the new state, because they're different (even 
-            # though the commenter_id did not change):
-            # SELECT * FROM cachetree_comment WHERE cachetree_comment.commenter_id = 6
-            # SELECT * FROM cachetree_comment WHERE cachetree_comment.commenter_id = 6
-            # This will return 1 comment, and since the comment is unchanged, 
-            # the following query should not be duplicated:
-            # SELECT * FROM cachetree_entry WHERE cachetree_entry.id = 5
-            # The entry this returns will then be invalidated.
+            # The original state of commenter and its new state are followed
+            # together, on the commenter_id they share, so the comments are
+            # only queried once, for the entry ids the next step needs:
+            # SELECT entry_id FROM cachetree_comment WHERE cachetree_comment.commenter_id IN (6)
+            # This will return 1 entry id, and since the entry is unchanged,
+            # only the fields its keys are made from are loaded:
+            # SELECT id, title FROM cachetree_entry WHERE cachetree_entry.id IN (5)
+            # The entry will then be invalidated.
+        
+    ####################################################################
+    
+    def test_original_state_snapshot(self):
+        """Tests the snapshot of an instance's original field values, which
+        of its fields are tracked, and that the original versions of changed
+        instances are made without sending post_init.
+        """
+        self.assertEqual(Invalidator.get_tracked_attnames(Author), 
+                         frozenset(["first_name", "id", "last_name"]))
+        self.assertEqual(Invalidator.get_tracked_attnames(Commenter), frozenset(["id"]))
+        self.assertEqual(Invalidator.get_tracked_attnames(Comment), frozenset(["entry_id", "id"]))
+        
+        comment = Comment.objects.get(pk=1)
+        entry_id = comment.entry_id
+        orig_state = comment._orig_state
+        self.assertTrue(isinstance(orig_state, OriginalState))
+        self.assertEqual(orig_state.values, tuple(
+            [getattr(comment, field.attname) for field in Comment._meta.fields]))
+        tracked_attnames = Invalidator.get_tracked_attnames(Comment)
+        self.assertFalse(orig_state.has_changed(comment))
+        comment.comment = "Edited"
+        self.assertTrue(orig_state.has_changed(comment))
+        self.assertEqual(orig_state.get_changed_attnames(comment, tracked_attnames), [])
+        comment.entry_id = entry_id + 1
+        self.assertEqual(orig_state.get_changed_attnames(comment, tracked_attnames), ["entry_id"])
+        
+        instances_initialized = []
+        def count_init(sender, instance, **kwargs):
+            instances_initialized.append(instance)
+        post_init.connect(count_init)
+        try:
+            orig = orig_state.make_original(comment)
+        finally:
+            post_init.disconnect(count_init)
+        self.assertEqual(instances_initialized, [])
+        self.assertEqual(orig.entry_id, entry_id)
+        self.assertNotEqual(orig.comment, "Edited")
+        
+    ####################################################################
+    
+    def test_skip_unchanged_save(self):
+        """Tests that saving an instance that hasn't changed doesn't
+        invalidate anything, that changing only untracked fields doesn't
+        follow or generate the keys of the original version, and that both
+        are counted.
+        """
+        reset_stats()
+        Author.objects.get_cached(pk=1)
+        commenter = Commenter.objects.get(pk=1)
+        # Only the queries of the save itself.
+        with self.assertNumQueries(2):
+            commenter.save()
+        with self.assertNumQueries(0):
+            Author.objects.get_cached(pk=1)
+        self.assertEqual(get_stats()["cachetree.Commenter"]["invalidations_skipped"], 1)
+        
+        # An instance that wasn't loaded may not hold the row's values.
+        Commenter(pk=1, first_name="Bob").save()
+        self.assertEqual(get_stats()["cachetree.Commenter"]["invalidations_skipped"], 1)
+        author = Author.objects.get_cached(pk=1)
+        self.assertTrue("Bob" in [comment.commenter.first_name for entry in author.entry_set.all()
+                                  for comment in entry.comment_set.all()])
+        
+        # Changing the name only adds the original version's key of the name
+        # lookup, not its pk key again.
+        author = Author.objects.get(pk=1)
+        author.first_name = "Bob"
+        batch = InvalidationBatch()
+        batch.add_root_instances([author])
+        self.assertTrue(generate_base_key(Author, first_name="Joe", last_name="Blog") in batch.keys)
+        self.assertEqual(len(batch.keys), 3)
+        comment = Comment.objects.get(pk=1)
+        comment.comment = "Edited"
+        comment.save()
+        self.assertEqual(get_stats()["cachetree.Comment"]["invalidations_pruned"], 1)
+        
+    ####################################################################
+    
+    def test_old_orig_state(self):
+        """Tests that an instance cached by an earlier version, whose original
+        state was pickled as a plain copy of its __dict__, is invalidated in
+        full when it is saved.
+        """
+        author = Author.objects.get(pk=1)
+        state = author.__dict__.copy()
+        del state["_orig_state"]
+        author._orig_state = state
+        cache.set(generate_base_key(Author, pk=1), author)
+        
+        author = Author.objects.get_cached(pk=1)
+        self.assertTrue(isinstance(author._orig_state, dict))
+        author.save()
+        self.assertEqual(cache.get(generate_base_key(Author, pk=1)), None)
+        
+    ####################################################################
+    
+    def test_ignore_fields(self):
+        """Tests that a save that only changes fields in the model's
+        ``ignore_fields`` setting doesn't invalidate anything, and is
+        counted, but that a save that also changes other fields does.
+        """
+        CACHETREE = deepcopy(self.CACHETREE)
+        CACHETREE["cachetree"]["Entry"]["ignore_fields"] = ("content",)
+        self.reinstall(dict(CACHETREE=CACHETREE))
+        reset_stats()
+        
+        Author.objects.get_cached(pk=1)
+        entry = Entry.objects.get_cached(title="Mapping URLs to Views in Django")
+        entry.content = "Edited"
+        entry.save()
+        with self.assertNumQueries(0):
+            Author.objects.get_cached(pk=1)
+            Entry.objects.get_cached(title="Mapping URLs to Views in Django")
+        self.assertEqual(get_stats()["cachetree.Entry"]["invalidations_ignored"], 1)
+        
+        entry.content = "Edited again"
+        entry.title = "Mapping URLs"
+        entry.save()
+        self.assertRaises(Entry.DoesNotExist, Entry.objects.get_cached,
+                          title="Mapping URLs to Views in Django")
+        entry = Entry.objects.get_cached(title="Mapping URLs")
+        self.assertEqual(entry.content, "Edited again")
+        self.assertEqual(get_stats()["cachetree.Entry"]["invalidations_ignored"], 1)
+        
+        uninstall()
+        CACHETREE["cachetree"]["Entry"]["ignore_fields"] = ("tags",)
+        self.change_settings(dict(CACHETREE=CACHETREE))
+        self.assertRaises(ImproperlyConfigured, install)
+        
+    ####################################################################
+    
+    def test_write_through(self):
+        """Tests that, with write_through, saving, creating and deleting an
+        instance in a cached tree patches it into the tree at every key of
+        the root instance, without deleting it, and that changes that move
+        the instance in the tree delete the tree instead.
+        """
+        CACHETREE = deepcopy(self.CACHETREE)
+        CACHETREE["cachetree"]["Author"]["write_through"] = True
+        self.reinstall(dict(CACHETREE=CACHETREE))
+        reset_stats()
+        
+        def get_comments(author):
+            return dict((comment.pk, comment) for entry in author.entry_set.all()
+                        for comment in entry.comment_set.all())
+        
+        Author.objects.get_cached(pk=1)
+        Author.objects.get_cached(first_name="Joe", last_name="Blog")
+        comment = Comment.objects.get(pk=1)
+        comment.comment = "Edited"
+        comment.save()
+        with self.assertNumQueries(0):
+            for author in (Author.objects.get_cached(pk=1), 
+                           Author.objects.get_cached(first_name="Joe", last_name="Blog")):
+                self.assertEqual(get_comments(author)[1].comment, "Edited")
+        self.assertEqual(get_stats()["cachetree.Author"]["patches"], 2)
+        
+        comment = Comment.objects.create(entry_id=1, commenter_id=3, comment="New")
+        Comment.objects.get(pk=2).delete()
+        with self.assertNumQueries(0):
+            comments = get_comments(Author.objects.get_cached(pk=1))
+            self.assertEqual(comments[comment.pk].commenter.first_name, "Ryan")
+            self.assertFalse(2 in comments)
+        self.assertEqual(get_stats()["cachetree.Author"]["patches"], 6)
+        
+        # Moving a comment to another author's entry deletes both trees.
+        Author.objects.get_cached(pk=2)
+        comment = Comment.objects.get(pk=5)
+        comment.entry_id = 1
+        comment.save()
+        for pk in (1, 2):
+            self.assertEqual(cache.get(generate_base_key(Author, pk=pk)), None)
+        self.assertTrue(5 in get_comments(Author.objects.get_cached(pk=1)))
+    
+    ####################################################################
+    
+    def test_write_through_ordering(self):
+        """Tests that, with write_through, saving an instance with changes to
+        the fields its list is ordered by deletes the tree instead of
+        patching it, and that other changes are still patched.
+        """
+        CACHETREE = deepcopy(self.CACHETREE)
+        CACHETREE["cachetree"]["Author"]["write_through"] = True
+        self.reinstall(dict(CACHETREE=CACHETREE))
+        reset_stats()
+        key = generate_base_key(Author, pk=1)
+        
+        ordering = Comment._meta.ordering
+        Comment._meta.ordering = ["comment"]
+        try:
+            Author.objects.get_cached(pk=1)
+            comment = Comment.objects.get(pk=1)
+            comment.comment = "Edited"
+            comment.save()
+            self.assertEqual(cache.get(key), None)
+            self.assertFalse("patches" in get_stats().get("cachetree.Author", {}))
+            
+            Comment._meta.ordering = ["-id"]
+            Author.objects.get_cached(pk=1)
+            comment.comment = "Edited again"
+            comment.save()
+            self.assertNotEqual(cache.get(key), None)
+            self.assertEqual(get_stats()["cachetree.Author"]["patches"], 1)
+        finally:
+            Comment._meta.ordering = ordering
+    
+    ####################################################################
+    
+    def test_write_through_conflict(self):
+        """Tests that a patched tree whose version was changed by another
+        writer since it was read is deleted instead of written back.
+        """
+        CACHETREE = deepcopy(self.CACHETREE)
+        CACHETREE["cachetree"]["Author"]["write_through"] = True
+        self.reinstall(dict(CACHETREE=CACHETREE))
+        
+        Author.objects.get_cached(pk=1)
+        plan = PLANS[Author]
+        key = generate_base_key(Author, pk=1)
+        trees = tree_cache.get_versioned([key], plan)
+        self.assertEqual(trees[key][0].first_name, "Joe")
+        tree_cache.bump_versions([key], plan)
+        self.assertEqual(tree_cache.set_versioned(trees, plan), [key])
+        self.assertEqual(cache.get(key), None)
+        
+        Author.objects.get_cached(pk=1)
+        trees = tree_cache.get_versioned([key], plan)
+        self.assertEqual(tree_cache.set_versioned(trees, plan), [])
+        self.assertNotEqual(cache.get(key), None)
+        
+        # A conflicting tree is never written, even until it is deleted.
+        trees = tree_cache.get_versioned([key], plan)
+        tree_cache.bump_versions([key], plan)
+        written = list()
+        cache_set = cache._wrapped.set
+        cache._wrapped.set = lambda key, *args, **kwargs: (written.append(key) or
+                                                          cache_set(key, *args, **kwargs))
+        try:
+            self.assertEqual(tree_cache.set_versioned(trees, plan), [key])
+        finally:
+            del cache._wrapped.set
+        self.assertFalse(key in written)
+        
+        # A tree read while another writer holds its version isn't written,
+        # and makes that writer's write fail too.
+        Author.objects.get_cached(pk=1)
+        version_key = tree_cache.get_version_key(key)
+        version = incr_counter(version_key, plan.timeout)
+        trees = tree_cache.get_versioned([key], plan)
+        self.assertEqual(trees[key][1], version)
+        self.assertEqual(tree_cache.set_versioned(trees, plan), [key])
+        self.assertNotEqual(incr_counter(version_key, plan.timeout), version + 1)
+        
+    ####################################################################
+    
+    def test_invalidation_path_queries(self):
+        """Tests that following an invalidation path takes the same number of
+        queries however many instances are followed, and only loads the
+        fields the root instances' keys are generated from.
+        """
+        commenters = list(Commenter.objects.all())
+        self.assertTrue(len(commenters) > 1)
+        
+        # Each path takes one query for the entry ids of the commenters'
+        # comments, one for the author ids of those entries, and one for
+        # the authors' first and last names.
+        batch = InvalidationBatch()
+        with self.assertNumQueries(3):
+            batch.add_changed_instances(Commenter, commenters)
+        with self.assertNumQueries(3):
+            InvalidationBatch().add_changed_instances(Commenter, commenters[:1])
+        self.assertTrue(generate_base_key(Author, pk=1) in batch.keys)
+        self.assertTrue(generate_base_key(Author, first_name="Joe", last_name="Blog") in batch.keys)
+        
+    ####################################################################
+    
+    def test_invalidation_trie(self):
+        """Tests that the invalidation paths of each model are compiled into
+        a trie, and that paths that start with the same steps are followed
+        together, with one query per shared step.
+        """
+        for model, invalidation_paths in Invalidator.INVALIDATION_PATHS.iteritems():
+            self.assertEqual(sorted(Invalidator.INVALIDATION_TRIES[model].get_paths()), 
+                             sorted(invalidation_paths))
+        
+        CACHETREE = deepcopy(self.CACHETREE)
+        CACHETREE["cachetree"]["Entry"]["prefetch"]["comment_set"] = {"commenter": {}}
+        self.reinstall(dict(CACHETREE=CACHETREE))
+        trie = Invalidator.INVALIDATION_TRIES[Commenter]
+        self.assertEqual(len(trie.children), 1)
+        entry_node = trie.children[0].children[0]
+        self.assertEqual(entry_node.path, (("comment_set", Comment), ("entry", Entry)))
+        self.assertTrue(entry_node.is_root)
+        self.assertEqual(entry_node.fields, (("author", "author_id"), ("pk", "id")))
+        
+        # One query for the entry ids of the commenters' comments, one for
+        # the entries' author ids, and one for each root model's
+        # key fields.
+        commenters = list(Commenter.objects.all())
+        batch = InvalidationBatch()
+        with self.assertNumQueries(4):
+            batch.add_changed_instances(Commenter, commenters)
+        self.assertTrue(generate_base_key(Author, pk=1) in batch.keys)
+        self.assertTrue(generate_base_key(Entry, title="Using Models in Tests") in batch.keys)
         
     ####################################################################
 
@@ -1202,6 +1711,59 @@ class CachetreeInvalidationTestCase(CachetreeBaseTestCase):
         
     ####################################################################
     
+    def test_no_invalidation_scope(self):
+        """Tests that no_invalidation only skips invalidation in the current
+        thread, and of the given models, without disconnecting the signal
+        handlers, and that it ends even if the block raises.
+        """
+        Author.objects.get_cached(pk=1)
+        Tag.objects.get_cached(name="models")
+        receivers = len(post_save.receivers)
+        skipped_in_thread = []
+        
+        try:
+            with no_invalidation(Author):
+                self.assertEqual(len(post_save.receivers), receivers)
+                thread = threading.Thread(
+                    target=lambda: skipped_in_thread.append(NoInvalidation.is_skipped(Author)))
+                thread.start()
+                thread.join()
+                author = Author.objects.get(pk=1)
+                author.first_name = "Bob"
+                author.save()
+                tag = Tag.objects.get(name="models")
+                tag.name = "modeling"
+                tag.save()
+                raise ValueError
+        except ValueError:
+            pass
+        
+        self.assertEqual(skipped_in_thread, [False])
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Joe")
+        self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="models")
+        author.last_name = "Robinson"
+        author.save()
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+    ####################################################################
+    
+    def test_no_invalidation_invalidate_after(self):
+        """Tests that no_invalidation with invalidate_after invalidates the
+        skipped instances when it ends.
+        """
+        Author.objects.get_cached(pk=1)
+        
+        @no_invalidation(invalidate_after=True)
+        def rename():
+            author = Author.objects.get(pk=1)
+            author.first_name = "Bob"
+            author.save()
+            self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Joe")
+        rename()
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+    ####################################################################
+    
     def test_disable(self):
         """Tests that cachetree invalidation can be disabled.
         """
@@ -1242,4 +1804,1237 @@ class CachetreeShortcutsTestCase(CachetreeBaseTestCase):
             with self.assertNumQueries(0):
                 author = get_cached_object_or_404(arg, pk=1)
         
-########################################################################
\ No newline at end of file
+########################################################################
+class CachetreeLocalCacheTestCase(CachetreeBaseTestCase):
+    """Tests cachetree's in-process local cache.
+    """
+    
+    LOCAL_CACHE = dict(
+        max_entries=100,
+        max_bytes=1024 * 1024,
+        timeout=60,
+        generation_check_interval=0,
+    )
+    
+    ####################################################################
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test.
+        """
+        test_settings = super(CachetreeLocalCacheTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        test_settings["LOCAL_CACHE"] = self.LOCAL_CACHE
+        return test_settings
+    
+    ####################################################################
+    
+    def test_local_cache_hit(self):
+        """Tests that trees are served from the local cache, as copies that
+        can be changed without affecting the cached tree.
+        """
+        author = Author.objects.get_cached(pk=1)
+        key = generate_base_key(Author, pk=1)
+        cache.delete(key)
+        
+        with self.assertNumQueries(0):
+            author = Author.objects.get_cached(pk=1)
+            author.first_name = "Changed"
+            other_author = Author.objects.get_cached(pk=1)
+        self.assertNotEqual(other_author.first_name, "Changed")
+        self.assertEqual(len(other_author.entry_set.all()), 2)
+        
+    ####################################################################
+    
+    def test_local_cache_old_trees(self):
+        """Tests that trees pickled as they are by earlier versions are read
+        from the shared cache, and not kept in the local cache.
+        """
+        key = generate_base_key(Author, pk=1)
+        cache.set(key, Author.objects.get(pk=1))
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.objects.get_cached(pk=1).pk, 1)
+        self.assertEqual(tree_cache.local.get(key, Author), None)
+        
+    ####################################################################
+    
+    def test_local_cache_invalidation(self):
+        """Tests that invalidation evicts trees from the local cache.
+        """
+        author = Author.objects.get_cached(pk=1)
+        author.first_name = "Bob"
+        author.save()
+        
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+    ####################################################################
+    
+    def test_local_cache_generation(self):
+        """Tests that an invalidation in another process, signalled by the
+        model's generation in the shared cache, makes the local entries
+        stale.
+        """
+        Author.objects.get_cached(pk=1)
+        Author.objects.filter(pk=1).update(first_name="Bob")
+        
+        # Simulate another process invalidating an Author.
+        cache.delete(generate_base_key(Author, pk=1))
+        cache.set(LocalCache.get_generation_key(Author), 100)
+        
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+    ####################################################################
+    
+    def test_local_cache_bounds(self):
+        """Tests that the local cache evicts the least recently used entries
+        when it has too many entries or bytes, and expires entries after its
+        timeout.
+        """
+        local_cache = LocalCache(max_entries=2, max_bytes=1000, timeout=60)
+        local_cache.set("a", "a", Author)
+        local_cache.set("b", "b", Author)
+        local_cache.get("a", Author)
+        local_cache.set("c", "c", Author)
+        self.assertEqual(local_cache.get("b", Author), None)
+        self.assertEqual(local_cache.get("a", Author), "a")
+        self.assertEqual(local_cache.get("c", Author), "c")
+        
+        local_cache.set("d", "d" * 600, Author)
+        local_cache.set("e", "e" * 600, Author)
+        self.assertEqual(local_cache.get("d", Author), None)
+        self.assertEqual(len(local_cache), 1)
+        
+        local_cache = LocalCache(timeout=0.1)
+        local_cache.set("a", "a", Author)
+        time.sleep(0.1)
+        self.assertEqual(local_cache.get("a", Author), None)
+
+########################################################################
+
+class CachetreeIdentityMapTestCase(CachetreeBaseTestCase):
+    """Tests cachetree's identity map.
+    """
+    
+    ####################################################################
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test.
+        """
+        test_settings = super(CachetreeIdentityMapTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        return test_settings
+    
+    ####################################################################
+    
+    def test_identity_map(self):
+        """Tests that, within an IdentityMap, get_cached and get_many_cached
+        return the same instance for the same cache key without going to the
+        cache.
+        """
+        with IdentityMap():
+            author = Author.objects.get_cached(pk=1)
+            cache.clear()
+            with self.assertNumQueries(0):
+                self.assertTrue(Author.objects.get_cached(pk=1) is author)
+                authors = Author.objects.get_many_cached([dict(pk=1)])
+                self.assertTrue(authors[0] is author)
+                
+        self.assertFalse(Author.objects.get_cached(pk=1) is author)
+        
+    ####################################################################
+    
+    def test_identity_map_decorator(self):
+        """Tests that IdentityMap works as a decorator.
+        """
+        @IdentityMap()
+        def get_authors():
+            return Author.objects.get_cached(pk=1), Author.objects.get_cached(pk=1)
+        
+        author1, author2 = get_authors()
+        self.assertTrue(author1 is author2)
+        self.assertEqual(tree_cache.get_identity_map(), None)
+        
+    ####################################################################
+    
+    def test_identity_map_invalidation(self):
+        """Tests that invalidation within an IdentityMap removes the affected
+        entries.
+        """
+        with IdentityMap():
+            author = Author.objects.get_cached(pk=1)
+            tag = Tag.objects.get_cached(name="views")
+            author.first_name = "Bob"
+            author.save()
+            
+            self.assertFalse(Author.objects.get_cached(pk=1) is author)
+            self.assertTrue(Tag.objects.get_cached(name="views") is tag)
+            
+    ####################################################################
+    
+    def test_identity_map_middleware(self):
+        """Tests that IdentityMapMiddleware scopes the identity map to a
+        request.
+        """
+        middleware = IdentityMapMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        author = Author.objects.get_cached(pk=1)
+        self.assertTrue(Author.objects.get_cached(pk=1) is author)
+        middleware.process_response(request, HttpResponse())
+        
+        self.assertEqual(tree_cache.get_identity_map(), None)
+        self.assertFalse(Author.objects.get_cached(pk=1) is author)
+        
+        # A request whose process_response wasn't called doesn't leak its
+        # scope into the next request on the same thread.
+        middleware.process_request(HttpRequest())
+        author = Author.objects.get_cached(pk=1)
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.assertFalse(Author.objects.get_cached(pk=1) is author)
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(tree_cache.get_identity_map(), None)
+
+########################################################################
+
+class CachetreeFillLockTestCase(CachetreeBaseTestCase):
+    """Tests cachetree's fill lock.
+    """
+    
+    CACHETREE = deepcopy(CachetreeBaseTestCase.CACHETREE)
+    CACHETREE["cachetree"]["Author"]["fill_lock"] = dict(wait=0.2, interval=0.01)
+    
+    ####################################################################
+    
+    def setUp(self):
+        super(CachetreeFillLockTestCase, self).setUp()
+        reset_stats()
+        self.key = generate_base_key(Author, pk=1)
+        self.lock_key = get_side_key(self.key, "lock")
+        
+    ####################################################################
+    
+    def test_fill_lock_acquired(self):
+        """Tests that a miss acquires the fill lock and releases it after
+        filling the cache.
+        """
+        author = Author.objects.get_cached(pk=1)
+        self.assertEqual(cache.get(self.lock_key), None)
+        self.assertEqual(get_stats()["cachetree.Author"], dict(fill_lock_acquired=1))
+        
+        with self.assertNumQueries(0):
+            Author.objects.get_cached(pk=1)
+        
+    ####################################################################
+    
+    def test_fill_lock_wait(self):
+        """Tests that a miss waits for another process holding the fill lock
+        and reads the tree it puts in the cache.
+        """
+        tree = Author.objects.get_cached(pk=1)
+        cache.clear()
+        cache.add(self.lock_key, 1)
+        timer = threading.Timer(0.05, lambda: cache.set(self.key, tree))
+        timer.start()
+        try:
+            with self.assertNumQueries(0):
+                author = Author.objects.get_cached(pk=1)
+        finally:
+            timer.join()
+        self.assertEqual(author.pk, 1)
+        stats = get_stats()["cachetree.Author"]
+        self.assertEqual(stats["fill_lock_waits"], 1)
+        self.assertFalse("fill_lock_timeouts" in stats)
+        
+    ####################################################################
+    
+    def test_fill_lock_timeout(self):
+        """Tests that a miss falls back to the database when the fill lock
+        isn't released before the deadline.
+        """
+        cache.add(self.lock_key, 1)
+        author = Author.objects.get_cached(pk=1)
+        self.assertEqual(author.pk, 1)
+        self.assertEqual(get_stats()["cachetree.Author"], dict(
+            fill_lock_waits=1, fill_lock_timeouts=1))
+        self.assertEqual(cache.get(self.lock_key), 1)
+        
+    ####################################################################
+    
+    def test_side_keys(self):
+        """Tests that a lookup value ending in the suffix of a side key can't
+        make a tree key equal to another lookup's fill lock, refresh marker
+        or version key.
+        """
+        key = generate_base_key(Author, first_name="Joe", last_name="Blog")
+        for name in ("lock", "refresh", "version"):
+            self.assertNotEqual(get_side_key(key, name), generate_base_key(
+                Author, first_name="Joe", last_name="Blog.%s" % name))
+        
+        cache.add(get_side_key(key, "lock"), 1)
+        self.assertRaises(Author.DoesNotExist, Author.objects.get_cached,
+                          first_name="Joe", last_name="Blog.lock")
+        cache.delete(get_side_key(key, "lock"))
+        reset_stats()
+        self.assertEqual(Author.objects.get_cached(first_name="Joe", last_name="Blog").pk, 1)
+        self.assertFalse("fill_lock_waits" in get_stats()["cachetree.Author"])
+        
+    ####################################################################
+    
+    def test_fill_lock_disabled(self):
+        """Tests that models without the fill_lock setting don't lock.
+        """
+        Tag.objects.get_cached(name="views")
+        self.assertEqual(get_stats(), {})
+
+########################################################################
+
+class CachetreeStaleTestCase(CachetreeBaseTestCase):
+    """Tests serving stale trees while they are refreshed.
+    """
+    
+    CACHETREE = deepcopy(CachetreeBaseTestCase.CACHETREE)
+    CACHETREE["cachetree"]["Author"]["stale_ttl"] = 60
+    
+    ####################################################################
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test. Refreshes
+        run in the calling thread, which shares the test database.
+        """
+        test_settings = super(CachetreeStaleTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        test_settings["STALE_REFRESH"] = dict(threads=0)
+        return test_settings
+    
+    ####################################################################
+    
+    def test_stale_while_revalidate(self):
+        """Tests that invalidation marks a tree as stale, and that the stale
+        tree is served once while it is refreshed.
+        """
+        reset_stats()
+        author = Author.objects.get_cached(pk=1)
+        first_name = author.first_name
+        author.first_name = "Bob"
+        author.save()
+        
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, first_name)
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        stats = get_stats()["cachetree.Author"]
+        self.assertEqual(stats["stale_hits"], 1)
+        self.assertEqual(stats["stale_refreshes"], 1)
+        
+    ####################################################################
+    
+    def test_stale_get_many_cached(self):
+        """Tests that get_many_cached serves and refreshes stale trees.
+        """
+        author = Author.objects.get_cached(pk=1)
+        first_name = author.first_name
+        author.first_name = "Bob"
+        author.save()
+        
+        authors = Author.objects.get_many_cached([dict(pk=1)])
+        self.assertEqual(authors[0].first_name, first_name)
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+    ####################################################################
+    
+    def test_stale_DoesNotExist(self):
+        """Tests that a cached DoesNotExist is deleted, not served stale, when
+        a matching instance is created.
+        """
+        self.assertRaises(Author.DoesNotExist, Author.objects.get_cached, pk=999)
+        Author.objects.create(pk=999, first_name="New", last_name="Author")
+        self.assertEqual(Author.objects.get_cached(pk=999).first_name, "New")
+        
+    ####################################################################
+    
+    def test_refresher(self):
+        """Tests that the refresher runs refreshes on its threads, and drops
+        them when its queue is full.
+        """
+        refresher = Refresher(threads=1, queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        done = threading.Event()
+        def block():
+            started.set()
+            release.wait()
+        
+        self.assertTrue(refresher.schedule(block))
+        started.wait()
+        self.assertTrue(refresher.schedule(done.set))
+        self.assertFalse(refresher.schedule(done.set))
+        release.set()
+        done.wait(5)
+        self.assertTrue(done.isSet())
+        refresher.stop()
+        
+    def test_refresher_stop(self):
+        """Tests that every refresh the refresher accepts runs, even when it is
+        stopped while refreshes are being scheduled.
+        """
+        refresher = Refresher(threads=2, queue_size=10000)
+        accepted = []
+        ran = []
+        def schedule():
+            for i in xrange(2000):
+                if refresher.schedule(lambda: ran.append(None)):
+                    accepted.append(None)
+        
+        threads = [threading.Thread(target=schedule) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        while [thread for thread in threads if thread.isAlive()]:
+            refresher.stop()
+        refresher.stop()
+        for i in xrange(500):
+            if len(ran) == len(accepted):
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(ran), len(accepted))
+
+########################################################################
+
+class CachetreeSerializerTestCase(CachetreeBaseTestCase):
+    """Tests cachetree's tree serializers.
+    """
+    
+    ####################################################################
+    
+    def test_row_serializer(self):
+        """Tests that the row serializer rebuilds a tree, preserving shared
+        instances and reference cycles, without any queries.
+        """
+        author = Author.objects.get_cached(pk=1)
+        author.authorprofile.__dict__["_author_cache"] = author
+        data = serializers.dumps(author)
+        self.assertEqual(ord(data[0]), serializers.row_serializer.id)
+        
+        with self.assertNumQueries(0):
+            loaded = serializers.loads(data)
+            for field in Author._meta.fields:
+                self.assertEqual(getattr(loaded, field.attname), getattr(author, field.attname))
+            self.assertTrue(loaded.authorprofile.author is loaded)
+            self.assertEqual(loaded._state.db, author._state.db)
+            self.assertFalse(loaded._state.adding)
+            self.assertTrue(loaded._from_cachetree)
+            entries = loaded.entry_set.all()
+            self.assertEqual(len(entries), len(author.entry_set.all()))
+            self.assertTrue(loaded.entry_set.all() is entries)
+            for entry, loaded_entry in zip(author.entry_set.all(), entries):
+                self.assertEqual(
+                    [comment.commenter.pk for comment in entry.comment_set.all()], 
+                    [comment.commenter.pk for comment in loaded_entry.comment_set.all()])
+        
+    ####################################################################
+    
+    def test_row_serializer_post_init(self):
+        """Tests that the row serializer sends post_init once per instance.
+        """
+        author = Author.objects.get_cached(pk=1)
+        data = serializers.dumps(author)
+        instances = []
+        def count(sender, instance, **kwargs):
+            instances.append(instance)
+        post_init.connect(count)
+        try:
+            serializers.loads(data)
+        finally:
+            post_init.disconnect(count)
+        self.assertEqual(len(instances), len(set(map(id, instances))))
+        self.assertEqual(len(instances), 1 + 1 + 2 + sum(
+            len(entry.comment_set.all()) * 2 for entry in author.entry_set.all()))
+        
+    ####################################################################
+    
+    def test_pickle_fallback(self):
+        """Tests that values the row serializer can't serialize are pickled,
+        and that values that weren't serialized are read as they are.
+        """
+        deferred = Author.objects.only("first_name").get(pk=1)
+        data = serializers.dumps(deferred)
+        self.assertEqual(ord(data[0]), serializers.pickle_serializer.id)
+        self.assertEqual(serializers.loads(data).__class__, deferred.__class__)
+        
+        self.assertTrue(serializers.loads(deferred) is deferred)
+        
+    ####################################################################
+    
+    def test_compression(self):
+        """Tests that serialized trees of at least the threshold size are
+        compressed, and read back whether they are compressed or not.
+        """
+        author = Author.objects.get_cached(pk=1)
+        uncompressed = serializers.dumps(author)
+        compressed = serializers.dumps(author, compression=dict(threshold=0, level=9))
+        self.assertFalse(ord(uncompressed[0]) & serializers.COMPRESSED)
+        self.assertTrue(ord(compressed[0]) & serializers.COMPRESSED)
+        self.assertTrue(len(compressed) < len(uncompressed))
+        self.assertEqual(
+            serializers.dumps(author, compression=dict(threshold=len(uncompressed), level=9)), 
+            uncompressed)
+        for data in (uncompressed, compressed):
+            self.assertEqual(serializers.loads(data).entry_set.all()[0].title, 
+                             author.entry_set.all()[0].title)
+        
+    ####################################################################
+    
+    def test_compression_settings(self):
+        """Tests the global and per-model compression settings.
+        """
+        cachetree_settings = deepcopy(self.CACHETREE)
+        cachetree_settings["cachetree"]["Author"]["compression"] = dict(threshold=0)
+        cachetree_settings["cachetree"]["Tag"]["compression"] = False
+        self.reinstall(dict(CACHETREE=cachetree_settings, COMPRESSION=True))
+        
+        self.assertEqual(PLANS[Author].compression, dict(threshold=0, level=6))
+        self.assertEqual(PLANS[Entry].compression, dict(threshold=10 * 1024, level=6))
+        self.assertEqual(PLANS[Tag].compression, None)
+        
+        Author.objects.get_cached(pk=1)
+        self.assertTrue(ord(cache.get(generate_base_key(Author, pk=1))[0]) & serializers.COMPRESSED)
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.objects.get_cached(pk=1).pk, 1)
+        
+    ####################################################################
+    
+    def test_serializer_settings(self):
+        """Tests the global and per-model serializer settings, including
+        serializers given by path.
+        """
+        cachetree_settings = deepcopy(self.CACHETREE)
+        cachetree_settings["cachetree"]["Author"]["serializer"] = "pickle"
+        cachetree_settings["cachetree"]["Tag"]["serializer"] = "cachetree.tests.TestSerializer"
+        self.reinstall(dict(CACHETREE=cachetree_settings, SERIALIZER="marshal"))
+        
+        for model, kwargs, serializer_id in ((Author, dict(pk=1), 1),
+                                             (Entry, dict(title="Using Models in Tests"), 3), 
+                                             (Tag, dict(name="views"), TestSerializer.id)):
+            model.objects.get_cached(**kwargs)
+            self.assertEqual(ord(cache.get(generate_base_key(model, **kwargs))[0]), serializer_id)
+            with self.assertNumQueries(0):
+                model.objects.get_cached(**kwargs)
+        
+        self.assertRaises(ImproperlyConfigured, serializers.get_serializer_by_name, "json")
+        self.assertRaises(ImproperlyConfigured, serializers.get_serializer, ConflictingSerializer)
+        
+    ####################################################################
+    
+    def test_marshal_fallback(self):
+        """Tests that trees marshal can't serialize are serialized by the row
+        serializer.
+        """
+        author = Author.objects.get_cached(pk=1)
+        self.assertEqual(ord(serializers.dumps(author, serializers.marshal_serializer)[0]), 
+                         serializers.marshal_serializer.id)
+        author.rating = Decimal("4.5")
+        data = serializers.dumps(author, serializers.marshal_serializer)
+        self.assertEqual(ord(data[0]), serializers.row_serializer.id)
+        self.assertEqual(serializers.loads(data).rating, Decimal("4.5"))
+
+########################################################################
+
+class CachetreePointerTestCase(CachetreeBaseTestCase):
+    """Tests storing each tree once, with pointers from the other lookups.
+    """
+    
+    CACHETREE = deepcopy(CachetreeBaseTestCase.CACHETREE)
+    CACHETREE["cachetree"]["Author"]["pointers"] = True
+    
+    ####################################################################
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test.
+        """
+        test_settings = super(CachetreePointerTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        return test_settings
+    
+    ####################################################################
+    
+    def setUp(self):
+        super(CachetreePointerTestCase, self).setUp()
+        author = Author.objects.get(pk=1)
+        self.name_kwargs = dict(first_name=author.first_name, last_name=author.last_name)
+        self.name_key = generate_base_key(Author, **self.name_kwargs)
+        self.pk_key = generate_base_key(Author, pk=1)
+        
+    ####################################################################
+    
+    def test_pointers(self):
+        """Tests that trees are stored once, under the pk key, and that other
+        lookups point to them.
+        """
+        author = Author.objects.get_cached(**self.name_kwargs)
+        self.assertEqual(cache.get(self.name_key).pk, 1)
+        self.assertTrue(isinstance(serializers.loads(cache.get(self.pk_key)), Author))
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.objects.get_cached(pk=1).pk, 1)
+            author = Author.objects.get_cached(**self.name_kwargs)
+            self.assertEqual(len(author.entry_set.all()), 2)
+            authors = Author.objects.get_many_cached([self.name_kwargs, dict(pk=1)])
+            self.assertEqual([author.pk for author in authors], [1, 1])
+            
+    ####################################################################
+    
+    def test_pointer_miss(self):
+        """Tests that a lookup whose pointer is missing only looks up the pk
+        if the tree is still cached, and is filled again if it isn't.
+        """
+        Author.objects.get_cached(pk=1)
+        with self.assertNumQueries(1):
+            Author.objects.get_cached(**self.name_kwargs)
+        
+        cache.delete(self.pk_key)
+        self.assertEqual(Author.objects.get_cached(**self.name_kwargs).pk, 1)
+        self.assertEqual(Author.objects.get_many_cached([self.name_kwargs])[0].pk, 1)
+        with self.assertNumQueries(0):
+            Author.objects.get_cached(pk=1)
+            
+    ####################################################################
+    
+    def test_pointer_invalidation(self):
+        """Tests that invalidation deletes the tree and its pointers, and that
+        misses are still cached.
+        """
+        author = Author.objects.get_cached(**self.name_kwargs)
+        author.first_name = "Bob"
+        author.save()
+        self.assertEqual(cache.get(self.name_key), None)
+        self.assertEqual(cache.get(self.pk_key), None)
+        
+        self.assertRaises(Author.DoesNotExist, Author.objects.get_cached, **self.name_kwargs)
+        with self.assertNumQueries(0):
+            self.assertRaises(Author.DoesNotExist, Author.objects.get_cached, **self.name_kwargs)
+            
+        self.assertEqual(Author.objects.get_cached(first_name="Bob", 
+                                                   last_name=author.last_name).first_name, "Bob")
+        
+    ####################################################################
+    
+    def test_pointer_fill_lock(self):
+        """Tests that a miss waiting on the fill lock resolves the pointer
+        another process puts in the cache, and keeps waiting while the tree
+        it points to isn't cached.
+        """
+        CACHETREE = deepcopy(self.CACHETREE)
+        CACHETREE["cachetree"]["Author"]["fill_lock"] = dict(wait=0.5, interval=0.01)
+        self.reinstall(dict(CACHETREE=CACHETREE))
+        
+        Author.objects.get_cached(**self.name_kwargs)
+        pointer = cache.get(self.name_key)
+        data = cache.get(self.pk_key)
+        cache.clear()
+        cache.add(get_side_key(self.name_key, "lock"), 1)
+        cache.set(self.name_key, pointer)
+        timer = threading.Timer(0.05, lambda: cache.set(self.pk_key, data))
+        timer.start()
+        try:
+            with self.assertNumQueries(0):
+                author = Author.objects.get_cached(**self.name_kwargs)
+        finally:
+            timer.join()
+        self.assertTrue(isinstance(author, Author))
+        self.assertEqual(author.pk, 1)
+
+########################################################################
+
+class CachetreeNegativeTestCase(CachetreeBaseTestCase):
+    """Tests the caching of DoesNotExist and MultipleObjectsReturned errors.
+    """
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test.
+        """
+        test_settings = super(CachetreeNegativeTestCase, self).get_test_settings()
+        test_settings["NEGATIVE_FILTER"] = dict(generation_check_interval=0)
+        return test_settings
+    
+    ####################################################################
+    
+    def test_negative_sentinels(self):
+        """Tests that errors are cached as sentinels, and raised as the
+        model's exceptions.
+        """
+        try:
+            Tag.objects.get_cached(name="invalid tag")
+        except Tag.DoesNotExist, e:
+            self.assertEqual(str(e), "Tag matching query does not exist.")
+        else:
+            self.fail("DoesNotExist not raised")
+        key = generate_base_key(Tag, name="invalid tag")
+        self.assertEqual(cache.get(key), serializers.DOES_NOT_EXIST)
+        
+        Tag.objects.create(name="models")
+        self.assertRaises(Tag.MultipleObjectsReturned, Tag.objects.get_cached, name="models")
+        key = generate_base_key(Tag, name="models")
+        self.assertEqual(cache.get(key), serializers.MULTIPLE_OBJECTS_RETURNED)
+        
+    ####################################################################
+    
+    def test_negative_timeout(self):
+        """Tests that errors are cached with the negative timeout, and trees
+        with the model's timeout.
+        """
+        CACHETREE = deepcopy(self.CACHETREE)
+        CACHETREE["cachetree"]["Tag"]["negative_timeout"] = 1
+        self.reinstall(dict(CACHETREE=CACHETREE))
+        
+        Tag.objects.get_cached(name="models")
+        self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="invalid tag")
+        self.assertRaises(Tag.DoesNotExist, Tag.objects.get_many_cached, 
+                          [dict(name="models"), dict(name="other invalid tag")])
+        
+        # Skip the negative filter, to see the shared cache's timeouts.
+        tree_cache.negative.clear()
+        time.sleep(1)
+        with self.assertNumQueries(0):
+            Tag.objects.get_cached(name="models")
+        with self.assertNumQueries(1):
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="invalid tag")
+        with self.assertNumQueries(1):
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="other invalid tag")
+            
+    ####################################################################
+    
+    def test_negative_filter(self):
+        """Tests that misses are served from the negative filter, and that
+        trees are not kept in it.
+        """
+        Tag.objects.get_cached(name="models")
+        self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="invalid tag")
+        self.assertEqual(len(tree_cache.negative), 1)
+        
+        cache.delete(generate_base_key(Tag, name="invalid tag"))
+        with self.assertNumQueries(0):
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="invalid tag")
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_many_cached, [dict(name="invalid tag")])
+            
+    ####################################################################
+    
+    def test_create_clears_negative_entries(self):
+        """Tests that creating an instance clears the misses at its keys,
+        with or without invalidation.
+        """
+        for invalidate in (False, True):
+            self.reinstall(dict(INVALIDATE=invalidate))
+            name = "new tag %s" % invalidate
+            self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name=name)
+            tag = Tag.objects.create(name=name)
+            self.assertEqual(Tag.objects.get_cached(name=name).pk, tag.pk)
+            
+########################################################################
+
+class CachetreeInvalidateModelTestCase(CachetreeBaseTestCase):
+    """Tests invalidating every tree of a model with invalidate_model.
+    """
+    
+    def test_invalidate_model(self):
+        """Tests that invalidate_model makes every tree of the model
+        unreachable, and leaves other models' trees alone.
+        """
+        Author.objects.get_cached(pk=1)
+        Tag.objects.get_cached(name="models")
+        key = generate_base_key(Author, pk=1)
+        self.assertTrue(key.startswith("cachetree:cachetree.Author.g"))
+        Author.objects.update(first_name="Bob")
+        
+        invalidate_model(Author)
+        self.assertNotEqual(generate_base_key(Author, pk=1), key)
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        self.assertEqual(
+            PLANS[Author].make_instance_keys([Author.objects.get(pk=1)])[0], 
+            generate_base_key(Author, pk=1))
+        with self.assertNumQueries(0):
+            Tag.objects.get_cached(name="models")
+            
+        self.assertRaises(ValueError, invalidate_model, Comment)
+            
+    ####################################################################
+    
+    def test_invalidate_related_model(self):
+        """Tests that, with invalidation enabled, invalidating a model that
+        is cached in other models' trees invalidates those models.
+        """
+        self.reinstall(dict(INVALIDATE=True))
+        Author.objects.get_cached(pk=1)
+        Tag.objects.get_cached(name="models")
+        Commenter.objects.update(first_name="Bob")
+        
+        invalidate_model(Commenter)
+        author = Author.objects.get_cached(pk=1)
+        for entry in author.entry_set.all():
+            for comment in entry.comment_set.all():
+                self.assertEqual(comment.commenter.first_name, "Bob")
+        with self.assertNumQueries(0):
+            Tag.objects.get_cached(name="models")
+            
+    ####################################################################
+    
+    def test_lost_generation(self):
+        """Tests that a generation whose key is lost from the cache is seeded
+        with a higher value, so the trees of earlier generations stay
+        unreachable.
+        """
+        self.reinstall(dict(GENERATION_CHECK_INTERVAL=0))
+        Author.objects.get_cached(pk=1)
+        invalidate_model(Author)
+        generation = key_generations.get(Author)
+        Author.objects.update(first_name="Bob")
+        Author.objects.get_cached(pk=1)
+        
+        cache.delete(key_generations.key_prefix + "cachetree.Author")
+        self.assertTrue(key_generations.get(Author) > generation)
+        Author.objects.update(first_name="Jim")
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Jim")
+        
+        cache.delete(key_generations.key_prefix + "cachetree.Author")
+        generation = key_generations.get(Author)
+        invalidate_model(Author)
+        self.assertTrue(key_generations.get(Author) > generation)
+        
+    ####################################################################
+    
+    def test_generation_check_interval(self):
+        """Tests that a model invalidated by another process is seen once
+        the generation is checked again.
+        """
+        self.reinstall(dict(GENERATION_CHECK_INTERVAL=0.1))
+        Author.objects.get_cached(pk=1)
+        Author.objects.update(first_name="Bob")
+        
+        # Simulate another process invalidating Author.
+        cache.set(key_generations.key_prefix + "cachetree.Author", 5)
+        self.assertNotEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        time.sleep(0.1)
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+########################################################################
+
+class CachetreeBulkTestCase(CachetreeBaseTestCase):
+    """Tests the bulk operations' invalidation.
+    """
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test.
+        """
+        test_settings = super(CachetreeBulkTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        return test_settings
+    
+    ####################################################################
+    
+    def test_bulk_update(self):
+        """Tests that bulk_update invalidates the trees the updated instances
+        are part of, with one query per step of each invalidation path.
+        """
+        author = Author.objects.get_cached(pk=1)
+        Tag.objects.get_cached(name="models")
+        
+        # One query to get the commenters, and one per step of the path from
+        # Commenter to Author, before and after the update.
+        with self.assertNumQueries(9):
+            self.assertEqual(bulk_update(Commenter.objects.all(), first_name="Bob"), 5)
+        author = Author.objects.get_cached(pk=1)
+        for entry in author.entry_set.all():
+            for comment in entry.comment_set.all():
+                self.assertEqual(comment.commenter.first_name, "Bob")
+        with self.assertNumQueries(0):
+            Tag.objects.get_cached(name="models")
+            
+    ####################################################################
+    
+    def test_bulk_update_chunks(self):
+        """Tests that bulk_update reads the tracked fields of the updated
+        instances in chunks, before and after the update.
+        """
+        Author.objects.get_cached(pk=1)
+        chunk_size = Invalidator.BULK_CHUNK_SIZE
+        Invalidator.BULK_CHUNK_SIZE = 2
+        try:
+            with self.assertNumQueries(3):
+                rows = _values_in_pk_chunks(Commenter.objects.all(), ["id"], 0)
+            self.assertEqual(rows, [(pk,) for pk in range(1, 6)])
+            
+            bulk_update(Commenter.objects.all(), first_name="Bob")
+        finally:
+            Invalidator.BULK_CHUNK_SIZE = chunk_size
+        for entry in Author.objects.get_cached(pk=1).entry_set.all():
+            for comment in entry.comment_set.all():
+                self.assertEqual(comment.commenter.first_name, "Bob")
+            
+    ####################################################################
+    
+    def test_bulk_update_lookups(self):
+        """Tests that bulk_update invalidates the keys of root instances'
+        original and updated lookup values.
+        """
+        Author.objects.get_cached(first_name="Joe", last_name="Blog")
+        self.assertRaises(Author.DoesNotExist, Author.objects.get_cached, 
+                          first_name="Bob", last_name="Blog")
+        
+        bulk_update(Author.objects.filter(pk=1), first_name="Bob")
+        self.assertRaises(Author.DoesNotExist, Author.objects.get_cached, 
+                          first_name="Joe", last_name="Blog")
+        self.assertEqual(Author.objects.get_cached(first_name="Bob", last_name="Blog").pk, 1)
+        
+    ####################################################################
+    
+    def test_bulk_delete(self):
+        """Tests that bulk_delete invalidates the trees of the deleted
+        instances and of the instances deleted by cascade.
+        """
+        author = Author.objects.get_cached(pk=1)
+        self.assertEqual(len(author.entry_set.all()[0].comment_set.all()), 2)
+        
+        bulk_delete(Comment.objects.filter(entry__author=1))
+        author = Author.objects.get_cached(pk=1)
+        self.assertEqual(len(author.entry_set.all()[0].comment_set.all()), 0)
+        
+        Tag.objects.get_cached(name="tests")
+        entry = Entry.objects.get_cached(title="Using Models in Tests")
+        bulk_delete(Entry.objects.filter(title="Using Models in Tests"))
+        self.assertEqual(len(Author.objects.get_cached(pk=1).entry_set.all()), 1)
+        self.assertEqual(len(Tag.objects.get_cached(name="tests").entry_set.all()), 0)
+        self.assertRaises(Entry.DoesNotExist, Entry.objects.get_cached, title="Using Models in Tests")
+        
+    ####################################################################
+    
+    def test_bulk_create(self):
+        """Tests that bulk_create invalidates the trees the new instances are
+        part of, and their cached misses.
+        """
+        self.assertEqual(len(Author.objects.get_cached(pk=1).entry_set.all()), 2)
+        self.assertRaises(Entry.DoesNotExist, Entry.objects.get_cached, title="New Entry")
+        
+        entries = bulk_create(Entry, [Entry(author_id=1, title="New Entry", content="Content"),
+                                      Entry(author_id=1, title="Other Entry", content="Content")])
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(len(Author.objects.get_cached(pk=1).entry_set.all()), 4)
+        self.assertEqual(Entry.objects.get_cached(title="New Entry").content, "Content")
+        
+        self.reinstall(dict(INVALIDATE=False))
+        self.assertRaises(Tag.DoesNotExist, Tag.objects.get_cached, name="new tag")
+        bulk_create(Tag, [Tag(name="new tag")])
+        self.assertEqual(Tag.objects.get_cached(name="new tag").name, "new tag")
+        
+    ####################################################################
+    
+    def test_bulk_invalidation_manager(self):
+        """Tests that the querysets of a manager with
+        BulkInvalidationManagerMixin invalidate in bulk.
+        """
+        class BulkManager(BulkInvalidationManagerMixin, models.Manager):
+            pass
+        manager = BulkManager()
+        manager.model = Commenter
+        
+        Author.objects.get_cached(pk=1)
+        manager.filter(pk=1).update(first_name="Bob")
+        author = Author.objects.get_cached(pk=1)
+        self.assertEqual(author.entry_set.all()[0].comment_set.all()[0].commenter.first_name, "Bob")
+        
+        manager.filter(pk=1).delete()
+        author = Author.objects.get_cached(pk=1)
+        self.assertEqual(len(author.entry_set.all()[0].comment_set.all()), 1)
+        
+########################################################################
+
+class CachetreeDeferredInvalidationTestCase(CachetreeBaseTestCase):
+    """Tests deferring invalidation until the end of the transaction.
+    """
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test.
+        """
+        test_settings = super(CachetreeDeferredInvalidationTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        test_settings["DEFER_INVALIDATION"] = {}
+        return test_settings
+    
+    ####################################################################
+    
+    def setUp(self):
+        """Stops the connection from really committing or rolling back the
+        test's transaction.
+        """
+        super(CachetreeDeferredInvalidationTestCase, self).setUp()
+        connection._commit = connection._rollback = lambda: None
+        
+    def tearDown(self):
+        del connection._commit, connection._rollback
+        super(CachetreeDeferredInvalidationTestCase, self).tearDown()
+        
+    ####################################################################
+    
+    def test_invalidate_on_commit(self):
+        """Tests that invalidations are deferred until the transaction is
+        committed, and that each key is only invalidated once.
+        """
+        author = Author.objects.get_cached(pk=1)
+        author.first_name = "Bob"
+        author.save()
+        for entry in author.entry_set.all():
+            entry.title = "%s 2" % entry.title
+            entry.save()
+            
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Joe")
+        batch = deferred_invalidation._get_batches()[connection.alias]
+        self.assertTrue(generate_base_key(Author, pk=1) in batch.keys)
+        
+        connection.commit()
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        self.assertFalse(connection.alias in deferred_invalidation._get_batches())
+        
+    ####################################################################
+    
+    def test_discard_on_rollback(self):
+        """Tests that the invalidations of a transaction that is rolled back
+        are dropped.
+        """
+        author = Author.objects.get_cached(pk=1)
+        author.first_name = "Bob"
+        author.save()
+        connection.rollback()
+        self.assertFalse(connection.alias in deferred_invalidation._get_batches())
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Joe")
+        
+    ####################################################################
+    
+    def test_repeat_after(self):
+        """Tests that the keys of a committed transaction are invalidated
+        again after "repeat_after" seconds.
+        """
+        self.reinstall(dict(DEFER_INVALIDATION=dict(repeat_after=0.05)))
+        author = Author.objects.get_cached(pk=1)
+        author.first_name = "Bob"
+        author.save()
+        connection.commit()
+        
+        # Simulate another process filling the cache with data read before
+        # the commit.
+        key = generate_base_key(Author, pk=1)
+        cache.set(key, "stale")
+        time.sleep(0.2)
+        self.assertEqual(cache.get(key), None)
+        
+########################################################################
+
+class CachetreeBatchInvalidationTestCase(CachetreeBaseTestCase):
+    """Tests invalidating the instances changed in a batch_invalidation
+    together.
+    """
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test.
+        """
+        test_settings = super(CachetreeBatchInvalidationTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        return test_settings
+    
+    ####################################################################
+    
+    def test_batch_invalidation(self):
+        """Tests that the instances saved and deleted in a batch are
+        invalidated when it ends, with one delete_many.
+        """
+        delete_many_calls = []
+        delete_many = tree_cache.delete_many
+        def counting_delete_many(*args, **kwargs):
+            delete_many_calls.append(args)
+            return delete_many(*args, **kwargs)
+        tree_cache.delete_many = counting_delete_many
+        try:
+            author = Author.objects.get_cached(pk=1)
+            with batch_invalidation():
+                for entry in author.entry_set.all():
+                    for comment in entry.comment_set.all():
+                        comment = Comment.objects.get(pk=comment.pk)
+                        comment.comment = "Edited"
+                        comment.save()
+                        comment.save()
+                Comment.objects.filter(entry__author=1)[0].delete()
+                self.assertEqual(Author.objects.get_cached(pk=1), author)
+                self.assertEqual(delete_many_calls, [])
+        finally:
+            tree_cache.delete_many = delete_many
+        
+        self.assertEqual(len(delete_many_calls), 1)
+        author = Author.objects.get_cached(pk=1)
+        comments = [comment for entry in author.entry_set.all() 
+                    for comment in entry.comment_set.all()]
+        self.assertEqual(len(comments), 3)
+        for comment in comments:
+            self.assertEqual(comment.comment, "Edited")
+        
+    ####################################################################
+    
+    def test_batch_invalidation_lookups(self):
+        """Tests that a batch invalidates the keys of an instance's state when
+        it was loaded, as well as its last saved state.
+        """
+        Author.objects.get_cached(first_name="Joe", last_name="Blog")
+        self.assertRaises(Author.DoesNotExist, Author.objects.get_cached, 
+                          first_name="Bob", last_name="Blog")
+        
+        author = Author.objects.get(pk=1)
+        with batch_invalidation():
+            author.first_name = "Jim"
+            author.save()
+            author.first_name = "Bob"
+            author.save()
+        self.assertRaises(Author.DoesNotExist, Author.objects.get_cached, 
+                          first_name="Joe", last_name="Blog")
+        self.assertEqual(Author.objects.get_cached(first_name="Bob", last_name="Blog").pk, 1)
+        self.assertFalse(author._orig_state.has_changed(author))
+        
+    ####################################################################
+    
+    def test_batch_invalidation_decorator(self):
+        """Tests batch_invalidation as a decorator, and that nested batches
+        are invalidated when the outermost one ends.
+        """
+        Author.objects.get_cached(pk=1)
+        
+        @batch_invalidation()
+        def rename(first_name):
+            author = Author.objects.get(pk=1)
+            author.first_name = first_name
+            author.save()
+            
+        with batch_invalidation():
+            rename("Bob")
+            self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Joe")
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        rename("Jim")
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Jim")
+        
+########################################################################
+
+class CachetreeAsyncInvalidationTestCase(CachetreeBaseTestCase):
+    """Tests queueing invalidations to be made outside of the saving thread.
+    """
+    
+    def get_test_settings(self):
+        """Returns the cachetree settings to be used for the test. The queue is
+        only consumed by drain(), since the test database isn't shared with
+        other threads.
+        """
+        test_settings = super(CachetreeAsyncInvalidationTestCase, self).get_test_settings()
+        test_settings["INVALIDATE"] = True
+        test_settings["ASYNC_INVALIDATION"] = dict(threads=0)
+        return test_settings
+    
+    ####################################################################
+    
+    def setUp(self):
+        """Stops the connection from really committing or rolling back the
+        test's transaction.
+        """
+        super(CachetreeAsyncInvalidationTestCase, self).setUp()
+        connection._commit = connection._rollback = lambda: None
+        reset_stats()
+        
+    def tearDown(self):
+        del connection._commit, connection._rollback
+        super(CachetreeAsyncInvalidationTestCase, self).tearDown()
+        
+    ####################################################################
+    
+    def rename(self, pk, first_name):
+        author = Author.objects.get(pk=pk)
+        author.first_name = first_name
+        author.save()
+    
+    def test_queue_on_commit(self):
+        """Tests that the instances changed in a transaction are queued when
+        it is committed, and invalidated when the queue is consumed.
+        """
+        Author.objects.get_cached(pk=1)
+        self.rename(1, "Bob")
+        self.assertEqual(len(async_invalidation._get_pending()[connection.alias]), 1)
+        connection.commit()
+        self.assertFalse(connection.alias in async_invalidation._get_pending())
+        self.assertEqual(get_stats()["cachetree.Author"]["invalidations_queued"], 1)
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Joe")
+        async_invalidation.drain()
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+    ####################################################################
+    
+    def test_identity_map_eviction(self):
+        """Tests that queueing an instance removes the trees that may hold it
+        from the current thread's identity map right away, and keeps the
+        others.
+        """
+        with IdentityMap():
+            author = Author.objects.get_cached(pk=1)
+            tag = Tag.objects.get_cached(name="models")
+            self.rename(1, "Bob")
+            self.assertFalse(Author.objects.get_cached(pk=1) is author)
+            with self.assertNumQueries(0):
+                self.assertTrue(Tag.objects.get_cached(name="models") is tag)
+        
+    ####################################################################
+    
+    def test_discard_on_rollback(self):
+        """Tests that the instances changed in a transaction that is rolled
+        back are never queued.
+        """
+        Author.objects.get_cached(pk=1)
+        self.rename(1, "Bob")
+        connection.rollback()
+        self.assertFalse(connection.alias in async_invalidation._get_pending())
+        async_invalidation.drain()
+        self.assertFalse("invalidations_queued" in get_stats().get("cachetree.Author", {}))
+        
+    ####################################################################
+    
+    def test_invalidate_when_full(self):
+        """Tests that an instance that can't be queued is invalidated in the
+        saving thread, and that the queued instances are invalidated when
+        asynchronous invalidation is disabled.
+        """
+        self.reinstall(dict(ASYNC_INVALIDATION=dict(threads=0, queue_size=1)))
+        Author.objects.get_cached(pk=1)
+        Author.objects.get_cached(pk=2)
+        self.rename(1, "Bob")
+        self.rename(2, "Jim")
+        connection.commit()
+        self.assertEqual(get_stats()["cachetree.Author"]["invalidations_unqueued"], 1)
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Joe")
+        self.assertEqual(Author.objects.get_cached(pk=2).first_name, "Jim")
+        async_invalidation.configure(None)
+        self.assertEqual(Author.objects.get_cached(pk=1).first_name, "Bob")
+        
+    ####################################################################
+    
+    def test_invalidation_queue(self):
+        """Tests that an InvalidationQueue refuses snapshots when it is full
+        or its oldest snapshot is older than max_staleness, and hands
+        snapshots to a waiting thread.
+        """
+        queue = InvalidationQueue(size=2, max_staleness=0.05)
+        self.assertTrue(queue.put("a"))
+        self.assertTrue(queue.put("b"))
+        self.assertFalse(queue.put("c"))
+        self.assertEqual(queue.get(1), ["a"])
+        time.sleep(0.1)
+        self.assertFalse(queue.put("d"))
+        self.assertEqual(queue.get(10, block=False), ["b"])
+        self.assertEqual(queue.get(10, block=False), None)
+        
+        batches = []
+        thread = threading.Thread(target=lambda: batches.append(queue.get(10)))
+        thread.start()
+        self.assertTrue(queue.put("e"))
+        thread.join(1)
+        self.assertEqual(batches, [["e"]])
+        queue.stop()
+        self.assertEqual(queue.get(10), None)
+        
+########################################################################
@@ -11,31 +11,86 @@ try:
 except ImportError:
     from md5 import md5
 import re
+import string
 import settings as cachetree_settings
 from exceptions import ImproperlyConfigured
+from cache import key_generations
 
 ########################################################################
 
 WHITESPACE = re.compile("\s")
 CACHETREE_PREFIX = "cachetree"
 
+# Raw keys of up to MAX_UNHASHED_KEY_LENGTH bytes that contain none of the
+# UNSAFE_KEY_CHARS are used as they are, without a hexdigest, as long as
+# none of the values contain the ";" separator. Unhashed keys are prefixed
+# with "cachetree:" instead of "cachetree.", so they never collide with
+# hashed keys, and neither form collides with the side keys kept next to
+# trees, which are prefixed with "cachetree-" (see cache.get_side_key).
+MAX_UNHASHED_KEY_LENGTH = 160
+UNSAFE_KEY_CHARS = "".join(chr(i) for i in range(33) + range(127, 256))
+_IDENTITY_TABLE = string.maketrans("", "")
+
 def generate_base_key(model, **kwargs):
     """Generates a base key to be used for caching, containing the model name,
-    the lookup kwargs, plus a hexdigest. The base key will later be combined
-    with any required version or prefix.
+    the lookup kwargs, plus a hexdigest if the key is long or contains unsafe
+    characters. The base key will later be combined with any required
+    version or prefix.
+    """
+    return make_key(get_key_prefix(model), kwargs)
+
+def get_key_prefix(model, base_key_prefix=None):
+    """Returns the ``model``'s part of its keys: the ``base_key_prefix``
+    ("app_label.Model." by default), followed by the model's key generation
+    if invalidate_model has ever been called for it.
+    """
+    if base_key_prefix is None:
+        base_key_prefix = "%s.%s." % (model._meta.app_label, model.__name__)
+    generation = key_generations.get(model)
+    if generation:
+        return "%sg%s." % (base_key_prefix, generation)
+    return base_key_prefix
+
+def get_model_key_prefixes(model):
+    """Returns the prefixes that every key of the ``model``'s trees starts
+    with, whatever its generation: one for unhashed keys and one for hashed
+    keys (see make_key_from_raw).
+    """
+    base_key_prefix = "%s.%s." % (model._meta.app_label, model.__name__)
+    return ("%s:%s" % (CACHETREE_PREFIX, base_key_prefix),
+            "%s.%s" % (CACHETREE_PREFIX, base_key_prefix))
+
+def make_key(key_prefix, kwargs):
+    """Generates a base key from the model's ``key_prefix`` ("app_label.Model.")
+    and the lookup ``kwargs``. See generate_base_key.
     """
+    if len(kwargs) == 1:
+        name, value = kwargs.items()[0]
+        if isinstance(value, models.Model):
+            value = value.pk
+        return make_key_from_raw("%s%s:%s" % (key_prefix, name, value), 1)
     
     key_parts = []
     for name, value in sorted(kwargs.iteritems()):
         if isinstance(value, models.Model):
             value = value.pk
         key_parts.append("%s:%s" % (name, value))
-        
-    raw_key = "%(app_label)s.%(model)s.%(parts)s" % dict(
-        app_label=model._meta.app_label, 
-        model=model.__name__, 
-        parts=";".join(key_parts))
-    raw_key = raw_key.encode('utf-8')
+    return make_key_from_raw(key_prefix + ";".join(key_parts), len(key_parts))
+
+def make_key_from_raw(raw_key, field_count):
+    """Returns the cache key for the ``raw_key`` ("app_label.Model." followed
+    by "name:value" for each field, separated by ";") of a lookup on
+    ``field_count`` fields: the raw key itself if it can be used unhashed,
+    or else the raw key with whitespace stripped, truncated, plus a
+    hexdigest of the raw key.
+    """
+    if isinstance(raw_key, unicode):
+        raw_key = raw_key.encode('utf-8')
+    if (len(raw_key) <= MAX_UNHASHED_KEY_LENGTH and 
+        raw_key.count(";") == field_count - 1 and
+        len(raw_key.translate(_IDENTITY_TABLE, UNSAFE_KEY_CHARS)) == len(raw_key)):
+        return "%s:%s" % (CACHETREE_PREFIX, raw_key)
+    
     digest = md5(raw_key).hexdigest()
     
     # Whitespace is stripped but the hexdigest ensures uniqueness
@@ -73,6 +128,8 @@ def get_cache_settings(model):
         raise ValueError("Caching is not enabled for %(app)s.%(model)s. To enable it, add the %(model)s model to your CACHETREE setting." % dict(
         app=model._meta.app_label, model=model.__name__))
     
+    # Fill in the defaults on a copy, leaving the CACHETREE setting as it was.
+    cache_settings = dict(cache_settings)
     if "lookups" not in cache_settings:
         cache_settings["lookups"] = ("pk", model._meta.pk.name)
     if "prefetch" not in cache_settings:
@@ -0,0 +1,234 @@
+"""
+Cachetree Write-Through
+"""
+
+########################################################################
+
+from itertools import izip
+from django.db.models.base import ModelState
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.db.models.fields.related import (
+    SingleRelatedObjectDescriptor, ReverseSingleRelatedObjectDescriptor,
+    ForeignRelatedObjectsDescriptor, ManyRelatedObjectsDescriptor,
+    ReverseManyRelatedObjectsDescriptor)
+import settings as cachetree_settings
+
+########################################################################
+
+# The changes a TreePatch can make to an instance in a tree.
+REPLACE, INSERT, REMOVE = "replace", "insert", "remove"
+
+########################################################################
+
+def get_relation(model, attr_name):
+    """Returns a tuple of the related model that the ``model``'s prefetched
+    ``attr_name`` leads to, the name of the attribute the related
+    instances are cached under on each instance, whether it holds a list
+    of them, and the (attname on the instance, attname on the related
+    instance) pair the relation joins on, if it is a reverse ForeignKey or
+    OneToOneField, or None. Returns None if ``attr_name`` isn't a related
+    model descriptor.
+    """
+    descriptor = getattr(model, attr_name, None)
+    many_name = "%s%s" % (cachetree_settings.CACHETREE_MANY_RELATED_PREFIX, attr_name)
+    if isinstance(descriptor, ReverseSingleRelatedObjectDescriptor):
+        field = descriptor.field
+        return field.rel.to, field.get_cache_name(), False, None
+    if isinstance(descriptor, (SingleRelatedObjectDescriptor, ForeignRelatedObjectsDescriptor)):
+        field = descriptor.related.field
+        join = (field.rel.get_related_field().attname, field.attname)
+        if isinstance(descriptor, SingleRelatedObjectDescriptor):
+            return descriptor.related.model, descriptor.cache_name, False, join
+        return descriptor.related.model, many_name, True, join
+    if isinstance(descriptor, ManyRelatedObjectsDescriptor):
+        return descriptor.related.model, many_name, True, None
+    if isinstance(descriptor, ReverseManyRelatedObjectsDescriptor):
+        return descriptor.field.rel.to, many_name, True, None
+    return None
+
+def _get_target(root_model, attr_names):
+    """Returns the relation at the end of the prefetched ``attr_names`` from
+    ``root_model``, as returned by get_relation, or None if any attribute
+    isn't a related model descriptor.
+    """
+    model = root_model
+    relation = None
+    for attr_name in attr_names:
+        relation = get_relation(model, attr_name)
+        if relation is None:
+            return None
+        model = relation[0]
+    return relation
+
+def can_patch(root_model, attr_names, action):
+    """Returns True if the ``action`` can be patched into the trees of
+    ``root_model`` at the end of the prefetched ``attr_names``: every
+    attribute must be a related model descriptor, only reverse
+    ForeignKeys and OneToOneFields can have instances inserted, into
+    unordered lists only, instances can't be removed from forward
+    ForeignKeys, and instances can't be inserted or replaced in lists
+    whose default manager filters them.
+    """
+    relation = _get_target(root_model, attr_names)
+    if relation is None:
+        return False
+    related_model, cache_name, many, join = relation
+    if action == REMOVE:
+        return many or join is not None
+    # Whether the new values still match the filter isn't known.
+    if many and related_model._default_manager.all().query.where.children:
+        return False
+    if action == INSERT:
+        # The new instance's place in an ordered list isn't known.
+        return join is not None and not (many and related_model._default_manager.all().ordered)
+    return True
+
+def get_ordering_attnames(root_model, attr_names):
+    """Returns the set of attnames that the list at the end of the
+    prefetched ``attr_names`` from ``root_model`` is ordered by, which is
+    empty if it isn't an ordered list, or None if it is ordered by
+    anything other than the related model's own fields.
+    """
+    related_model, cache_name, many, join = _get_target(root_model, attr_names)
+    queryset = related_model._default_manager.all()
+    if not many or not queryset.ordered:
+        return set()
+    query = queryset.query
+    if query.extra_order_by:
+        return None
+    opts = related_model._meta
+    attnames = set()
+    for name in query.order_by or opts.ordering:
+        name = name.lstrip("-")
+        if name == "pk":
+            name = opts.pk.name
+        try:
+            attnames.add(opts.get_field(name, many_to_many=False).attname)
+        except FieldDoesNotExist:
+            return None
+    return attnames
+
+def _get_list(value):
+    """Returns the list of related instances held by the cached many related
+    ``value``, a list or a QuerySet, or None if it doesn't hold one.
+    """
+    if isinstance(value, QuerySet):
+        return value._result_cache
+    if isinstance(value, list):
+        return value
+    return None
+
+########################################################################
+
+class TreePatch(object):
+    """A change to one instance of ``model``, made in place in the cached
+    trees that hold it, at the end of the prefetched ``attr_names`` from
+    their root instances. The ``action`` is REPLACE if the instance's
+    field values changed, INSERT if it was created, or REMOVE if it was
+    deleted. The ``values`` are those of the model's ``attnames``, the
+    attnames of its concrete fields, and ``child_attrs`` is the
+    ``prefetch`` tree below the instance, which is filled for an inserted
+    instance.
+    """
+
+    __slots__ = ("action", "model", "attnames", "values", "db", "attr_names",
+                 "child_attrs", "instance")
+
+    def __init__(self, action, model, attnames, values, db, attr_names, child_attrs):
+        self.action = action
+        self.model = model
+        self.attnames = attnames
+        self.values = values
+        self.db = db
+        self.attr_names = attr_names
+        self.child_attrs = child_attrs
+        self.instance = None
+
+    ####################################################################
+
+    def apply(self, root):
+        """Makes the change in the tree ``root``. Returns False if the tree
+        doesn't hold the instance to replace, or the parent to insert it
+        under, in which case the tree must be deleted instead.
+        """
+        nodes = [root]
+        model = root.__class__
+        for attr_name in self.attr_names[:-1]:
+            model, cache_name, many, join = get_relation(model, attr_name)
+            related_nodes = list()
+            seen = set()
+            for node in nodes:
+                for related in self._get_related(node, cache_name, many):
+                    if id(related) not in seen:
+                        seen.add(id(related))
+                        related_nodes.append(related)
+            nodes = related_nodes
+
+        model, cache_name, many, join = get_relation(model, self.attr_names[-1])
+        pk = self.values[self.attnames.index(self.model._meta.pk.attname)]
+        if self.action == REPLACE:
+            found = False
+            for node in nodes:
+                for related in self._get_related(node, cache_name, many):
+                    if related.__class__ is self.model and related.pk == pk:
+                        related.__dict__.update(izip(self.attnames, self.values))
+                        found = True
+            return found
+
+        if self.action == REMOVE:
+            for node in nodes:
+                value = node.__dict__.get(cache_name)
+                if many:
+                    related_list = _get_list(value)
+                    if related_list is not None:
+                        related_list[:] = [related for related in related_list if related.pk != pk]
+                elif value is not None and value.pk == pk:
+                    del node.__dict__[cache_name]
+            return True
+
+        parent_attname, attname = join
+        value = self.values[self.attnames.index(attname)]
+        found = False
+        for node in nodes:
+            if getattr(node, parent_attname) != value:
+                continue
+            found = True
+            if many:
+                related_list = _get_list(node.__dict__.get(cache_name))
+                if related_list is None:
+                    # Not prefetched, so it is read from the database.
+                    continue
+                related_list[:] = [related for related in related_list if related.pk != pk]
+                related_list.append(self.get_instance(root.__class__))
+            else:
+                node.__dict__[cache_name] = self.get_instance(root.__class__)
+        return found
+
+    @staticmethod
+    def _get_related(node, cache_name, many):
+        value = node.__dict__.get(cache_name)
+        if value is None:
+            return ()
+        if many:
+            return _get_list(value) or ()
+        return (value,)
+
+    ####################################################################
+
+    def get_instance(self, root_model):
+        """Returns the instance to insert, built from the ``values`` once, with
+        its ``child_attrs`` prefetched by the ``root_model``'s manager.
+        """
+        if self.instance is None:
+            instance = self.model.__new__(self.model)
+            instance.__dict__ = dict(izip(self.attnames, self.values))
+            state = instance._state = ModelState(self.db)
+            state.adding = False
+            if self.child_attrs:
+                root_model._default_manager.db_manager(self.db)._prefetch_related(
+                    [instance], self.child_attrs)
+            self.instance = instance
+        return self.instance
+
+########################################################################
@@ -28,7 +28,7 @@ setup(name="django-cachetree",
       url="https://github.com/brianjaystanley/django-cachetree",
       author_email="brian@brianjaystanley.com",
       license="MIT",
-      packages=["cachetree"],
+      packages=["cachetree", "cachetree.management", "cachetree.management.commands"],
       package_data={"cachetree": ["fixtures/testdata.json"]},
       install_requires=["django",],
 )